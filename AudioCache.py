@@ -0,0 +1,186 @@
+import asyncio
+import os
+import sqlite3
+import time
+
+import Store
+
+'''
+    On-disk cache of transcoded audio for the tracks that get played over and over.
+
+    Tracks are stored as Ogg/Opus files keyed by extractor and id (youtube-dQw4w9WgXcQ.ogg), so a
+    cached track plays from a local file at disk speed and doesn't care what YouTube is doing.
+
+    A track only gets cached once it has been played `admit_after` times (1 caches everything on
+    its first play). The file is filled in the background by a separate ffmpeg fetch while the
+    track plays normally. The directory is kept under a byte budget by evicting the least recently
+    played files, or the least played ones with policy='lfu'.
+'''
+
+
+def cache_key(info: dict):
+    if not info.get('extractor') or not info.get('id'):
+        return None
+    return '{}-{}'.format(info['extractor'], info['id']).replace('/', '_')
+
+
+class AudioCache:
+    def __init__(self, directory: str = 'audio_cache', *, budget: int = 2 * 1024 ** 3, admit_after: int = 2,
+                 policy: str = 'lru', max_length: int = 20 * 60, fills: int = 2):
+        self.directory = directory
+        self.budget = budget
+        self.admit_after = admit_after
+        self.policy = policy
+        # Anything longer (or without a duration, like streams) isn't worth the disk space.
+        self.max_length = max_length
+
+        self._filling = set()
+        self._fill_slots = asyncio.Semaphore(fills)
+
+        self.hits = 0
+        self.misses = 0
+        self.filled = 0
+        self.failed = 0
+        self.evictions = 0
+
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, 'index.db')
+        db = sqlite3.connect(path)
+        db.execute('CREATE TABLE IF NOT EXISTS tracks (key TEXT PRIMARY KEY, plays INTEGER NOT NULL, '
+                   'last_played REAL NOT NULL, size INTEGER)')
+
+        # key -> [plays, last_played, size]. size is None until the file is actually on disk.
+        self._tracks = {key: [plays, last_played, size]
+                        for key, plays, last_played, size in db.execute('SELECT * FROM tracks')}
+        self.used = sum(track[2] or 0 for track in self._tracks.values())
+        db.close()
+
+        # Everything is read from _tracks after this. Every play gets saved, by a thread of its own so
+        # that it doesn't hold up the song starting.
+        self._writer = Store.Writer(path, name='audio-cache-writer')
+        self._writer.start()
+
+    def path(self, key: str):
+        return os.path.join(self.directory, key + '.ogg')
+
+    def contains(self, key: str):
+        track = self._tracks.get(key) if key else None
+        return track is not None and track[2] is not None
+
+    # Path of the cached file for key, or None if it isn't cached.
+    def lookup(self, key: str):
+        track = self._tracks.get(key) if key else None
+        if track is None or track[2] is None:
+            self.misses += 1
+            return None
+
+        if not os.path.exists(self.path(key)):
+            self._forget(key)
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return self.path(key)
+
+    def _save(self, key: str):
+        plays, last_played, size = self._tracks[key]
+        self._writer.put('INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?)', key, plays, last_played, size)
+
+    def _forget(self, key: str):
+        track = self._tracks.get(key)
+        if track is not None and track[2]:
+            self.used -= track[2]
+            track[2] = None
+            self._save(key)
+
+    # Counts a play of key. Returns True if the track should be cached now.
+    def record_play(self, key: str, length: int):
+        if not key:
+            return False
+
+        track = self._tracks.setdefault(key, [0, 0.0, None])
+        track[0] += 1
+        track[1] = time.time()
+        self._save(key)
+
+        return (track[2] is None and key not in self._filling and track[0] >= self.admit_after
+                and 0 < (length or 0) <= self.max_length)
+
+    def _evict(self, needed: int = 0):
+        cached = [(key, track) for key, track in self._tracks.items() if track[2]]
+        if self.policy == 'lfu':
+            cached.sort(key=lambda item: (item[1][0], item[1][1]))
+        else:
+            cached.sort(key=lambda item: item[1][1])
+
+        for key, track in cached:
+            if self.used + needed <= self.budget:
+                break
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+            self._forget(key)
+            self.evictions += 1
+
+    # Fetches and transcodes a track into the cache with its own ffmpeg process. An upstream stream
+    # that's already Opus is only remuxed.
+    async def fill(self, key: str, stream_url: str, *, acodec: str = None, before_options: str = ''):
+        if key in self._filling:
+            return
+
+        self._filling.add(key)
+        partial = self.path(key) + '.part'
+        try:
+            async with self._fill_slots:
+                codec = ('-c:a', 'copy') if acodec == 'opus' else ('-c:a', 'libopus', '-b:a', '128k', '-ar', '48000',
+                                                                   '-ac', '2')
+                process = await asyncio.create_subprocess_exec(
+                    'ffmpeg', '-nostdin', '-loglevel', 'error', '-y', *before_options.split(), '-i', stream_url,
+                    '-vn', '-map_metadata', '-1', *codec, '-f', 'ogg', partial,
+                    stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+
+                try:
+                    returncode = await process.wait()
+                except asyncio.CancelledError:
+                    process.kill()
+                    raise
+
+                if returncode != 0:
+                    self.failed += 1
+                    return
+
+            size = os.path.getsize(partial)
+            if size > self.budget:
+                return
+
+            self._evict(size)
+            os.replace(partial, self.path(key))
+
+            track = self._tracks.setdefault(key, [0, time.time(), None])
+            track[2] = size
+            self.used += size
+            self._save(key)
+            self.filled += 1
+        finally:
+            self._filling.discard(key)
+            if os.path.exists(partial):
+                os.remove(partial)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'files': sum(1 for track in self._tracks.values() if track[2]),
+            'used_mb': self.used / 1024 ** 2,
+            'budget_mb': self.budget / 1024 ** 2,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'filling': len(self._filling),
+            'filled': self.filled,
+            'failed': self.failed,
+            'evictions': self.evictions,
+        }
+
+    def close(self):
+        self._writer.close()
@@ -0,0 +1,304 @@
+import itertools
+import logging
+import multiprocessing
+import shlex
+import subprocess
+import threading
+import time
+from collections import deque
+
+'''
+    Audio workers: ffmpeg and Opus frame production in separate processes.
+
+    The voice connection itself has to stay in the bot process, discord.py's VoiceClient owns the
+    voice websocket and UDP socket. What moves out is everything that produces the frames: each
+    worker process runs the ffmpeg processes of the streams assigned to it, parses their Ogg output
+    into Opus packets and sends them back in batches over a multiprocessing pipe. The voice thread
+    in the bot then only pops ready frames off a deque, so chat traffic and extraction in the bot
+    process no longer compete with ffmpeg pipe reads and Ogg parsing for the GIL.
+
+    Flow control is credit based: a worker sends at most AHEAD frames more than the bot has played,
+    so a long song isn't read into memory at disk speed. The pool supervises its workers; when one
+    dies it is started again and every stream it had is reopened where playback got to.
+'''
+
+log = logging.getLogger(__name__)
+
+# Frames a stream may be ahead of playback, and how many go in one message or credit grant.
+AHEAD = 250
+BATCH = 25
+
+
+# ffmpeg arguments for Opus in an Ogg container on stdout, same as discord.FFmpegOpusAudio uses.
+def ffmpeg_args(source: str, *, codec: str = None, before_options: str = '', options: str = '',
+                bitrate: int = 128):
+    codec = 'copy' if codec in ('opus', 'libopus') else 'libopus'
+    return ['ffmpeg', *shlex.split(before_options or ''), '-i', source,
+            '-map_metadata', '-1', '-f', 'opus', '-c:a', codec, '-ar', '48000', '-ac', '2',
+            '-b:a', '{}k'.format(bitrate), '-loglevel', 'warning', *shlex.split(options or ''), 'pipe:1']
+
+
+# Runs in the worker process. Messages from the bot: ('open', stream id, args, credit),
+# ('credit', stream id, frames) and ('close', stream id). Messages back: ('frames', stream id,
+# [packets]) and ('end', stream id).
+def worker_main(conn):
+    from discord.oggparse import OggStream
+
+    send_lock = threading.Lock()
+    # stream id -> [process, credit, stopped]. Registered as soon as the open comes in, so a credit or
+    # close that arrives before ffmpeg has been started still finds the stream. process is None until then.
+    streams = {}
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def pump(stream_id, args, stream):
+        _, credit, stopped = stream
+        process = None
+        batch = []
+        try:
+            process = stream[0] = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                                   stderr=subprocess.DEVNULL)
+            # Closed while ffmpeg was starting: the close found no process to kill.
+            if stopped.is_set():
+                return
+            for packet in OggStream(process.stdout).iter_packets():
+                # Out of credit: hand over what's ready before waiting for more.
+                if not credit.acquire(blocking=False):
+                    if batch:
+                        send(('frames', stream_id, batch))
+                        batch = []
+                    credit.acquire()
+                if stopped.is_set():
+                    return
+
+                batch.append(packet)
+                if len(batch) >= BATCH:
+                    send(('frames', stream_id, batch))
+                    batch = []
+
+            if batch:
+                send(('frames', stream_id, batch))
+            send(('end', stream_id))
+        except (OSError, ValueError, EOFError):
+            pass
+        finally:
+            if process is not None:
+                process.kill()
+                process.wait()
+            if streams.get(stream_id) is stream:
+                streams.pop(stream_id, None)
+
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        kind, stream_id = message[0], message[1]
+        if kind == 'open':
+            stream = streams[stream_id] = [None, threading.Semaphore(message[3]), threading.Event()]
+            threading.Thread(target=pump, args=(stream_id, message[2], stream), daemon=True).start()
+        elif kind == 'credit':
+            stream = streams.get(stream_id)
+            if stream is not None:
+                stream[1].release(message[2])
+        elif kind == 'close':
+            stream = streams.pop(stream_id, None)
+            if stream is not None:
+                process, credit, stopped = stream
+                stopped.set()
+                if process is not None:
+                    process.kill()
+                credit.release()
+
+    for process, credit, stopped in list(streams.values()):
+        stopped.set()
+        if process is not None:
+            process.kill()
+
+
+class Worker:
+    __slots__ = ('index', 'process', 'conn', 'lock', 'streams')
+
+    def __init__(self, index: int, process, conn):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.lock = threading.Lock()
+        # stream id -> WorkerStream
+        self.streams = {}
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+
+# Takes the place of a discord.FFmpegOpusAudio: read() hands out Opus frames, cleanup() stops it.
+class WorkerStream:
+    # How long read() waits for a frame before giving up on the stream. Covers a worker restart.
+    TIMEOUT = 10.0
+
+    def __init__(self, pool, stream_id: int, args_at, start: float):
+        self.pool = pool
+        self.id = stream_id
+        # args_at(start) gives the ffmpeg arguments for starting `start` seconds in.
+        self.args_at = args_at
+        self.start = start
+        self.worker = None
+
+        self._frames = deque()
+        self._ready = threading.Condition()
+        self._ended = False
+        self.closed = False
+        self.received = 0
+        self.played = 0
+
+    # Where a new ffmpeg should pick up: after the last frame that came in.
+    def resume_position(self):
+        return self.start + self.received * 0.02
+
+    def _feed(self, packets):
+        with self._ready:
+            self._frames.extend(packets)
+            self.received += len(packets)
+            self._ready.notify()
+
+    def _end(self):
+        with self._ready:
+            self._ended = True
+            self._ready.notify()
+
+    def read(self):
+        with self._ready:
+            if not self._frames and not self._ended:
+                self._ready.wait_for(lambda: self._frames or self._ended or self.closed, self.TIMEOUT)
+            if not self._frames:
+                return b''
+            frame = self._frames.popleft()
+
+        self.played += 1
+        if self.played % BATCH == 0:
+            self.pool.credit(self, BATCH)
+        return frame
+
+    def is_opus(self):
+        return True
+
+    def cleanup(self):
+        self.pool.close(self)
+
+
+class AudioWorkerPool:
+    def __init__(self, workers: int = 2):
+        self.size = workers
+        self._context = multiprocessing.get_context('spawn')
+        self._workers = [None] * workers
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._closing = False
+
+        self.opened = 0
+        self.restarts = 0
+
+    def _start(self, index: int):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(target=worker_main, args=(child,), name='audio-worker-{}'.format(index),
+                                        daemon=True)
+        process.start()
+        child.close()
+
+        worker = Worker(index, process, parent)
+        self._workers[index] = worker
+        threading.Thread(target=self._receive, args=(worker,), name='audio-worker-{}-recv'.format(index),
+                         daemon=True).start()
+        return worker
+
+    def _worker(self):
+        with self._lock:
+            for index, worker in enumerate(self._workers):
+                if worker is None:
+                    return self._start(index)
+            return min(self._workers, key=lambda worker: len(worker.streams))
+
+    # Opens a stream on the least busy worker. args_at(start) builds the ffmpeg arguments.
+    def open(self, args_at, start: float = 0.0):
+        stream = WorkerStream(self, next(self._ids), args_at, start)
+        self._assign(stream, self._worker(), start)
+        self.opened += 1
+        return stream
+
+    def _assign(self, stream: WorkerStream, worker: Worker, start: float):
+        stream.worker = worker
+        worker.streams[stream.id] = stream
+        worker.send(('open', stream.id, stream.args_at(start), AHEAD - len(stream._frames)))
+
+    def credit(self, stream: WorkerStream, frames: int):
+        try:
+            stream.worker.send(('credit', stream.id, frames))
+        except (OSError, ValueError):
+            pass
+
+    def close(self, stream: WorkerStream):
+        if stream.closed:
+            return
+        stream.closed = True
+        stream.worker.streams.pop(stream.id, None)
+        try:
+            stream.worker.send(('close', stream.id))
+        except (OSError, ValueError):
+            pass
+        with stream._ready:
+            stream._ready.notify()
+
+    def _receive(self, worker: Worker):
+        while True:
+            try:
+                kind, stream_id, *rest = worker.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            stream = worker.streams.get(stream_id)
+            if stream is None:
+                continue
+            if kind == 'frames':
+                stream._feed(rest[0])
+            elif kind == 'end':
+                worker.streams.pop(stream_id, None)
+                stream._end()
+
+        if not self._closing:
+            self._restart(worker)
+
+    # A worker died: start a new one in its slot and reopen its streams where they got to.
+    def _restart(self, worker: Worker):
+        log.warning('audio worker %d died (exit code %s), restarting', worker.index, worker.process.exitcode)
+        self.restarts += 1
+        worker.conn.close()
+        # Don't spin if it dies straight away every time.
+        time.sleep(0.5)
+
+        with self._lock:
+            replacement = self._start(worker.index)
+        for stream in list(worker.streams.values()):
+            if not stream.closed:
+                self._assign(stream, replacement, stream.resume_position())
+
+    def stats(self):
+        workers = [worker for worker in self._workers if worker is not None]
+        return {
+            'workers': len(workers),
+            'streams': sum(len(worker.streams) for worker in workers),
+            'opened': self.opened,
+            'restarts': self.restarts,
+        }
+
+    def shutdown(self):
+        self._closing = True
+        for worker in self._workers:
+            if worker is not None:
+                worker.conn.close()
+                worker.process.join(1)
+                if worker.process.is_alive():
+                    worker.process.kill()
@@ -0,0 +1,199 @@
+import itertools
+import random
+
+'''
+    List type for long song queues.
+
+    Items are kept in a list of blocks of a few hundred items each, with a Fenwick tree over the
+    block lengths. Finding the block an index falls in is a walk down the tree, O(log n), and
+    inserting or removing inside a block only moves that block's items. So unlike a deque, indexing,
+    insert/remove anywhere, moving an item and slicing out a page all stay cheap at the back of a
+    10k song queue, and shuffling is a single O(n) pass over a flat copy.
+
+    Blocks are split when they double in size and merged with a neighbour when they shrink to a
+    quarter; both rebuild the tree, which is O(number of blocks).
+'''
+
+
+class BlockList:
+    LOAD = 256
+
+    def __init__(self, iterable=()):
+        self._reset(list(iterable))
+
+    def _reset(self, items: list):
+        self._blocks = [items[i:i + self.LOAD] for i in range(0, len(items), self.LOAD)]
+        self._len = len(items)
+        self._rebuild()
+
+    # Fenwick tree over the block lengths, 1 indexed.
+    def _rebuild(self):
+        tree = [0] + [len(block) for block in self._blocks]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self._tree = tree
+
+    def _update(self, block: int, delta: int):
+        i = block + 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    # (block, offset in block) of a valid, non negative index.
+    def _locate(self, index: int):
+        tree = self._tree
+        pos = 0
+        step = 1 << (len(tree) - 1).bit_length()
+        while step:
+            following = pos + step
+            if following < len(tree) and tree[following] <= index:
+                pos = following
+                index -= tree[following]
+            step >>= 1
+        return pos, index
+
+    def _index(self, index: int):
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('BlockList index out of range')
+        return index
+
+    # Splits a block that got too big, or merges one that got too small into a neighbour.
+    def _balance(self, block: int):
+        blocks = self._blocks
+        size = len(blocks[block])
+
+        if size > 2 * self.LOAD:
+            half = size // 2
+            blocks[block:block + 1] = [blocks[block][:half], blocks[block][half:]]
+        elif size == 0:
+            del blocks[block]
+        elif size < self.LOAD // 4 and len(blocks) > 1:
+            if block + 1 < len(blocks):
+                blocks[block:block + 2] = [blocks[block] + blocks[block + 1]]
+            else:
+                blocks[block - 1:block + 1] = [blocks[block - 1] + blocks[block]]
+                block -= 1
+            if len(blocks[block]) > 2 * self.LOAD:
+                return self._balance(block)
+        else:
+            return
+
+        self._rebuild()
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self._blocks)
+
+    def __repr__(self):
+        return 'BlockList({!r})'.format(list(self))
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return list(self)[index]
+            if start >= stop:
+                return []
+
+            block, offset = self._locate(start)
+            items = []
+            needed = stop - start
+            while needed > 0:
+                chunk = self._blocks[block][offset:offset + needed]
+                items.extend(chunk)
+                needed -= len(chunk)
+                block += 1
+                offset = 0
+            return items
+
+        block, offset = self._locate(self._index(index))
+        return self._blocks[block][offset]
+
+    def __delitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                items = list(self)
+                del items[index]
+                return self._reset(items)
+            if start >= stop:
+                return
+
+            block, offset = self._locate(start)
+            remaining = stop - start
+            while remaining > 0:
+                taken = min(remaining, len(self._blocks[block]) - offset)
+                del self._blocks[block][offset:offset + taken]
+                remaining -= taken
+                block += 1
+                offset = 0
+
+            self._len -= stop - start
+            self._blocks = [block for block in self._blocks if block]
+            self._rebuild()
+            return
+
+        self.pop(index)
+
+    def insert(self, index: int, item):
+        if index < 0:
+            index = max(index + self._len, 0)
+        if index >= self._len:
+            return self.append(item)
+
+        block, offset = self._locate(index)
+        self._blocks[block].insert(offset, item)
+        self._len += 1
+        self._update(block, 1)
+        self._balance(block)
+
+    def append(self, item):
+        if not self._blocks:
+            self._blocks.append([item])
+            self._len = 1
+            return self._rebuild()
+
+        block = len(self._blocks) - 1
+        self._blocks[block].append(item)
+        self._len += 1
+        self._update(block, 1)
+        self._balance(block)
+
+    def pop(self, index: int = -1):
+        block, offset = self._locate(self._index(index))
+        item = self._blocks[block].pop(offset)
+        self._len -= 1
+        self._update(block, -1)
+        self._balance(block)
+        return item
+
+    def popleft(self):
+        if not self._len:
+            raise IndexError('pop from an empty BlockList')
+
+        # The front is always the first block, no need to walk the tree for it.
+        item = self._blocks[0].pop(0)
+        self._len -= 1
+        self._update(0, -1)
+        if len(self._blocks[0]) < self.LOAD // 4:
+            self._balance(0)
+        return item
+
+    # Moves the item at src so it ends up at dst.
+    def move(self, src: int, dst: int):
+        dst = min(max(dst + self._len if dst < 0 else dst, 0), self._len - 1)
+        self.insert(dst, self.pop(src))
+
+    def clear(self):
+        self._reset([])
+
+    def shuffle(self, rng: random.Random = None):
+        items = list(self)
+        (rng or random).shuffle(items)
+        self._reset(items)
@@ -0,0 +1,197 @@
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+
+import Store
+
+'''
+    Extraction cache that sits in front of youtube_dl.
+
+    Two things get cached here, and they age very differently:
+        - search string -> webpage_url, and webpage_url -> trimmed info record. This is metadata
+          (title, uploader, duration...) which is good for weeks.
+        - the `url` stream field of that info. YouTube signs these and they die after a few hours,
+          so it is stored next to its expiry time and only handed out while it is still fresh.
+
+    Lookups go through a small in-memory LRU first and fall back to an SQLite file, so the cache
+    survives the restarts done by MothBotDriver.sh. Writes to the file are left to a Store.Writer
+    thread, the LRU already has them for the lookups that come right after.
+'''
+
+# The only keys from a processed info dict that the bot ever reads. Everything else (formats,
+# description, subtitles, ...) is dropped before it gets cached.
+INFO_KEYS = ('id', 'extractor', 'title', 'uploader', 'uploader_url', 'upload_date', 'thumbnail',
+             'duration', 'tags', 'webpage_url', 'view_count', 'like_count', 'dislike_count', 'acodec')
+
+# Used when a stream url doesn't say when it expires.
+DEFAULT_STREAM_TTL = 60 * 60
+
+
+def trim_info(info: dict):
+    return {key: info.get(key) for key in INFO_KEYS}
+
+
+def normalize_query(search: str):
+    search = ' '.join(search.split())
+    # URLs are case sensitive (video ids are), plain searches are not.
+    if '://' in search:
+        return search
+    return search.lower()
+
+
+# Works out when a stream url stops working. googlevideo urls carry it as `expire=` in the query
+# string or as `/expire/<ts>/` in the path of manifest urls.
+def stream_expiry(url: str, now: float = None):
+    now = now or time.time()
+    parsed = urlparse(url)
+
+    expire = parse_qs(parsed.query).get('expire')
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            pass
+
+    parts = parsed.path.split('/')
+    if 'expire' in parts:
+        index = parts.index('expire')
+        try:
+            return float(parts[index + 1])
+        except (IndexError, ValueError):
+            pass
+
+    return now + DEFAULT_STREAM_TTL
+
+
+class ExtractionCache:
+    def __init__(self, path: str = 'cache.db', *, size: int = 512, search_ttl: float = 7 * 24 * 60 * 60,
+                 info_ttl: float = 30 * 24 * 60 * 60, stream_margin: float = 5 * 60):
+        self.path = path
+        self.size = size
+        self.search_ttl = search_ttl
+        self.info_ttl = info_ttl
+        # A stream url this close to expiring counts as expired, ffmpeg needs time to get through it.
+        self.stream_margin = stream_margin
+
+        self._searches = OrderedDict()
+        self._infos = OrderedDict()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stale_streams = 0
+        self.evictions = 0
+
+        self._db = sqlite3.connect(path)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS searches '
+                         '(query TEXT PRIMARY KEY, webpage_url TEXT NOT NULL, stored REAL NOT NULL)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS infos '
+                         '(webpage_url TEXT PRIMARY KEY, info TEXT NOT NULL, stored REAL NOT NULL, '
+                         'stream_url TEXT, expires REAL)')
+        self._writer = Store.Writer(path, name='cache-writer')
+        self._writer.start()
+        self.prune()
+
+    # Drops anything on disk that is past its TTL.
+    def prune(self):
+        now = time.time()
+        self._writer.put('DELETE FROM searches WHERE stored < ?', now - self.search_ttl)
+        self._writer.put('DELETE FROM infos WHERE stored < ?', now - self.info_ttl)
+
+    def _remember(self, table: OrderedDict, key, value):
+        table[key] = value
+        table.move_to_end(key)
+        while len(table) > self.size:
+            table.popitem(last=False)
+            self.evictions += 1
+
+    def lookup_search(self, search: str):
+        query = normalize_query(search)
+        now = time.time()
+
+        entry = self._searches.get(query)
+        if entry is not None:
+            webpage_url, stored = entry
+            if now - stored < self.search_ttl:
+                self._searches.move_to_end(query)
+                self.hits += 1
+                return webpage_url
+            del self._searches[query]
+
+        row = self._db.execute('SELECT webpage_url, stored FROM searches WHERE query = ?', (query,)).fetchone()
+        if row is not None and now - row[1] < self.search_ttl:
+            self._remember(self._searches, query, row)
+            self.disk_hits += 1
+            return row[0]
+
+        self.misses += 1
+        return None
+
+    def store_search(self, search: str, webpage_url: str):
+        query = normalize_query(search)
+        stored = time.time()
+
+        self._remember(self._searches, query, (webpage_url, stored))
+        self._writer.put('INSERT OR REPLACE INTO searches VALUES (?, ?, ?)', query, webpage_url, stored)
+
+    # Returns (info, stream_url). info is None on a miss, stream_url is None if the metadata is
+    # still good but the stream url has to be resolved again. margin asks for a stream url that
+    # stays alive for longer than the default.
+    def lookup(self, webpage_url: str, margin: float = 0):
+        now = time.time()
+
+        entry = self._infos.get(webpage_url)
+        if entry is not None and now - entry[1] < self.info_ttl:
+            self._infos.move_to_end(webpage_url)
+            self.hits += 1
+        else:
+            row = self._db.execute('SELECT info, stored, stream_url, expires FROM infos WHERE webpage_url = ?',
+                                   (webpage_url,)).fetchone()
+            if row is None or now - row[1] >= self.info_ttl:
+                self.misses += 1
+                return None, None
+
+            entry = (json.loads(row[0]), row[1], row[2], row[3])
+            self._remember(self._infos, webpage_url, entry)
+            self.disk_hits += 1
+
+        info, stored, stream_url, expires = entry
+        if stream_url is None or expires - max(self.stream_margin, margin) <= now:
+            self.stale_streams += 1
+            return info, None
+
+        return info, stream_url
+
+    # Caches a processed info dict, stream url included.
+    def store(self, info: dict):
+        webpage_url = info['webpage_url']
+        stream_url = info.get('url')
+        expires = stream_expiry(stream_url) if stream_url else None
+        trimmed = trim_info(info)
+        stored = time.time()
+
+        self._remember(self._infos, webpage_url, (trimmed, stored, stream_url, expires))
+        self._writer.put('INSERT OR REPLACE INTO infos VALUES (?, ?, ?, ?, ?)',
+                         webpage_url, json.dumps(trimmed), stored, stream_url, expires)
+
+        return trimmed
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'stale_streams': self.stale_streams,
+            'evictions': self.evictions,
+            'hit_rate': (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            'memory_entries': len(self._searches) + len(self._infos),
+        }
+
+    def close(self):
+        self._writer.close()
+        self._db.close()
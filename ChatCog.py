@@ -0,0 +1,360 @@
+import asyncio
+import os
+import random
+
+import discord
+from discord.ext import commands, tasks
+
+import Dice
+import Metrics
+import Music
+import Shards
+import Store
+import Tracing
+import Triggers
+
+
+# def is_owner():
+#     def predicate(ctx):
+#         return ctx.author.id == 238801458030575627 or ctx.author.id == 787208554431119360
+#     return commands.check(predicate)
+
+
+# Keywords that get a custom emoji reaction, keyword -> emoji id.
+EMOJI_TRIGGERS = {
+    ":thonk:": 621072530253414432,
+    ":megathonk:": 739226375239630918,
+    ":gaythonk:": 750168162171093103,
+    ":doublethonk:": 764553793039499286,
+    ":codethonk:": 786700064051298364,
+    ":eggthonk:": 786774524653862962,
+    "mood": 783010747491942431,
+    "darryl": 620036969933701120,
+    "bruh": 786149121123680266,
+    ":high:": 786149121123680266,
+}
+
+# Everything the chat listeners look for. The per-guild ones from `m!trigger` are added on top.
+KEYWORDS = list(EMOJI_TRIGGERS) + ["good bot", "moth", "mother", "mothbot", "praise be"]
+
+
+class ChatCog(commands.Cog):
+    def __init__(self, bot: commands.Bot, store: Store.Store, triggers: Triggers.TriggerEngine):
+        self.bot = bot
+        self.store = store
+        self.triggers = triggers
+        self.current = None
+        self.compact_store.start()
+        if Shards.link is not None:
+            Shards.link.handlers['say'] = self.say_in
+            Shards.link.handlers['describe'] = self.describe_in
+
+    def cog_unload(self):
+        self.compact_store.cancel()
+
+    @commands.command()
+    @commands.is_owner()
+    @commands.dm_only()
+    async def set(self, ctx: commands.Context, id_send: int):
+        self.current = await self.bot.fetch_channel(id_send)
+        if self.current is None:
+            self.current = await self.bot.fetch_user(id_send)
+            if self.current is None:
+                await ctx.send("That is not a valid destination.")
+            else:
+                await ctx.send("Destination to " + self.current.name + ".")
+        else:
+            await ctx.send("Destination to " + await self.describe(self.current) + ".")
+
+    # "channel in guild". Sharded, a channel of a guild this shard doesn't have comes back without the
+    # guild's name (a bare discord.Object), the shard that has it names it instead.
+    async def describe(self, channel):
+        if Shards.link is not None:
+            try:
+                return await Shards.link.call(Shards.link.shard_for(channel.guild.id), 'describe', channel.id)
+            except (RuntimeError, asyncio.TimeoutError):
+                pass
+        return self.name_channel(channel)
+
+    # m!set's description routed here from shard 0.
+    async def describe_in(self, channel_id: int):
+        channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+        return self.name_channel(channel)
+
+    @staticmethod
+    def name_channel(channel):
+        return "{} in {}".format(channel.name, getattr(channel.guild, 'name', None) or channel.guild.id)
+
+    @commands.command(aliases=['send'])
+    @commands.is_owner()
+    @commands.dm_only()
+    async def say(self, ctx: commands.Context, *, message: str):
+        if self.current is None:
+            await ctx.send("Destination has not been set!")
+            return
+
+        # DMs only come in on shard 0, a guild channel gets its message from the shard that has the guild.
+        guild = getattr(self.current, 'guild', None)
+        if Shards.link is not None and guild is not None:
+            try:
+                await Shards.link.call(Shards.link.shard_for(guild.id), 'say', self.current.id, message)
+            except (RuntimeError, asyncio.TimeoutError) as e:
+                await ctx.send("Message not sent: {}".format(e))
+                return
+        else:
+            await self.current.send(message)
+        await ctx.send("Message sent.")
+
+    # m!say routed here from shard 0.
+    async def say_in(self, channel_id: int, message: str):
+        channel = self.bot.get_channel(channel_id) or await self.bot.fetch_channel(channel_id)
+        await channel.send(message)
+
+    @commands.command()
+    @commands.is_owner()
+    @commands.dm_only()
+    async def refresh(self, ctx: commands.Context):
+        os.environ["loop"] = "loop"
+        await ctx.send("Refreshing code...")
+        if Shards.link is not None:
+            # The coordinator logs out every shard, this one included.
+            Shards.link.stop_all("loop")
+        else:
+            await self.bot.logout()
+
+    @commands.command()
+    @commands.is_owner()
+    @commands.dm_only()
+    async def shutdown(self, ctx: commands.Context):
+        os.environ["loop"] = "stop"
+        await ctx.send("Shutting down...")
+        if Shards.link is not None:
+            # The coordinator logs out every shard, this one included.
+            Shards.link.stop_all("stop")
+        else:
+            await self.bot.logout()
+
+    @commands.command(name='extraction', aliases=['cache'])
+    @commands.is_owner()
+    @commands.dm_only()
+    async def extraction_stats(self, ctx: commands.Context):
+        stats = Music.YTDLInfo.cache.stats()
+        await ctx.send("Extraction cache: " + ", ".join("{}={}".format(k, round(v, 3)) for k, v in stats.items()))
+
+        stats = Music.YTDLInfo.extractor.stats()
+        await ctx.send("Extractor: " + ", ".join("{}={}".format(k, v) for k, v in stats.items()))
+
+        stats = Music.YTDLInfo.scheduler.stats()
+        await ctx.send("Workers: " + ", ".join("{}={}".format(k, round(v, 3) if isinstance(v, float) else v)
+                                               for k, v in stats.items()))
+
+    @commands.command(name='audiocache')
+    @commands.is_owner()
+    @commands.dm_only()
+    async def audio_cache_stats(self, ctx: commands.Context):
+        stats = Music.YTDLInfo.audio_cache.stats()
+        await ctx.send("Audio cache: " + ", ".join("{}={}".format(k, round(v, 3)) for k, v in stats.items()))
+
+        if Music.YTDLInfo.AUDIO_WORKERS:
+            stats = Music.YTDLInfo.audio_workers.stats()
+            await ctx.send("Audio workers: " + ", ".join("{}={}".format(k, v) for k, v in stats.items()))
+
+    @commands.command(name='store')
+    @commands.is_owner()
+    @commands.dm_only()
+    async def store_stats(self, ctx: commands.Context):
+        stats = self.store.stats()
+        await ctx.send("Store: " + ", ".join("{}={}".format(k, round(v, 3)) for k, v in stats.items()))
+
+    @commands.command(name='traces')
+    @commands.is_owner()
+    @commands.dm_only()
+    async def play_traces(self, ctx: commands.Context, count: int = 500):
+        records = await self.bot.loop.run_in_executor(None, Tracing.load, count)
+        if not records:
+            await ctx.send("No m!play traces yet.")
+            return
+
+        lines = ['{:<12} {:>6} {:>9} {:>9}'.format('stage', 'count', 'p50 ms', 'p95 ms')]
+        for stage, (total, p50, p95) in sorted(Tracing.summary(records).items(), key=lambda item: -item[1][2]):
+            lines.append('{:<12} {:>6} {:>9.1f} {:>9.1f}'.format(stage, total, p50 * 1000, p95 * 1000))
+        await ctx.send("Latest {} m!play traces:\n```\n{}\n```".format(len(records), "\n".join(lines)))
+
+    @commands.command(name='stalls')
+    @commands.is_owner()
+    @commands.dm_only()
+    async def loop_stalls(self, ctx: commands.Context, count: int = 3):
+        watchdog = self.bot.watchdog
+        if watchdog is None:
+            await ctx.send("The watchdog is off, start with --watchdog to turn it on.")
+            return
+
+        stats = watchdog.stats()
+        await ctx.send("Watchdog: " + ", ".join("{}={}".format(k, round(v, 3)) for k, v in stats.items()))
+        for stall in list(watchdog.stalls)[-count:]:
+            await ctx.send("{}\n```\n{}\n```".format(stall, "".join(stall.stack[-4:])[-1800:]))
+
+    @commands.group()
+    async def react(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
+            await ctx.send('Invalid subcommand for react')
+
+    @react.command()
+    async def add(self, ctx: commands.Context, emoji: str):
+        self.store.reacts.set(ctx.guild.id, ctx.author.id, emoji)
+
+        await ctx.send("Set to react to " + ctx.author.mention + " with " + str(emoji))
+
+    @react.command()
+    async def remove(self, ctx: commands.Context):
+        self.store.reacts.remove(ctx.guild.id, ctx.author.id)
+
+        await ctx.send("Will no longer react to " + ctx.author.mention)
+
+    @commands.group()
+    async def trigger(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
+            await ctx.send("Invalid subcommand for trigger")
+
+    @trigger.command(name='add')
+    async def trigger_add(self, ctx: commands.Context, emoji: str, *, keyword: str):
+        self.triggers.set_trigger(ctx.guild.id, keyword, emoji)
+
+        await ctx.send("Will react to \"" + keyword.lower() + "\" with " + emoji)
+
+    @trigger.command(name='remove')
+    async def trigger_remove(self, ctx: commands.Context, *, keyword: str):
+        if self.triggers.remove_trigger(ctx.guild.id, keyword):
+            await ctx.send("Will no longer react to \"" + keyword.lower() + "\"")
+        else:
+            await ctx.send("There is no trigger for \"" + keyword.lower() + "\"")
+
+    @trigger.command(name='list')
+    async def trigger_list(self, ctx: commands.Context):
+        custom = self.triggers.guild_triggers(ctx.guild.id)
+        if not custom:
+            return await ctx.send("No triggers set up here.")
+
+        await ctx.send("\n".join("\"{}\" -> {}".format(keyword, emoji) for keyword, emoji in custom.items())[:2000])
+
+    @commands.group()
+    async def void(self, ctx: commands.Context):
+        if ctx.invoked_subcommand is None:
+            await ctx.send("Invalid subcommand for void")
+
+    # @void.command()
+    # async def set(self, ctx: commands.Context, channel_id: discord.TextChannel):
+    #     self.store.voids.set(ctx.guild.id, channel_id.id)
+    #
+    #     await ctx.send("Installed a bottomless void in " + channel_id.name)
+
+    @void.command()
+    async def remove(self, ctx: commands.Context):
+        self.store.voids.remove(ctx.guild.id)
+
+        await ctx.send("The void collapsed.")
+
+    @tasks.loop(minutes=5)
+    async def void_swallow(self):
+        for guild_id, channel_id in self.store.voids.items():
+            void = self.bot.get_channel(channel_id)
+
+    @tasks.loop(minutes=30)
+    async def compact_store(self):
+        self.store.compact()
+
+    @commands.command()
+    async def roll(self, ctx: commands.Context, *, dice: str):
+        try:
+            expression = Dice.parse(dice)
+        except Dice.DiceError as e:
+            await ctx.send(str(e))
+            return
+
+        # Anything too big to list takes long enough to hold up every other guild, even sampled.
+        if expression.inline:
+            result = expression.roll()
+        else:
+            result = await self.bot.loop.run_in_executor(None, expression.roll)
+        await ctx.send(result.describe())
+
+    @commands.command()
+    async def bitch(self, ctx: commands.Context):
+        do_copypasta = random.random()
+        if do_copypasta <= 0.1:
+            async with ctx.channel.typing():
+                await asyncio.sleep(2)
+                await ctx.send("What the fuck did you just fucking say about me, you little bitch? I'll have you know "
+                               + "I graduated top of my class in the Navy Seals, and I've been involved in numerous "
+                               + "secret raids on  Al-Quaeda, and I have over 300 confirmed kills. I am trained in "
+                               + "gorilla warfare and I'm the top sniper in the entire US armed forces. You are nothing"
+                               + " to me but just another target. I will wipe you the fuck out with precision the likes"
+                               + " of which has never been seen before on this Earth, mark my fucking words. You think "
+                               + "you can get away with saying that shit to me over the Internet? Think again, fucker. "
+                               + "As we speak I am contacting my secret network of spies across the USA and your IP is "
+                               + "being traced right now so you better prepare for the storm, maggot. The storm that "
+                               + "wipes out the pathetic little thing you call your life. You're fucking dead, kid. I "
+                               + "can be anywhere, anytime, and I can kill you in over seven hundred ways, and that's "
+                               + "just with my bare hands. Not only am I extensively trained in unarmed combat, but I "
+                               + "have access to the entire arsenal of the United States Marine Corps and I will use it"
+                               + " to its full extent to wipe your miserable ass off the face of the continent, you "
+                               + "little shit. If only you could have known what unholy retribution your little "
+                               + "\"clever\" comment was about to bring down upon you, maybe you would have held your "
+                               + "fucking tongue. But you couldn't, you didn't, and now you're paying the price, you "
+                               + "goddamn idiot. I will shit fury all over you and you will drown in it. "
+                               + "You're fucking dead, kiddo.")
+        else:
+            await ctx.send(ctx.message.author.mention + " bitch")
+
+    @commands.command()
+    async def hello(self, ctx: commands.Context):
+        await ctx.send(ctx.message.author.mention + " hello")
+
+    @commands.Cog.listener()
+    async def on_message(self, message: discord.Message):
+        if message.author == self.bot.user:
+            return
+
+        with Metrics.timer('mothbot_on_message_seconds', handler='ChatCog'):
+            is_bot_admin = await self.bot.is_owner(message.author)
+
+            if isinstance(message.channel, discord.DMChannel) and not is_bot_admin:
+                owner = self.bot.get_user(self.bot.owner_id)
+                self.bot.outbound.send(owner, "Message from " + message.author.name + ": " + message.content)
+
+            found = self.triggers.scan(message)
+
+            if "good bot" in found:
+                self.bot.outbound.send(message.channel, "thenk \U0001F642")  # Smiling face
+
+            emojis = []
+            for keyword, emoji_id in EMOJI_TRIGGERS.items():
+                if keyword in found and self.bot.get_emoji(emoji_id) not in emojis:
+                    emojis.append(self.bot.get_emoji(emoji_id))
+
+            custom = self.triggers.guild_triggers(message.guild.id) if message.guild else {}
+            for keyword in found:
+                if keyword in custom:
+                    emojis.append(custom[keyword])
+
+            if isinstance(message.channel, discord.TextChannel):
+                emoji = self.store.reacts.get(message.guild.id, message.author.id)
+                if emoji is not None:
+                    emojis.append(emoji)
+
+            self.bot.outbound.react(message, *emojis)
+
+    @commands.Cog.listener()
+    async def on_reaction_add(self, reaction: discord.Reaction, user):
+        if user == self.bot.user:
+            return
+
+        if reaction.emoji == '\U00002755' or reaction.emoji == '\U00002757':
+            self.bot.outbound.react(reaction.message, '🇼', '🇭', '🇦', '🇹')
+
+
+# The store lives on the bot and outlives reloads, only the trigger engine is rebuilt from it. The
+# module level on_message in MothBot.py reads it from bot.triggers too.
+def setup(bot: commands.Bot):
+    bot.triggers = Triggers.TriggerEngine(KEYWORDS, bot.store.triggers)
+    bot.add_cog(ChatCog(bot, bot.store, bot.triggers))
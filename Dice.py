@@ -0,0 +1,468 @@
+import math
+import random
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+'''
+    Dice expressions for m!roll.
+
+        expression  [+|-] term ((+|-) term)*
+        term        number | dice
+        dice        [count] d (sides | %) modifier*
+        modifier    !         explode: a die showing its highest face is rolled again and added
+                    khN, kN   keep the N highest dice        dhN  drop the N highest
+                    klN       keep the N lowest dice         dlN  drop the N lowest
+                    rN        reroll any die showing N or less until it doesn't
+                    roN       reroll any die showing N or less, once
+
+    How a dice term gets rolled depends on its size, so that no roll costs more than a few
+    milliseconds however many dice it asks for:
+
+        up to LIST_DICE dice        one by one, and every die is shown in the reply
+        up to FACE_LIMIT sides      how many dice landed on each face, drawn from the multinomial
+                                    distribution of all of them at once. That is exact, for sums
+                                    and keeps alike, and costs the same for a hundred dice as for
+                                    a billion. Exploded dice are the dice on the top face rolled
+                                    again, which is the same draw again for just those.
+        up to VECTOR_DICE dice      one by one, vectorized with NumPy. Without NumPy only up to
+                                    PYTHON_DICE, in a plain loop
+        more than that              the sum drawn from its normal approximation, which for that
+                                    many dice can't be told apart from the real thing
+
+    Anything over LIST_DICE dice is summarized in the reply instead of listed. Only rolls small
+    enough to be listed are quick enough to roll on the event loop, see Expression.inline.
+'''
+
+MAX_DICE = 10 ** 12
+MAX_SIDES = 10 ** 9
+MAX_TERMS = 20
+
+LIST_DICE = 100
+FACE_LIMIT = 1000
+VECTOR_DICE = 10 ** 6
+PYTHON_DICE = 10 ** 5
+# How many times in a row a die can explode, for the dice where it would never stop (d6!r5).
+EXPLODE_LIMIT = 100
+# Replies with more detail than this only get the summaries.
+DETAIL_LENGTH = 1500
+
+USAGE = 'Format is like `2d6 + 3`, `1d20 - 1d4`, `4d6kh3`, `2d20kl1`, `3d6!`, `4d6r1` or `2d10ro2`.'
+
+TERM = re.compile(r'(\d*)d(\d+|%)([a-z!\d]*)|(\d+)')
+MODIFIER = re.compile(r'!|(kh|kl|k|dh|dl|ro|r)(\d+)')
+
+
+class DiceError(Exception):
+    pass
+
+
+# int() gives up past a few thousand digits, no roll needs numbers anywhere near that long anyway.
+def number(digits: str):
+    try:
+        return int(digits)
+    except ValueError:
+        raise DiceError('`{}...` is too long a number.'.format(digits[:12])) from None
+
+
+class Dice:
+    __slots__ = ('count', 'sides', 'keep', 'explode', 'reroll', 'once')
+
+    def __init__(self, count: int, sides: int):
+        self.count = count
+        self.sides = sides
+        # ('h' or 'l', how many) when only some of the dice count.
+        self.keep = None
+        self.explode = False
+        # Faces up to and including this one get rerolled, just once if `once`.
+        self.reroll = 0
+        self.once = False
+
+    def __str__(self):
+        text = '{}d{}'.format(self.count, self.sides)
+        if self.explode:
+            text += '!'
+        if self.reroll:
+            text += '{}{}'.format('ro' if self.once else 'r', self.reroll)
+        if self.keep:
+            text += 'k{}{}'.format(*self.keep)
+        return text
+
+    @classmethod
+    def parse(cls, count: str, sides: str, modifiers: str):
+        dice = cls(number(count) if count else 1, 100 if sides == '%' else number(sides))
+        if not 1 <= dice.count <= MAX_DICE:
+            raise DiceError('Between 1 and {:,} dice, please.'.format(MAX_DICE))
+        if not 1 <= dice.sides <= MAX_SIDES:
+            raise DiceError('Dice have between 1 and {:,} sides.'.format(MAX_SIDES))
+
+        position = 0
+        while position < len(modifiers):
+            match = MODIFIER.match(modifiers, position)
+            if match is None:
+                raise DiceError('`{}` isn\'t something dice can do. {}'.format(modifiers[position:], USAGE))
+            position = match.end()
+
+            kind = match.group(1)
+            if kind is None:
+                dice.explode = True
+                continue
+            amount = number(match.group(2))
+            if kind in ('r', 'ro'):
+                dice.reroll, dice.once = amount, kind == 'ro'
+            elif kind in ('kh', 'k', 'kl'):
+                dice.keep = (kind[-1] if kind != 'k' else 'h', amount)
+            else:
+                if amount > dice.count:
+                    raise DiceError('Can\'t drop {} of {} dice.'.format(amount, dice.count))
+                # Dropping the highest is keeping the lowest of the rest, and the other way around.
+                dice.keep = ('l' if kind == 'dh' else 'h', dice.count - amount)
+
+        if dice.explode and dice.sides == 1:
+            raise DiceError('A d1 would explode forever.')
+        if dice.reroll >= dice.sides:
+            if not dice.once:
+                raise DiceError('Rerolling every face of a d{} would never end.'.format(dice.sides))
+            raise DiceError('A d{} can only reroll up to {} once.'.format(dice.sides, dice.sides - 1))
+        if dice.keep and dice.keep[1] > dice.count:
+            raise DiceError('Can\'t keep {} of {} dice.'.format(dice.keep[1], dice.count))
+        if dice.keep and dice.keep[1] == dice.count:
+            dice.keep = None
+        if dice.count > vector_dice() and dice.sides > FACE_LIMIT and (dice.keep or dice.explode):
+            raise DiceError('That\'s too many dice of that size to keep or explode.')
+        return dice
+
+    # The chance of each face, 1 to sides, after rerolling.
+    def faces(self):
+        sides, reroll = self.sides, self.reroll
+        if not reroll:
+            return [1 / sides] * sides
+        if not self.once:
+            return [0.0] * reroll + [1 / (sides - reroll)] * (sides - reroll)
+        low = reroll / sides / sides
+        return [low] * reroll + [1 / sides + low] * (sides - reroll)
+
+    # One face, after rerolling.
+    def face(self, rng):
+        if self.reroll and not self.once:
+            return rng.randint(self.reroll + 1, self.sides)
+        value = rng.randint(1, self.sides)
+        if value <= self.reroll:
+            value = rng.randint(1, self.sides)
+        return value
+
+    # One die: every face it showed, more than one when it exploded.
+    def roll_die(self, rng):
+        rolls = [self.face(rng)]
+        while self.explode and rolls[-1] == self.sides and len(rolls) <= EXPLODE_LIMIT:
+            rolls.append(self.face(rng))
+        return rolls
+
+    # Which of the totals count, as a list of booleans.
+    def kept(self, totals: list):
+        if not self.keep:
+            return [True] * len(totals)
+        which, number = self.keep
+        order = sorted(range(len(totals)), key=totals.__getitem__, reverse=which == 'h')
+        kept = [False] * len(totals)
+        for index in order[:number]:
+            kept[index] = True
+        return kept
+
+    # Mean and variance of a single face, for the normal approximation.
+    def moments(self):
+        def uniform(a: int, b: int):
+            n = b - a + 1
+            mean = (a + b) / 2
+            return mean, (n * n - 1) / 12 + mean * mean
+
+        if not self.reroll:
+            mean, square = uniform(1, self.sides)
+        elif not self.once:
+            mean, square = uniform(self.reroll + 1, self.sides)
+        else:
+            # Kept as it was when above the reroll, otherwise whatever the second roll shows.
+            chance = self.reroll / self.sides
+            high, high_square = uniform(self.reroll + 1, self.sides)
+            any_, any_square = uniform(1, self.sides)
+            mean = (1 - chance) * high + chance * any_
+            square = (1 - chance) * high_square + chance * any_square
+        return mean, square - mean * mean
+
+
+class Term:
+    __slots__ = ('term', 'total', 'dice')
+
+    # total is before the term's sign. dice is a list of (rolls, kept) for every die, or None when
+    # there were too many to list.
+    def __init__(self, term, total: int, dice: list = None):
+        self.term = term
+        self.total = total
+        self.dice = dice
+
+    def detail(self, nested: bool):
+        term = self.term
+        if not isinstance(term, Dice):
+            return str(term)
+
+        if self.dice is None:
+            text = '{:,} dice'.format(term.count)
+            kept = term.count
+            if term.keep:
+                which, kept = term.keep
+                text = '{:,} {} of {}'.format(kept, 'highest' if which == 'h' else 'lowest', text)
+            text += ', {:.2f} on average'.format(self.total / kept if kept else 0)
+            return '[' + text + ']' if nested else text
+
+        shown = []
+        for rolls, kept in self.dice:
+            die = '!'.join(str(value) for value in rolls)
+            shown.append(die if kept else '~~' + die + '~~')
+        text = ' + '.join(shown)
+        return '[' + text + ']' if nested and len(shown) > 1 else text
+
+
+class Result:
+    def __init__(self, expression, terms: list):
+        self.expression = expression
+        self.terms = terms
+        self.total = sum(sign * term.total for term, sign in zip(terms, expression.signs))
+
+    def detail(self):
+        nested = len(self.terms) > 1
+        text = ''
+        for index, (term, sign) in enumerate(zip(self.terms, self.expression.signs)):
+            part = term.detail(nested)
+            if index == 0:
+                text = ('-' if sign < 0 else '') + part
+            else:
+                text += (' - ' if sign < 0 else ' + ') + part
+        return text
+
+    # The reply for m!roll. A single die needs no breakdown.
+    def describe(self):
+        header = 'Roll `{}`: {}'.format(self.expression, self.total)
+        only = self.terms[0].term if len(self.terms) == 1 else None
+        if isinstance(only, Dice) and only.count == 1 and not only.explode:
+            return header
+
+        detail = self.detail()
+        if len(detail) > DETAIL_LENGTH:
+            for term in self.terms:
+                term.dice = None
+            detail = self.detail()
+        return '{} ({})'.format(header, detail)
+
+
+class Expression:
+    def __init__(self, terms: list, signs: list):
+        # Dice, or ints for the constants.
+        self.terms = terms
+        self.signs = signs
+
+    def __str__(self):
+        text = ''
+        for index, (term, sign) in enumerate(zip(self.terms, self.signs)):
+            if index == 0:
+                text = ('-' if sign < 0 else '') + str(term)
+            else:
+                text += ('-' if sign < 0 else '+') + str(term)
+        return text
+
+    # Small enough to roll right on the event loop, everything is listed.
+    @property
+    def inline(self):
+        return all(not isinstance(term, Dice) or term.count <= LIST_DICE for term in self.terms)
+
+    def roll(self, rng=random):
+        return Result(self, [roll_dice(term, rng) if isinstance(term, Dice) else Term(term, term)
+                             for term in self.terms])
+
+
+def parse(text: str):
+    text = text.replace(' ', '').lower()
+    if not text:
+        raise DiceError(USAGE)
+
+    terms, signs = [], []
+    position = 0
+    sign = 1
+    if text[0] in '+-':
+        sign = -1 if text[0] == '-' else 1
+        position = 1
+
+    while True:
+        match = TERM.match(text, position)
+        if match is None or match.end() == position:
+            raise DiceError(USAGE)
+        if match.group(4) is not None:
+            terms.append(number(match.group(4)))
+        else:
+            terms.append(Dice.parse(match.group(1), match.group(2), match.group(3)))
+        signs.append(sign)
+        position = match.end()
+
+        if position == len(text):
+            break
+        if text[position] not in '+-':
+            raise DiceError(USAGE)
+        sign = -1 if text[position] == '-' else 1
+        position += 1
+
+    if len(terms) > MAX_TERMS:
+        raise DiceError('Up to {} terms, please.'.format(MAX_TERMS))
+    return Expression(terms, signs)
+
+
+def roll_dice(dice: Dice, rng=random):
+    if dice.count <= LIST_DICE:
+        rolls = [dice.roll_die(rng) for _ in range(dice.count)]
+        totals = [sum(die) for die in rolls]
+        kept = dice.kept(totals)
+        return Term(dice, sum(total for total, keep in zip(totals, kept) if keep), list(zip(rolls, kept)))
+
+    if dice.sides <= FACE_LIMIT:
+        return Term(dice, face_total(dice, dice.count, dice.keep, rng))
+    if dice.count <= vector_dice():
+        return Term(dice, vector_total(dice, rng))
+    return Term(dice, normal_total(dice, rng))
+
+
+# Most dice worth rolling one by one.
+def vector_dice():
+    return VECTOR_DICE if numpy is not None else PYTHON_DICE
+
+
+# Draws how many of `count` dice land on each face. Exact with NumPy, and without it each face is
+# a binomial draw from the dice the faces before it left over.
+def multinomial(count: int, chances: list, rng=random):
+    if numpy is not None:
+        generator = numpy.random.default_rng(rng.getrandbits(64))
+        return [int(n) for n in generator.multinomial(count, chances)]
+
+    counts = []
+    left, rest = count, 1.0
+    for chance in chances[:-1]:
+        drawn = binomial(left, min(chance / rest, 1.0), rng) if rest > 0 else 0
+        counts.append(drawn)
+        left -= drawn
+        rest -= chance
+    counts.append(left)
+    return counts
+
+
+def binomial(n: int, p: float, rng=random):
+    if n <= 0 or p <= 0:
+        return 0
+    if p >= 1:
+        return n
+    if n < 64:
+        return sum(1 for _ in range(n) if rng.random() < p)
+
+    mean = n * p
+    if n - mean < 30:
+        return n - binomial(n, 1 - p, rng)
+    if mean < 30:
+        # Inverting the distribution, a step per success on average.
+        u = rng.random()
+        k, chance = 0, (1 - p) ** n
+        while u > chance and k < n:
+            u -= chance
+            chance *= (n - k) / (k + 1) * p / (1 - p)
+            k += 1
+        return k
+
+    # Over 30 either way the normal approximation is as good as exact for dice.
+    drawn = round(rng.gauss(mean, math.sqrt(mean * (1 - p))))
+    return min(max(drawn, 0), n)
+
+
+# Total of `count` dice worked out from how many land on each face, keeping only the highest or
+# lowest `keep` if given. The dice that exploded are `count` more dice of their own, one level down.
+def face_total(dice: Dice, count: int, keep, rng=random, depth: int = 0):
+    if count == 0:
+        return 0
+    counts = multinomial(count, dice.faces(), rng)
+    sides = dice.sides
+
+    exploded = 0
+    if dice.explode and depth < EXPLODE_LIMIT:
+        exploded = counts[-1]
+        counts[-1] = 0
+
+    def take(number: int, faces):
+        total = 0
+        for face in faces:
+            taken = min(counts[face - 1], number)
+            total += face * taken
+            number -= taken
+            if not number:
+                break
+        return total
+
+    if keep is None:
+        total = sum(face * n for face, n in enumerate(counts, 1))
+        return total + sides * exploded + face_total(dice, exploded, None, rng, depth + 1)
+
+    which, number = keep
+    # An exploded die is worth more than any other, so keeping the highest takes those first.
+    if which == 'h':
+        if number <= exploded:
+            return sides * number + face_total(dice, exploded, ('h', number), rng, depth + 1)
+        total = sides * exploded + face_total(dice, exploded, None, rng, depth + 1)
+        return total + take(number - exploded, range(sides, 0, -1))
+
+    others = count - exploded
+    if number <= others:
+        return take(number, range(1, sides + 1))
+    total = take(others, range(1, sides + 1))
+    return total + sides * (number - others) + face_total(dice, exploded, ('l', number - others), rng, depth + 1)
+
+
+# Total of every die rolled one by one, in a few array operations when NumPy is there.
+def vector_total(dice: Dice, rng=random):
+    if numpy is None:
+        totals = [sum(dice.roll_die(rng)) for _ in range(dice.count)]
+        kept = dice.kept(totals)
+        return sum(total for total, keep in zip(totals, kept) if keep)
+
+    generator = numpy.random.default_rng(rng.getrandbits(64))
+
+    def faces(count: int):
+        if dice.reroll and not dice.once:
+            return generator.integers(dice.reroll + 1, dice.sides + 1, count, dtype=numpy.int64)
+        values = generator.integers(1, dice.sides + 1, count, dtype=numpy.int64)
+        if dice.reroll:
+            again = values <= dice.reroll
+            values[again] = generator.integers(1, dice.sides + 1, int(again.sum()), dtype=numpy.int64)
+        return values
+
+    totals = faces(dice.count)
+    if dice.explode:
+        exploding = numpy.flatnonzero(totals == dice.sides)
+        for _ in range(EXPLODE_LIMIT):
+            if not len(exploding):
+                break
+            values = faces(len(exploding))
+            totals[exploding] += values
+            exploding = exploding[values == dice.sides]
+
+    if dice.keep:
+        which, number = dice.keep
+        if not number:
+            return 0
+        if which == 'h':
+            return int(numpy.partition(totals, dice.count - number)[dice.count - number:].sum())
+        return int(numpy.partition(totals, number - 1)[:number].sum())
+    return int(totals.sum())
+
+
+# The sum of more dice than are worth rolling, drawn from the normal distribution it converges to.
+def normal_total(dice: Dice, rng=random):
+    mean, variance = dice.moments()
+    low = dice.reroll + 1 if dice.reroll and not dice.once else 1
+    drawn = round(rng.gauss(dice.count * mean, math.sqrt(dice.count * variance)))
+    return min(max(drawn, dice.count * low), dice.count * dice.sides)
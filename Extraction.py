@@ -0,0 +1,316 @@
+import asyncio
+import functools
+import itertools
+import threading
+import time
+from urllib.parse import urlparse, parse_qs
+
+import Cache
+import Metrics
+import Scheduler
+
+'''
+    Extraction front end for youtube_dl.
+
+    A query is resolved in a single processed extract_info pass whenever possible, and results go
+    through the extraction cache. Identical queries that are already in flight (a few guilds
+    pasting the same link at once) share one pending future instead of each running their own
+    extraction.
+
+    Playlists are listed flat (ids and titles only) on an extraction worker like everything else,
+    and with thread workers streamed out entry by entry, so playback can start long before a big
+    playlist has been fully listed.
+'''
+
+
+class YTDLError(Exception):
+    pass
+
+
+# Playlist urls are the one case where a processed pass is a bad idea, it would resolve every
+# single entry just to play the first one.
+def is_playlist_url(search: str):
+    if '://' not in search:
+        return False
+
+    parsed = urlparse(search)
+    query = parse_qs(parsed.query)
+    return parsed.path.rstrip('/').endswith('/playlist') or ('list' in query and 'v' not in query)
+
+
+def first_entry(data: dict):
+    if 'entries' not in data:
+        return data
+
+    for entry in data['entries']:
+        if entry:
+            return entry
+
+    return None
+
+
+# Turns a flat playlist entry into the little bit needed to queue it and resolve it later. None for
+# entries there is no url to resolve (deleted and private videos can come back like that).
+def playlist_entry(entry: dict):
+    url = entry.get('webpage_url') or entry.get('url')
+    if not url:
+        return None
+    if '://' not in url and entry.get('ie_key') == 'Youtube':
+        url = 'https://www.youtube.com/watch?v=' + url
+
+    return {'title': entry.get('title') or url, 'webpage_url': url, 'duration': entry.get('duration'),
+            'uploader': entry.get('uploader')}
+
+
+# What actually runs on an extraction worker. Only the first entry comes back, trimmed, since that's
+# all the bot uses and in process mode everything returned has to be pickled.
+# Returns (entry, phases). The processed pass is split in two the same way extract_info does it
+# internally, so phases has how long finding the video (search) and resolving its formats
+# (process) each took.
+def extract_first(ytdl, url: str, process: bool = True):
+    started = time.perf_counter()
+    data = ytdl.extract_info(url, download=False, process=False)
+    searched = time.perf_counter()
+    phases = {'search': searched - started}
+    if process and data is not None:
+        data = ytdl.process_ie_result(data, download=False)
+        phases['process'] = time.perf_counter() - searched
+
+    entry = first_entry(data) if data is not None else None
+    if entry is None:
+        return None, phases
+
+    return dict(Cache.trim_info(entry), url=entry.get('url')), phases
+
+
+# youtube_dl loads every one of its extractors on import, which is a good part of the bot's startup
+# time. It's only imported here, the first time a YoutubeDL is actually needed.
+def build_ytdl(options: dict, **overrides):
+    import youtube_dl
+    # Silence useless bug reports messages
+    youtube_dl.utils.bug_reports_message = lambda: ''
+    return youtube_dl.YoutubeDL(dict(options, **overrides))
+
+
+# The entries of a flat playlist listing, up to limit of them. youtube_dl pages through the playlist
+# as they're taken.
+def flat_entries(ytdl, url: str, limit: int = None):
+    data = ytdl.extract_info(url, download=False, process=False)
+    entries = data.get('entries', [data]) if data is not None else []
+    return (entry for entry in itertools.islice(entries, limit) if entry)
+
+
+_worker_ytdl = None
+_worker_flat_ytdl = None
+
+
+# Same as extract_first, for process workers. Each worker process builds its own YoutubeDL once.
+def extract_first_in_worker(options: dict, url: str, process: bool = True):
+    global _worker_ytdl
+    if _worker_ytdl is None:
+        _worker_ytdl = build_ytdl(options)
+
+    return extract_first(_worker_ytdl, url, process)
+
+
+# The playlist listing for process workers. A generator can't be sent back, so it's all at once.
+def list_playlist_in_worker(options: dict, url: str, limit: int = None):
+    global _worker_flat_ytdl
+    if _worker_flat_ytdl is None:
+        _worker_flat_ytdl = build_ytdl(options, extract_flat='in_playlist', noplaylist=False)
+
+    return list(flat_entries(_worker_flat_ytdl, url, limit))
+
+
+class Extractor:
+    # Listing a playlist takes one youtube_dl request per page of entries, so it gets longer than a
+    # single video does on the scheduler.
+    PLAYLIST_TIMEOUT = 5 * 60
+
+    def __init__(self, cache: Cache.ExtractionCache, scheduler: Scheduler.ExtractionScheduler, options: dict):
+        self.cache = cache
+        self.scheduler = scheduler
+        self.options = options
+
+        # Both built on first use (or by warm()), see build_ytdl.
+        self._ytdl = None
+        self._flat_ytdl = None
+        self._build_lock = threading.Lock()
+        self._pending = {}
+        self._waiters = {}
+
+        self.extractions = 0
+        self.coalesced = 0
+
+    # Runs coro_factory() once per key, anyone asking for the same key while it runs gets the same
+    # future. The shield stops one impatient caller from cancelling everyone else's result, the
+    # extraction itself is only cancelled once every caller has given up on it.
+    async def _shared(self, key, coro_factory, loop: asyncio.AbstractEventLoop):
+        future = self._pending.get(key)
+        if future is None:
+            future = loop.create_task(coro_factory())
+            self._pending[key] = future
+            future.add_done_callback(lambda _: self._pending.pop(key, None))
+        else:
+            self.coalesced += 1
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not future.done():
+                future.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    # Runs on an extraction thread, so the first call is the one that pays for building the YoutubeDL.
+    def _extract_first(self, url: str, process: bool = True):
+        return extract_first(self._get_ytdl(), url, process)
+
+    async def _extract(self, url: str, guild_id, *, process: bool = True, trace=None):
+        self.extractions += 1
+        if self.scheduler.processes:
+            partial = functools.partial(extract_first_in_worker, self.options, url, process)
+        else:
+            partial = functools.partial(self._extract_first, url, process)
+
+        # Whatever youtube_dl or the workers raise (DownloadError, BrokenProcessPool, PoolReset) is a
+        # YTDLError to the callers, those are the ones they handle. Cancellation still goes through.
+        try:
+            info, phases = await self.scheduler.run(guild_id, partial)
+        except asyncio.TimeoutError:
+            raise YTDLError('Timed out while fetching `{}`'.format(url))
+        except Exception as e:
+            raise YTDLError('Couldn\'t fetch `{}`: {}'.format(url, e)) from e
+
+        for phase, seconds in phases.items():
+            Metrics.observe('mothbot_extraction_seconds', seconds, phase=phase)
+            if trace is not None:
+                trace.add(phase, seconds)
+        return info
+
+    # Returns a processed info dict (trimmed, with a live `url`) for a search string or url.
+    # guild_id decides whose turn it is on the extraction workers. The youtube_dl passes that were
+    # needed are added to trace (a Tracing.Trace) if there is one.
+    async def resolve(self, search: str, *, guild_id=None, loop: asyncio.AbstractEventLoop = None, trace=None):
+        loop = loop or asyncio.get_event_loop()
+        info = await self._shared(('search', Cache.normalize_query(search)),
+                                  lambda: self._resolve(search, guild_id, loop, trace), loop)
+        return dict(info)
+
+    async def _resolve(self, search: str, guild_id, loop: asyncio.AbstractEventLoop, trace):
+        webpage_url = self.cache.lookup_search(search)
+        if webpage_url is not None:
+            return await self.resolve_url(webpage_url, guild_id=guild_id, loop=loop, trace=trace)
+
+        target = search
+        if is_playlist_url(search):
+            entry = await self._extract(search, guild_id, process=False, trace=trace)
+            target = entry and (entry.get('webpage_url') or entry.get('url'))
+            if not target:
+                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        info = await self._extract(target, guild_id, trace=trace)
+        if info is None:
+            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
+
+        self.cache.store_search(search, info['webpage_url'])
+        return dict(self.cache.store(info), url=info['url'])
+
+    # Same as resolve, but for a known webpage_url. Only hits youtube_dl when the cached stream url
+    # has gone stale, or would within `margin` seconds.
+    async def resolve_url(self, webpage_url: str, *, margin: float = 0, guild_id=None,
+                          loop: asyncio.AbstractEventLoop = None, trace=None):
+        loop = loop or asyncio.get_event_loop()
+
+        info, stream_url = self.cache.lookup(webpage_url, margin)
+        if info is not None and stream_url is not None:
+            return dict(info, url=stream_url)
+
+        return dict(await self._shared(('url', webpage_url), lambda: self._refresh(webpage_url, guild_id, trace),
+                                       loop))
+
+    async def _refresh(self, webpage_url: str, guild_id, trace=None):
+        info = await self._extract(webpage_url, guild_id, trace=trace)
+        if info is None:
+            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
+
+        return dict(self.cache.store(info), url=info['url'])
+
+    def _get_ytdl(self):
+        with self._build_lock:
+            if self._ytdl is None:
+                self._ytdl = build_ytdl(self.options)
+            return self._ytdl
+
+    def _get_flat_ytdl(self):
+        with self._build_lock:
+            if self._flat_ytdl is None:
+                self._flat_ytdl = build_ytdl(self.options, extract_flat='in_playlist', noplaylist=False)
+            return self._flat_ytdl
+
+    # Imports youtube_dl and builds the YoutubeDL instances ahead of the first music command. Blocks,
+    # so run it in an executor.
+    def warm(self):
+        self._get_ytdl()
+        self._get_flat_ytdl()
+
+    # Async generator over the entries of a playlist, as playlist_entry dicts. The listing is a job on
+    # the scheduler, in guild_id's line like any extraction. With thread workers entries come out as
+    # youtube_dl pages through them, with process workers once the listing is done.
+    async def iter_playlist(self, url: str, *, limit: int = None, guild_id=None,
+                            loop: asyncio.AbstractEventLoop = None):
+        loop = loop or asyncio.get_event_loop()
+        queue = asyncio.Queue()
+        stop = threading.Event()
+        done = object()
+
+        def produce():
+            for entry in flat_entries(self._get_flat_ytdl(), url, limit):
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, entry)
+
+        if self.scheduler.processes:
+            job = functools.partial(list_playlist_in_worker, self.options, url, limit)
+        else:
+            job = produce
+
+        # After whatever produce() handed over, its call_soon_threadsafe calls come first.
+        def listed(task: asyncio.Task):
+            if not task.cancelled() and task.exception() is None:
+                for entry in task.result() or ():
+                    queue.put_nowait(entry)
+            queue.put_nowait(done)
+
+        listing = loop.create_task(self.scheduler.run(guild_id, job, timeout=self.PLAYLIST_TIMEOUT))
+        listing.add_done_callback(listed)
+
+        try:
+            while True:
+                item = await queue.get()
+                if item is done:
+                    break
+
+                entry = playlist_entry(item)
+                if entry is not None:
+                    yield entry
+
+            error = listing.exception()
+            if isinstance(error, asyncio.TimeoutError):
+                raise YTDLError('Timed out while listing `{}`'.format(url))
+            if error is not None:
+                raise YTDLError('Couldn\'t list `{}`: {}'.format(url, error)) from error
+        finally:
+            stop.set()
+            listing.cancel()
+
+    def stats(self):
+        return {
+            'extractions': self.extractions,
+            'coalesced': self.coalesced,
+            'in_flight': len(self._pending),
+        }
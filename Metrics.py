@@ -0,0 +1,215 @@
+import asyncio
+import bisect
+import logging
+import os
+import sys
+import time
+
+'''
+    Optional metrics endpoint, in the Prometheus text format.
+
+    Turned on with `python3 MothBot.py --metrics PORT` or MOTHBOT_METRICS=PORT, it serves
+    http://127.0.0.1:PORT/metrics (a sharded launch uses PORT + shard id). Off, every inc() and
+    observe() returns straight away.
+
+    On, counters and histograms are a dict lookup and an add each. Anything that is a current
+    value rather than a count (queue depths, voice states, ffmpeg processes) isn't tracked at all,
+    collectors registered with collector() compute it when /metrics is actually scraped. So nothing
+    costs more than a few hundred nanoseconds unless somebody is looking.
+
+    What gets measured:
+        mothbot_command_seconds{command, outcome}      commands, from on_command to completion
+        mothbot_extraction_seconds{phase}              youtube_dl, search and processing separately
+        mothbot_on_message_seconds{handler}            the on_message handlers, commands excluded
+        mothbot_rest_seconds{route}, mothbot_rest_requests_total{route, status}
+        mothbot_rest_rate_limited_total{route}         429s, including the ones discord.py retries
+        mothbot_queue_depth{guild}, mothbot_voice_states, mothbot_ffmpeg_processes
+'''
+
+
+def _port():
+    for i, arg in enumerate(sys.argv):
+        if arg == '--metrics' and i + 1 < len(sys.argv):
+            return int(sys.argv[i + 1])
+        if arg.startswith('--metrics='):
+            return int(arg.split('=', 1)[1])
+    port = os.environ.get('MOTHBOT_METRICS')
+    return int(port) if port else None
+
+
+port = _port()
+enabled = port is not None
+
+# Histogram bucket bounds, seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Histogram:
+    __slots__ = ('counts', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+
+# (name, sorted label items) -> value
+counters = {}
+histograms = {}
+# name -> function returning (metric name, labels dict, value) triples, run on every scrape.
+collectors = {}
+
+
+def _key(name: str, labels: dict):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name: str, seconds: float, **labels):
+    if not enabled:
+        return
+    key = _key(name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+        histogram = histograms[key] = Histogram()
+    histogram.observe(seconds)
+
+
+# Registers fn as the collector called name, replacing the one a reloaded extension left behind.
+def collector(name: str, fn):
+    collectors[name] = fn
+
+
+class timer:
+    __slots__ = ('name', 'labels', 'started')
+
+    def __init__(self, name: str, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe(self.name, time.perf_counter() - self.started, **self.labels)
+
+
+def _labels(items):
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                          for k, v in items) + '}'
+
+
+def render():
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+
+    for (name, labels), histogram in sorted(histograms.items()):
+        total = 0
+        for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+            total += count
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels + (('le', bound),)), total))
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), histogram.sum))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), total))
+
+    for fn in list(collectors.values()):
+        for name, labels, value in fn():
+            lines.append('{}{} {}'.format(name, _labels(sorted(labels.items())), value))
+
+    return '\n'.join(lines) + '\n'
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Drain the headers, nothing in them matters here.
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+
+        parts = request.split()
+        if len(parts) > 1 and parts[1] == b'/metrics':
+            status, body = '200 OK', render().encode()
+        else:
+            status, body = '404 Not Found', b'Metrics are at /metrics\n'
+
+        writer.write('HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, len(body)).encode() + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(listen_port: int, host: str = '127.0.0.1'):
+    return await asyncio.start_server(_handle, host, listen_port)
+
+
+# Counts the 429s discord.py handles (and retries) on its own, off the warning it logs for each.
+class RateLimitHandler(logging.Handler):
+    def emit(self, record: logging.LogRecord):
+        if 'rate limit' not in str(record.msg):
+            return
+        if record.args and len(record.args) > 1:
+            # The bucket is "channel id:guild id:route".
+            route = str(record.args[1]).split(':', 2)[-1]
+        else:
+            route = 'global'
+        inc('mothbot_rest_rate_limited_total', route=route)
+
+
+# Hooks the bot-wide measurements (commands and REST calls) into bot and starts serving /metrics.
+def install(bot, listen_port: int = None):
+    if not enabled:
+        return
+
+    async def on_command(ctx):
+        ctx.metrics_started = time.perf_counter()
+
+    def finished(ctx, outcome: str):
+        started = getattr(ctx, 'metrics_started', None)
+        if started is not None and ctx.command is not None:
+            observe('mothbot_command_seconds', time.perf_counter() - started,
+                    command=ctx.command.qualified_name, outcome=outcome)
+
+    async def on_command_completion(ctx):
+        finished(ctx, 'ok')
+
+    async def on_command_error(ctx, error):
+        finished(ctx, type(error).__name__)
+
+    bot.add_listener(on_command)
+    bot.add_listener(on_command_completion)
+    bot.add_listener(on_command_error)
+
+    request = bot.http.request
+
+    async def timed_request(route, **kwargs):
+        started = time.perf_counter()
+        status = '2xx'
+        try:
+            return await request(route, **kwargs)
+        except Exception as e:
+            status = str(getattr(e, 'status', type(e).__name__))
+            raise
+        finally:
+            path = '{} {}'.format(route.method, route.path)
+            observe('mothbot_rest_seconds', time.perf_counter() - started, route=path)
+            inc('mothbot_rest_requests_total', route=path, status=status)
+
+    bot.http.request = timed_request
+    logging.getLogger('discord.http').addHandler(RateLimitHandler(logging.WARNING))
+
+    bot.loop.create_task(serve(listen_port or port))
@@ -1,14 +1,25 @@
-import youtube_dl
 import asyncio
-import random
+import logging
+import time
+import threading
 
-import functools
-import itertools
+import audioop
+from collections import deque
 from async_timeout import timeout
 
 import discord
 from discord.ext import commands
 
+import AudioCache
+import AudioWorkers
+import BlockList
+import Cache
+import Extraction
+import Outbound
+import Scheduler
+import Shards
+from Extraction import YTDLError
+
 '''
     This file takes great care to separate all of the classes regarding the actual music 
     and to place them here instead of polluting the main MothBot file.
@@ -16,20 +27,19 @@ from discord.ext import commands
     Note: This will be commented for my own sake as well as whomever may read this 
 '''
 
-# Silence useless bug reports messages
-youtube_dl.utils.bug_reports_message = lambda: ''
+log = logging.getLogger(__name__)
 
+# Most entries queued from a single playlist.
+MAX_PLAYLIST = 1000
 
-class VoiceError(Exception):
-    pass
 
-
-class YTDLError(Exception):
+class VoiceError(Exception):
     pass
 
 
-# Encapsulation for a YouTube source. Parsed as a Discord PCM Volume Transformer.
-class YTDLSource(discord.PCMVolumeTransformer):
+# Everything both source types share: youtube_dl config, the track's info and ffmpeg handling.
+# Subclasses only decide how ffmpeg gets opened (_open) and how frames come out of it (read).
+class YTDLInfo:
     YTDL_OPTIONS = {
         'format': 'bestaudio/best',
         'extractaudio': True,
@@ -51,75 +61,179 @@ class YTDLSource(discord.PCMVolumeTransformer):
         'options': '-vn',
     }
 
-    ytdl = youtube_dl.YoutubeDL(YTDL_OPTIONS)
+    # Extraction workers. Set EXTRACT_PROCESSES to parse in worker processes instead of threads.
+    EXTRACT_WORKERS = 4
+    EXTRACT_PROCESSES = False
+    EXTRACT_TIMEOUT = 30
 
-    # Initializes the basic information for the source
-    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio, *, data: dict, volume: float = 0.5):
-        super().__init__(source, volume)
+    # Audio worker processes. Set above 0 to run ffmpeg and read frames off it in those instead of
+    # in the bot process (see AudioWorkers).
+    AUDIO_WORKERS = 0
+
+    # Set up by start() when the music cog is, importing this module opens nothing.
+    cache = None
+    scheduler = None
+    extractor = None
+    audio_cache = None
+    audio_workers = None
+
+    # Once per process, m!reload setting the cog up again keeps the ones already running.
+    @classmethod
+    def start(cls):
+        if cls.extractor is not None:
+            return
+        cls.cache = Cache.ExtractionCache('cache.db')
+        cls.scheduler = Scheduler.ExtractionScheduler(cls.EXTRACT_WORKERS, processes=cls.EXTRACT_PROCESSES,
+                                                      timeout=cls.EXTRACT_TIMEOUT)
+        cls.extractor = Extraction.Extractor(cls.cache, cls.scheduler, cls.YTDL_OPTIONS)
+        cls.audio_cache = AudioCache.AudioCache(Shards.local_path('audio_cache'))
+        # Worker processes are only started once the first song plays.
+        cls.audio_workers = AudioWorkers.AudioWorkerPool(cls.AUDIO_WORKERS)
+
+    # Writes out what the caches still have queued.
+    @classmethod
+    def close(cls):
+        if cls.extractor is not None:
+            cls.cache.close()
+            cls.audio_cache.close()
 
+    # Initializes the basic information for the source
+    def _load(self, ctx: commands.Context, data: dict):
         self.requester = ctx.author
         self.channel = ctx.channel
         self.data = data
+        # First frames read ahead of time by prime(), handed out before reading from ffmpeg.
+        self._buffer = deque()
+        # Frames handed to the voice client since ffmpeg was opened at `offset` seconds in.
+        self._lock = threading.Lock()
+        self.frames = 0
+        self.offset = 0.0
 
         self.uploader = data.get('uploader')
         self.uploader_url = data.get('uploader_url')
         date = data.get('upload_date')
-        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4]
+        self.upload_date = date[6:8] + '.' + date[4:6] + '.' + date[0:4] if date else None
         self.title = data.get('title')
         self.thumbnail = data.get('thumbnail')
         self.description = data.get('description')
-        self.duration = self.parse_duration(int(data.get('duration')))
+        # Livestreams (and anything else youtube_dl couldn't tell the length of) have none, 0 is unknown.
+        self.length = int(data.get('duration') or 0)
+        self.duration = self.parse_duration(self.length) if self.length else 'Unknown'
         self.tags = data.get('tags')
         self.url = data.get('webpage_url')
         self.views = data.get('view_count')
         self.likes = data.get('like_count')
         self.dislikes = data.get('dislike_count')
         self.stream_url = data.get('url')
+        self.expires = Cache.stream_expiry(self.stream_url)
+        self.acodec = data.get('acodec')
+        self.key = AudioCache.cache_key(data)
+        # Whether ffmpeg was last opened on the audio cache's file rather than the stream.
+        self.cached = False
 
     def __str__(self):
         return '**{0.title}** by **{0.uploader}**'.format(self)
 
-    # Honestly, the main function at work for fetching data.
-    @classmethod
-    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+    # How far into the track playback is, in seconds.
+    @property
+    def position(self):
+        return self.offset + self.frames * 0.02
+
+    # What ffmpeg should read (the cached file if there is one, the stream otherwise) and its options,
+    # seeking to `start` seconds in if needed. Seeking before -i is done on the input, so ffmpeg
+    # doesn't have to decode its way there.
+    def _ffmpeg_input(self, start: float = 0.0, options: str = ''):
+        path = self.audio_cache.lookup(self.key)
+        self.cached = path is not None
+
+        before_options = '' if self.cached else self.FFMPEG_OPTIONS['before_options']
+        if start:
+            before_options += ' -ss {:.2f}'.format(start)
+        return path or self.stream_url, {'before_options': before_options.strip(),
+                                         'options': (self.FFMPEG_OPTIONS['options'] + ' ' + options).strip()}
+
+    def _next_frame(self):
+        with self._lock:
+            data = self._buffer.popleft() if self._buffer else self.original.read()
+            if data:
+                self.frames += 1
+            return data
+
+    # Whether the stream url will still be good `margin` seconds from now. A track in the audio
+    # cache doesn't need it at all.
+    def is_fresh(self, margin: float = 0):
+        return self.audio_cache.contains(self.key) or self.expires - margin > time.time()
+
+    # Counts a play for the audio cache, which starts filling in the background once the track has
+    # been played often enough.
+    def record_play(self, loop: asyncio.BaseEventLoop):
+        if self.audio_cache.record_play(self.key, self.length) and self.expires - self.length > time.time():
+            loop.create_task(self.audio_cache.fill(self.key, self.stream_url, acodec=self.acodec,
+                                                   before_options=self.FFMPEG_OPTIONS['before_options']))
+
+    # Reads the first few frames off ffmpeg so that startup, the TLS connection and the initial
+    # buffering are already done by the time this gets played. Blocks, so run it in an executor.
+    def prime(self, frames: int):
+        while len(self._buffer) < frames:
+            data = self.original.read()
+            if not data:
+                break
+            self._buffer.append(data)
+
+    # Puts a new ffmpeg process (opened at `start` seconds) in place of the current one. Anything it
+    # already read goes in `buffer`; frames that were played in the meantime get dropped from it so
+    # playback carries on from where it is now rather than where it was when `start` was taken.
+    def _swap(self, original, start: float, buffer: deque = None):
+        buffer = buffer if buffer is not None else deque()
+        with self._lock:
+            played = int(round((self.position - start) / 0.02)) if start else 0
+            dropped = min(max(played, 0), len(buffer))
+            for _ in range(dropped):
+                buffer.popleft()
+
+            old = self.original
+            self.original = original
+            self._buffer = buffer
+            self.offset = start + 0.02 * dropped
+            self.frames = 0
+
+        old.cleanup()
+
+    # Swaps in a new ffmpeg process for this track, starting from the top. The stream url is only
+    # resolved again when it would expire within `margin` seconds.
+    async def reopen(self, *, margin: float = 0, loop: asyncio.BaseEventLoop = None):
+        if not self.is_fresh(margin):
+            info = await self.extractor.resolve_url(self.url, margin=margin, guild_id=self.channel.guild.id,
+                                                    loop=loop)
+            self.stream_url = info['url']
+            self.expires = Cache.stream_expiry(self.stream_url)
+
+        self._swap(self._open(), 0.0)
+
+    # Reopens ffmpeg at the current position while the track keeps playing, for changes that have to
+    # be made inside ffmpeg. The new process is started and buffered off the loop before the swap.
+    async def restart(self, *, loop: asyncio.BaseEventLoop = None):
         loop = loop or asyncio.get_event_loop()
-
-        partial = functools.partial(cls.ytdl.extract_info, search, download=False, process=False)
-        data = await loop.run_in_executor(None, partial)
-
-        if data is None:
-            raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
-
-        if 'entries' not in data:
-            process_info = data
-        else:
-            process_info = None
-            for entry in data['entries']:
-                if entry:
-                    process_info = entry
+        start = self.position
+
+        def open_buffered():
+            original = self._open(start)
+            buffer = deque()
+            while len(buffer) < 50:
+                data = original.read()
+                if not data:
                     break
+                buffer.append(data)
+            return original, buffer
 
-            if process_info is None:
-                raise YTDLError('Couldn\'t find anything that matches `{}`'.format(search))
-
-        webpage_url = process_info['webpage_url']
-        partial = functools.partial(cls.ytdl.extract_info, webpage_url, download=False)
-        processed_info = await loop.run_in_executor(None, partial)
+        original, buffer = await loop.run_in_executor(None, open_buffered)
+        self._swap(original, start, buffer)
 
-        if processed_info is None:
-            raise YTDLError('Couldn\'t fetch `{}`'.format(webpage_url))
-
-        if 'entries' not in processed_info:
-            info = processed_info
-        else:
-            info = None
-            while info is None:
-                try:
-                    info = processed_info['entries'].pop(0)
-                except IndexError:
-                    raise YTDLError('Couldn\'t retrieve any matches for `{}`'.format(webpage_url))
-
-        return cls(ctx, discord.FFmpegPCMAudio(info['url'], **cls.FFMPEG_OPTIONS), data=info)
+    # Honestly, the main function at work for fetching data.
+    @classmethod
+    async def create_source(cls, ctx: commands.Context, search: str, *, loop: asyncio.BaseEventLoop = None):
+        info = await cls.extractor.resolve(search, guild_id=ctx.guild.id, loop=loop)
+        return cls(ctx, data=info)
 
     @staticmethod
     def parse_duration(duration: int):
@@ -140,19 +254,154 @@ class YTDLSource(discord.PCMVolumeTransformer):
         return ', '.join(duration)
 
 
+# Encapsulation for a YouTube source. Parsed as a Discord PCM Volume Transformer.
+class YTDLSource(YTDLInfo, discord.PCMVolumeTransformer):
+    def __init__(self, ctx: commands.Context, source: discord.FFmpegPCMAudio = None, *, data: dict,
+                 volume: float = 0.5, start: float = 0.0):
+        self._load(ctx, data)
+        self.offset = start
+        discord.PCMVolumeTransformer.__init__(self, source or self._open(start), volume)
+
+    def _open(self, start: float = 0.0):
+        source, options = self._ffmpeg_input(start)
+        return discord.FFmpegPCMAudio(source, **options)
+
+    def read(self):
+        data = self._next_frame()
+        return audioop.mul(data, 2, min(self.volume, 2.0)) if data else data
+
+    async def set_volume(self, volume: float, *, loop: asyncio.BaseEventLoop = None):
+        self.volume = volume
+
+
+# Same track, but Opus comes straight out of ffmpeg so nothing gets decoded, scaled or encoded in
+# this process. Volume is an ffmpeg filter, so changing it means restarting ffmpeg where playback is.
+# At exactly 100% volume an upstream stream that's already Opus is passed through without encoding.
+class YTDLOpusSource(YTDLInfo, discord.AudioSource):
+    def __init__(self, ctx: commands.Context, *, data: dict, volume: float = 0.5, start: float = 0.0):
+        self._load(ctx, data)
+        self.volume = volume
+        self.offset = start
+        self.original = self._open(start)
+
+    # ffmpeg input, codec and options for Opus output at `start` seconds in.
+    def _opus_input(self, start: float = 0.0):
+        if self.volume != 1.0:
+            source, options = self._ffmpeg_input(start, '-filter:a volume={:.2f}'.format(self.volume))
+            return source, None, options
+
+        # Files in the audio cache are always Opus.
+        source, options = self._ffmpeg_input(start)
+        codec = 'opus' if self.cached or self.acodec == 'opus' else None
+        return source, codec, options
+
+    def _open(self, start: float = 0.0):
+        source, codec, options = self._opus_input(start)
+        return discord.FFmpegOpusAudio(source, codec=codec, **options)
+
+    def is_opus(self):
+        return True
+
+    def read(self):
+        return self._next_frame()
+
+    def cleanup(self):
+        self.original.cleanup()
+
+    async def set_volume(self, volume: float, *, loop: asyncio.BaseEventLoop = None):
+        if volume != self.volume:
+            self.volume = volume
+            await self.restart(loop=loop)
+
+
+# Same as YTDLOpusSource, but ffmpeg runs in one of the audio worker processes and the frames come
+# over a pipe. The voice connection stays here, only producing the frames moves out.
+class YTDLWorkerSource(YTDLOpusSource):
+    def _worker_args(self, start: float):
+        source, codec, options = self._opus_input(start)
+        return AudioWorkers.ffmpeg_args(source, codec=codec, **options)
+
+    # If the worker dies, the pool calls _worker_args again with where playback got to.
+    def _open(self, start: float = 0.0):
+        return self.audio_workers.open(self._worker_args, start)
+
+
+# Source type new songs are played with. YTDLSource is the old PCM path, kept for comparison.
+Source = YTDLWorkerSource if YTDLInfo.AUDIO_WORKERS else YTDLOpusSource
+
+
+# Stands in for the commands.Context of the songs restored from a snapshot, the bits of one they use.
+class SnapshotContext:
+    __slots__ = ('guild', 'channel', 'author')
+
+    def __init__(self, guild: discord.Guild, channel: discord.TextChannel, author):
+        self.guild = guild
+        self.channel = channel
+        self.author = author
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+
+# A queued song is only this record. The source, and with it the ffmpeg process, is created once the
+# song gets near the front of the queue (VoiceState.prefetch) and dropped again by release().
 class Song:
-    __slots__ = ('source', 'requester')
+    __slots__ = ('ctx', 'source', 'requester', 'title', 'uploader', 'url', 'length', 'start', 'prepared', 'trace')
+
+    # start is where playback begins, in seconds. Only a song restored from a snapshot doesn't start
+    # at the top.
+    def __init__(self, ctx: commands.Context, *, title: str, url: str, length: int = 0, uploader: str = None,
+                 requester=None, start: float = 0.0):
+        self.ctx = ctx
+        self.source = None
+        self.requester = requester or ctx.author
+        self.title = title
+        self.uploader = uploader
+        self.url = url
+        self.length = length or 0
+        self.start = start
+
+        # Task from VoiceState.prefetch, once it has been started.
+        self.prepared = None
+        # Tracing.Trace of the m!play that queued it, until the song has started.
+        self.trace = None
 
-    def __init__(self, source: YTDLSource):
-        self.source = source
-        self.requester = source.requester
+    def __str__(self):
+        if self.uploader:
+            return '**{0.title}** by **{0.uploader}**'.format(self)
+        return '**{0.title}**'.format(self)
+
+    # From a resolved info dict or a playlist listing entry.
+    @classmethod
+    def from_info(cls, ctx: commands.Context, info: dict):
+        return cls(ctx, title=info['title'], url=info['webpage_url'], length=info.get('duration'),
+                   uploader=info.get('uploader'))
+
+    # The info is normally still in the extraction cache from when the song was queued, so this only
+    # starts ffmpeg.
+    async def resolve(self, *, loop: asyncio.BaseEventLoop = None, volume: float = 0.5):
+        if self.source is None:
+            info = await YTDLInfo.extractor.resolve_url(self.url, guild_id=self.ctx.guild.id, loop=loop,
+                                                        trace=self.trace)
+            self.source = Source(self.ctx, data=info, volume=volume, start=self.start)
+            self.title, self.uploader, self.length = self.source.title, self.source.uploader, self.source.length
+
+    # Gives back the ffmpeg process of a song that isn't going to be played soon after all.
+    def release(self):
+        if self.prepared is not None:
+            self.prepared.cancel()
+            self.prepared = None
+
+        if self.source is not None:
+            self.source.cleanup()
+            self.source = None
 
     def create_embed(self):
         embed = (discord.Embed(title="Now Playing",
                                description='```css\n{0.source.title}\n```'.format(self),
                                colour=discord.Colour.dark_blue())
                  .add_field(name="Duration", value=self.source.duration)
-                 .add_field(name="Requested by", value=self.requester.mention)
+                 .add_field(name="Requested by", value='<@{}>'.format(self.requester.id))
                  .add_field(name="Uploader", value="[{0.source.uploader}]({0.source.uploader_url})".format(self))
                  .add_field(name="URL", value='[Click]({0.source.url})'.format(self))
                  .set_thumbnail(url=self.source.thumbnail))
@@ -160,12 +409,20 @@ class Song:
         return embed
 
 
+# asyncio.Queue over a BlockList instead of a deque, so get() still waits for the next song while
+# everything the queue commands do by index stays O(log n) on long queues.
 class SongQueue(asyncio.Queue):
+    def _init(self, maxsize):
+        self._queue = BlockList.BlockList()
+
+    def _put(self, item):
+        self._queue.append(item)
+
+    def _get(self):
+        return self._queue.popleft()
+
     def __getitem__(self, item):
-        if isinstance(item, slice):
-            return list(itertools.islice(self._queue, item.start, item.stop, item.step))
-        else:
-            return self._queue[item]
+        return self._queue[item]
 
     def __iter__(self):
         return self._queue.__iter__()
@@ -173,18 +430,137 @@ class SongQueue(asyncio.Queue):
     def __len__(self):
         return self.qsize()
 
+    # Like put_nowait, but at a position in the queue rather than the end.
+    def insert(self, index: int, song: Song):
+        self._queue.insert(index, song)
+        self._unfinished_tasks += 1
+        self._finished.clear()
+        self._wakeup_next(self._getters)
+
     def clear(self):
+        for song in self._queue:
+            song.release()
         self._queue.clear()
 
     def shuffle(self):
-        random.shuffle(self._queue)
+        self._queue.shuffle()
+
+    def move(self, src: int, dst: int):
+        self._queue.move(src, dst)
 
     def remove(self, index: int):
-        del self._queue[index]
+        self._queue.pop(index).release()
+
+    # Removes songs start to stop (exclusive). Returns how many were removed.
+    def remove_range(self, start: int, stop: int):
+        removed = self._queue[start:stop]
+        for song in removed:
+            song.release()
+        del self._queue[start:stop]
+        return len(removed)
+
+    # Drops every song whose url is already queued further up. Returns how many were dropped.
+    def dedupe(self):
+        seen = set()
+        kept = []
+        for song in self._queue:
+            if song.url in seen:
+                song.release()
+            else:
+                seen.add(song.url)
+                kept.append(song)
+
+        removed = len(self._queue) - len(kept)
+        if removed:
+            self._queue = BlockList.BlockList(kept)
+        return removed
+
+
+# The now playing message of a guild. It's sent once with its control reactions and then edited in
+# place for every new song. Updates are coalesced: while one edit is in flight, newer songs only
+# replace what the next edit shows, so a burst of skips costs one or two edits rather than one each.
+class PlayerPanel:
+    REACTIONS = ('\U000023EF',  # Play/Pause
+                 '\U000023F9',  # Stop
+                 '\U000023ED',  # Next
+                 '\U0001F500',  # Shuffle
+                 '\U0001F502')  # Repeat Single
+
+    # players maps the id of every live panel message to the VoiceState it controls (owner), so the
+    # reaction listeners find their player with a dict lookup.
+    def __init__(self, loop: asyncio.BaseEventLoop, outbound: Outbound.Dispatcher, players: dict, owner):
+        self.loop = loop
+        self.outbound = outbound
+        self.players = players
+        self.owner = owner
+        self.message = None
+        self._song = None
+        self._task = None
+
+    def _set_message(self, message):
+        if self.message is not None:
+            self.players.pop(self.message.id, None)
+        self.message = message
+        if message is not None:
+            self.players[message.id] = self.owner
+
+    def show(self, song: Song):
+        self._song = song
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._flush())
+
+    async def _flush(self):
+        while True:
+            song = self._song
+            channel = song.source.channel
+            started = time.perf_counter()
+
+            if self.message is not None and self.message.channel != channel:
+                await self._delete()
+
+            if self.message is not None:
+                try:
+                    await self.outbound.edit(self.message, key=('panel', self.message.id), embed=song.create_embed())
+                except discord.NotFound:
+                    self._set_message(None)
+
+            if self.message is None:
+                self._set_message(await self.outbound.send(channel, embed=song.create_embed()))
+                self.outbound.react(self.message, *self.REACTIONS)
+
+            if song.trace is not None:
+                song.trace.add('panel', time.perf_counter() - started, started)
+                song.trace.finish()
+
+            if self._song is song:
+                return
+
+    async def _delete(self):
+        message = self.message
+        self._set_message(None)
+        try:
+            await self.outbound.delete(message)
+        except discord.NotFound:
+            pass
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+        if self.message is not None:
+            await self._delete()
 
 
 class VoiceState:
-    def __init__(self, bot: commands.Bot, ctx: commands.Context):
+    # How many queued songs get prepared ahead of time, how many seconds before the current song
+    # ends that starts, and how much audio (in 20ms frames) gets buffered for each of them. A guild
+    # never has more than 1 + PREFETCH_DEPTH ffmpeg processes, however long its queue is.
+    PREFETCH_DEPTH = 2
+    PREFETCH_LEAD = 20
+    PREFETCH_FRAMES = 50
+
+    def __init__(self, bot: commands.Bot, ctx: commands.Context, players: dict = None):
         self.bot = bot
         self._ctx = ctx
 
@@ -198,12 +574,16 @@ class VoiceState:
         self.skip_votes = set()
 
         self.exists = True
-        self.player_message = None
+        self.panel = PlayerPanel(bot.loop, bot.outbound, players if players is not None else {}, self)
 
+        self.prefetcher = None
+        self._snapshot_handle = None
         self.audio_player = bot.loop.create_task(self.audio_player_task())
 
     def __del__(self):
         self.audio_player.cancel()
+        if self.prefetcher:
+            self.prefetcher.cancel()
 
     @property
     def loop(self):
@@ -225,6 +605,79 @@ class VoiceState:
     def is_playing(self):
         return self.current and self.voice
 
+    @property
+    def player_message(self):
+        return self.panel.message
+
+    # Gets a song ready to play: resolved, a live stream url and the first frames already buffered.
+    async def _prepare(self, song: Song, start_in: float):
+        started = time.perf_counter()
+        await song.resolve(loop=self.bot.loop, volume=self._volume)
+        if song.trace is not None:
+            song.trace.add('resolve', time.perf_counter() - started, started)
+
+        source = song.source
+        # The url has to outlive the whole song, ffmpeg reconnects to it when the connection drops.
+        margin = start_in + source.length
+        if not source.is_fresh(margin):
+            await source.reopen(margin=margin, loop=self.bot.loop)
+        await source.set_volume(self._volume, loop=self.bot.loop)
+
+        started = time.perf_counter()
+        await self.bot.loop.run_in_executor(None, source.prime, self.PREFETCH_FRAMES)
+        if song.trace is not None:
+            song.trace.add('ffmpeg', time.perf_counter() - started, started)
+
+    def prefetch(self, song: Song, start_in: float = 0):
+        if song.prepared is None:
+            song.prepared = self.bot.loop.create_task(self._prepare(song, start_in))
+        return song.prepared
+
+    # Sleeps until the current song is about to end, then prepares the next few in the queue.
+    async def prefetch_task(self, delay: float):
+        await asyncio.sleep(delay)
+
+        start_in = self.PREFETCH_LEAD
+        for song in self.songs[:self.PREFETCH_DEPTH]:
+            prepared = self.prefetch(song, start_in)
+            try:
+                # Shielded so a skip cancelling this task doesn't throw away a half done prepare.
+                await asyncio.shield(prepared)
+            except YTDLError:
+                pass
+            except asyncio.CancelledError:
+                # Only the prepare was cancelled, by release().
+                if not prepared.cancelled():
+                    raise
+            # Nothing after a song of unknown length can be timed, those wait for the player.
+            if not song.length:
+                break
+            start_in += song.length
+
+    # Releases the songs that were prepared but have been moved back in the queue, so reordering
+    # doesn't let the number of ffmpeg processes grow. Checks the whole queue unless told which
+    # positions songs could have been moved to.
+    def trim_prepared(self, *indexes: int):
+        songs = [self.songs[i] for i in indexes if self.PREFETCH_DEPTH <= i < len(self.songs)] if indexes \
+            else self.songs[self.PREFETCH_DEPTH:]
+        for song in songs:
+            if song.prepared is not None or song.source is not None:
+                song.release()
+
+    # Without a length there's no telling when the song ends, the next one is then prepared once the
+    # player gets to it.
+    def schedule_prefetch(self):
+        if self.prefetcher:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+        if not self.current.source.length:
+            return
+
+        # What's left of the song, which is less than its length when it was resumed from a snapshot.
+        source = self.current.source
+        delay = max(0, source.length - source.position - self.PREFETCH_LEAD)
+        self.prefetcher = self.bot.loop.create_task(self.prefetch_task(delay))
+
     async def audio_player_task(self):
         while True:
             self.next.clear()
@@ -239,43 +692,167 @@ class VoiceState:
                     self.exists = False
                     return
 
-            if self.player_message is not None:
-                await self.player_message.delete()
-                self.player_message = None
-
-            message = await self.current.source.channel.send(embed=self.current.create_embed())
-            self.player_message = message
-
-            await message.add_reaction('\U000023EF')  # Play/Pause
-            await message.add_reaction('\U000023F9')  # Stop
-            await message.add_reaction('\U000023ED')  # Next
-            await message.add_reaction('\U0001F500')  # Shuffle
-            await message.add_reaction('\U0001F502')  # Repeat Single
-
-            self.current.source.volume = self._volume
-            self.voice.play(self.current.source, after=self.play_next_song)
+            trace = self.current.trace
+            try:
+                await self.play_current(trace)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # A song that can't be played is that song's problem, the player goes on with the next.
+                # Once the audio is going though, it plays out whatever failed after that.
+                if self.voice is None or not (self.voice.is_playing() or self.voice.is_paused()):
+                    log.exception('Could not play %s', self.current.url)
+                    await self.skip_failed(e)
+                    continue
+                log.exception('Error after starting %s', self.current.url)
 
             await self.next.wait()
 
+            # Normally written once the panel is up, unless the song ended before that.
+            if trace is not None:
+                trace.finish()
+                self.current.trace = None
+
+    # Starts the current song: ffmpeg, the voice client and then the panel.
+    async def play_current(self, trace):
+        if self.loop:
+            # The last play used up the ffmpeg process, the repeat needs a new one.
+            await self.current.source.reopen(loop=self.bot.loop)
+            self.current.prepared = None
+
+        if trace is not None:
+            trace.mark_dequeued()
+
+        # Usually done already by the prefetch, otherwise this is where ffmpeg gets started.
+        try:
+            started = time.perf_counter()
+            await self.prefetch(self.current)
+            if trace is not None:
+                trace.add('prepare', time.perf_counter() - started, started)
+        except YTDLError:
+            # Only fatal when there's no source at all, a failed refresh can still play.
+            if self.current.source is None:
+                raise
+
+        # Audio first, the now playing message can take its time.
+        started = time.perf_counter()
+        await self.current.source.set_volume(self._volume, loop=self.bot.loop)
+        self.voice.play(self.current.source, after=self.play_next_song)
+        if trace is not None:
+            trace.add('play', time.perf_counter() - started, started)
+            trace.mark_audio()
+        self.current.source.record_play(self.bot.loop)
+        self.schedule_prefetch()
+
+        self.panel.show(self.current)
+        self.schedule_snapshot()
+
+    # Tells the channel why the current song is being skipped and lets go of it.
+    async def skip_failed(self, error: Exception):
+        song = self.current
+        self.loop = False
+        if song.trace is not None:
+            song.trace.finish('failed')
+            song.trace = None
+        song.release()
+
+        try:
+            await song.ctx.send('Skipping **{}**: {}'.format(song.title, str(error) or type(error).__name__))
+        except discord.HTTPException:
+            pass
+
+    # Called from the voice thread when a song ends, so the event has to be set on the bot's loop.
     def play_next_song(self, error=None):
+        self.bot.loop.call_soon_threadsafe(self.next.set)
+
         if error:
             raise VoiceError(str(error))
 
-        self.next.set()
-
     def skip(self):
         self.skip_votes.clear()
 
         if self.is_playing:
             self.voice.stop()
 
+    # Shuts the player down for good. The audio player task is cancelled here rather than left to
+    # idle out, so a state that was left doesn't linger (and later clear a new state's snapshot).
     async def stop(self):
+        self.exists = False
+        self.audio_player.cancel()
         self.songs.clear()
 
-        if self.player_message is not None:
-            await self.player_message.delete()
-            self.player_message = None
+        if self.prefetcher:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+
+        await self.panel.close()
+
+        if self._snapshot_handle:
+            self._snapshot_handle.cancel()
+            self._snapshot_handle = None
+        self.bot.store.snapshots.remove(self._ctx.guild.id)
 
         if self.voice:
             await self.voice.disconnect()
             self.voice = None
+
+        # Nothing is going to play it any more, its source and info dict can go now.
+        if self.current is not None:
+            self.current.release()
+            self.current = None
+
+    # What's needed to pick playback back up after a restart: the channels, the player settings and
+    # for every song (the current one first) its url, requester and what the queue shows, plus how
+    # far into the current song playback is. Nothing that would need the extractor to rebuild.
+    def snapshot(self):
+        songs = list(self.songs)
+        position = 0.0
+        if self.current is not None and self.voice is not None and (self.voice.is_playing() or
+                                                                     self.voice.is_paused()):
+            songs.insert(0, self.current)
+            source = self.current.source
+            position = round(source.position if source is not None else self.current.start, 1)
+
+        return {
+            'voice': self.voice.channel.id if self.voice else None,
+            'text': self._ctx.channel.id,
+            'volume': self._volume,
+            'loop': self._loop,
+            'position': position,
+            'songs': [[song.url, song.requester.id, song.title, song.length, song.uploader] for song in songs],
+        }
+
+    def save_snapshot(self):
+        self._snapshot_handle = None
+        if self.exists and self.voice is not None:
+            self.bot.store.snapshots.set(self._ctx.guild.id, self.snapshot())
+
+    # Snapshots after a change are delayed a little, so a burst of changes is saved once.
+    def schedule_snapshot(self, delay: float = 2.0):
+        if self._snapshot_handle is None:
+            self._snapshot_handle = self.bot.loop.call_later(delay, self.save_snapshot)
+
+    # Rebuilds a guild's player from its snapshot: rejoins the voice channel and queues everything
+    # again, but only as song records. The first song gets resolved (and seeks to where it was) when
+    # the player gets to it, the others as the prefetch reaches them.
+    @classmethod
+    async def restore(cls, bot: commands.Bot, guild: discord.Guild, data: dict, players: dict = None):
+        voice_channel = guild.get_channel(data['voice'] or 0)
+        text_channel = guild.get_channel(data['text'])
+        if voice_channel is None or text_channel is None or not data['songs']:
+            return None
+
+        voice = await voice_channel.connect()
+
+        ctx = SnapshotContext(guild, text_channel, guild.me)
+        state = cls(bot, ctx, players)
+        state.voice = voice
+        state._volume = data['volume']
+        state._loop = data['loop']
+
+        for index, (url, requester_id, title, length, uploader) in enumerate(data['songs']):
+            requester = guild.get_member(requester_id) or discord.Object(requester_id)
+            start = data['position'] if index == 0 else 0.0
+            state.songs.put_nowait(Song(ctx, title=title, url=url, length=length, uploader=uploader,
+                                        requester=requester, start=start))
+        return state
@@ -0,0 +1,454 @@
+import asyncio
+import copy
+import math
+import time
+
+import discord
+from discord.ext import commands, tasks
+
+import Metrics
+import Music
+import Shards
+import Tracing
+
+
+class MusicCog(commands.Cog):
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        # guild id -> VoiceState, and player message id -> VoiceState (kept up to date by each state's
+        # panel). Handed over from the previous instance when the extension is being reloaded.
+        self.voice_states, self.players = bot.music_handover or ({}, {})
+        bot.music_handover = None
+        self.save_snapshots.start()
+        Metrics.collector('music', self.collect_metrics)
+
+    # Only for the commands that actually want audio, everything else works off an existing state.
+    def get_voice_state(self, ctx: commands.Context):
+        state = self.voice_states.get(ctx.guild.id)
+
+        if not state or not state.exists:
+            state = Music.VoiceState(self.bot, ctx, self.players)
+            self.voice_states[ctx.guild.id] = state
+
+        return state
+
+    # On a reload the voice states are left running for the new instance to pick up, so playback
+    # doesn't notice. Otherwise everything is stopped.
+    def cog_unload(self):
+        self.save_snapshots.cancel()
+        if self.bot.reloading:
+            self.bot.music_handover = (self.voice_states, self.players)
+            return
+
+        for state in self.voice_states.values():
+            self.bot.loop.create_task(state.stop())
+
+    def cog_check(self, ctx: commands.Context):
+        if not ctx.guild:
+            raise commands.NoPrivateMessage('This command can\'t be used in DM channels.')
+
+        return True
+
+    # join, summon, play, playnext and playlist have created the state already in their own hooks, which run first.
+    async def cog_before_invoke(self, ctx: commands.Context):
+        state = self.voice_states.get(ctx.guild.id)
+        if not state or not state.exists:
+            raise commands.CommandError('Not connected to any voice channel.')
+
+        ctx.voice_state = state
+
+    async def cog_after_invoke(self, ctx: commands.Context):
+        state = getattr(ctx, 'voice_state', None)
+        if state is not None:
+            state.schedule_snapshot()
+
+    async def cog_command_error(self, ctx: commands.Context, error: commands.CommandError):
+        # A traced command that failed before its song got queued, nothing else is going to finish the trace.
+        trace = getattr(ctx, 'trace', None)
+        if trace is not None:
+            trace.finish('error')
+        await ctx.send('An error occurred: {}'.format(str(error)))
+
+    @commands.command(name="join", invoke_without_subcommand=True)
+    async def _join(self, ctx: commands.Context):
+        destination = ctx.author.voice.channel
+        if ctx.voice_state.voice:
+            await ctx.voice_client.move_to(destination)
+            return
+
+        trace = getattr(ctx, 'trace', None)
+        started = time.perf_counter()
+        ctx.voice_state.voice = await destination.connect()
+        if trace is not None:
+            trace.add('connect', time.perf_counter() - started, started)
+        await ctx.send("Connected to voice channel.")
+
+    @commands.command(name='summon')
+    # @commands.has_permissions(manage_guild=True)
+    async def _summon(self, ctx: commands.Context, *, channel: discord.VoiceChannel = None):
+        if not channel and not ctx.author.voice:
+            raise Music.VoiceError('You are neither connected to a voice channel nor specified a channel to join.')
+
+        destination = channel or ctx.author.voice.channel
+        if ctx.voice_state.voice:
+            await ctx.voice_state.voice.move_to(destination)
+            return
+
+        ctx.voice_state.voice = await destination.connect()
+
+    @commands.command(name='leave', aliases=['disconnect'])
+    # @commands.has_permissions(manage_guild=True)
+    async def _leave(self, ctx: commands.Context):
+        if not ctx.voice_state.voice:
+            return await ctx.send('Not connected to any voice channel.')
+
+        await ctx.send("Left the voice channel.")
+        await ctx.voice_state.stop()
+        del self.voice_states[ctx.guild.id]
+
+    @commands.command(name='volume')
+    async def _volume(self, ctx: commands.Context, *, volume: int):
+
+        if not ctx.voice_state.is_playing:
+            return await ctx.send('Nothing being played at the moment.')
+
+        if not 0 <= volume <= 100:
+            return await ctx.send('Volume must be between 0 and 100')
+
+        ctx.voice_state.volume = volume / 100
+        # A song that already finished keeps `current` set until the next one starts, restarting it would leave
+        # an ffmpeg behind that nothing reads; the next song picks the new volume up when it's prepared.
+        voice = ctx.voice_state.voice
+        if voice.is_playing() or voice.is_paused():
+            await ctx.voice_state.current.source.set_volume(volume / 100, loop=self.bot.loop)
+        await ctx.send('Volume of the player set to {}%'.format(volume))
+
+    @commands.command(name='now', aliases=['current', 'playing'])
+    async def _now(self, ctx: commands.Context):
+        await ctx.send(embed=ctx.voice_state.current.create_embed())
+
+    @commands.command(name='pause')
+    # @commands.has_permissions(manage_guild=True)
+    async def _pause(self, ctx: commands.Context):
+        if ctx.voice_state.is_playing and ctx.voice_state.voice.is_playing():
+            ctx.voice_state.voice.pause()
+            await ctx.send("Music paused.")
+
+    @commands.command(name='resume')
+    # @commands.has_permissions(manage_guild=True)
+    async def _resume(self, ctx: commands.Context):
+        if ctx.voice_state.is_playing and ctx.voice_state.voice.is_paused():
+            ctx.voice_state.voice.resume()
+            await ctx.send("Music resumed.")
+
+    @commands.command(name='stop')
+    # @commands.has_permissions(manage_guild=True)
+    async def _stop(self, ctx: commands.Context):
+        ctx.voice_state.songs.clear()
+
+        if ctx.voice_state.is_playing:
+            ctx.voice_state.voice.stop()
+
+            await ctx.voice_state.panel.close()
+
+            await ctx.send("Music stopped.")
+
+    @commands.command(name='skip')
+    async def _skip(self, ctx: commands.Context):
+        if not ctx.voice_state.is_playing:
+            return await ctx.send('Not playing any music right now...')
+
+        voter = ctx.message.author
+        if voter == ctx.voice_state.current.requester:
+            await ctx.send("Song skipped.")
+            ctx.voice_state.skip()
+
+        elif voter.id not in ctx.voice_state.skip_votes:
+            ctx.voice_state.skip_votes.add(voter.id)
+            total_votes = len(ctx.voice_state.skip_votes)
+
+            if total_votes >= 3:
+                await ctx.send("Song skipped.")
+                ctx.voice_state.skip()
+            else:
+                await ctx.send('Skip vote added, currently at **{}/3**'.format(total_votes))
+
+        else:
+            await ctx.send('You have already voted to skip this song.')
+
+    @commands.command(name='queue')
+    async def _queue(self, ctx: commands.Context, *, page: int = 1):
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        items_per_page = 10
+        pages = math.ceil(len(ctx.voice_state.songs) / items_per_page)
+
+        start = (page - 1) * items_per_page
+        end = start + items_per_page
+
+        queue = ''
+        for i, song in enumerate(ctx.voice_state.songs[start:end], start=start):
+            queue += '`{0}.` [**{1.title}**]({1.url})\n'.format(i + 1, song)
+
+        embed = (discord.Embed(description='**{} tracks:**\n\n{}'.format(len(ctx.voice_state.songs), queue))
+                 .set_footer(text='Viewing page {}/{}'.format(page, pages)))
+        await ctx.send(embed=embed)
+
+    @commands.command(name='shuffle')
+    async def _shuffle(self, ctx: commands.Context):
+        """Shuffles the queue."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        ctx.voice_state.songs.shuffle()
+        ctx.voice_state.trim_prepared()
+        await ctx.send("Shuffled the queue.")
+
+    @commands.command(name='remove')
+    async def _remove(self, ctx: commands.Context, index: str):
+        """Removes a song from the queue at a given index, or a range of them (3-10)."""
+
+        if len(ctx.voice_state.songs) == 0:
+            return await ctx.send('Empty queue.')
+
+        first, _, last = index.partition('-')
+        try:
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            return await ctx.send('Give a position or a range of them, like `3` or `3-10`.')
+
+        if not 1 <= first <= last <= len(ctx.voice_state.songs):
+            return await ctx.send('The queue only has {} songs.'.format(len(ctx.voice_state.songs)))
+
+        if first == last:
+            ctx.voice_state.songs.remove(first - 1)
+            await ctx.send("Song removed.")
+        else:
+            removed = ctx.voice_state.songs.remove_range(first - 1, last)
+            await ctx.send("Removed {} songs.".format(removed))
+
+    @commands.command(name='move')
+    async def _move(self, ctx: commands.Context, src: int, dst: int):
+        """Moves the song at one position of the queue to another."""
+
+        length = len(ctx.voice_state.songs)
+        if not 1 <= src <= length or not 1 <= dst <= length:
+            return await ctx.send('The queue only has {} songs.'.format(length))
+
+        ctx.voice_state.songs.move(src - 1, dst - 1)
+        ctx.voice_state.trim_prepared(dst - 1, Music.VoiceState.PREFETCH_DEPTH)
+        await ctx.send('Moved **{}** to position {}.'.format(ctx.voice_state.songs[dst - 1].title, dst))
+
+    @commands.command(name='dedupe')
+    async def _dedupe(self, ctx: commands.Context):
+        """Removes songs that are already in the queue further up."""
+
+        removed = ctx.voice_state.songs.dedupe()
+        await ctx.send("Removed {} duplicate songs.".format(removed))
+
+    @commands.command(name='loop')
+    async def _loop(self, ctx: commands.Context):
+        if not ctx.voice_state.is_playing:
+            return await ctx.send('Nothing being played at the moment.')
+
+        # Inverse boolean value to loop and unloop.
+        ctx.voice_state.loop = not ctx.voice_state.loop
+        if ctx.voice_state.loop:
+            await ctx.send("Current song will **now** be looped.")
+        else:
+            await ctx.send("Current song will **not** be looped.")
+
+    @commands.command(name='play', aliases=['p'])
+    async def _play(self, ctx: commands.Context, *, search: str):
+        if Music.Extraction.is_playlist_url(search):
+            # Playlists aren't traced, m!playlist has no single song to follow to its first audio.
+            ctx.trace.finish('playlist')
+            return await ctx.invoke(self._playlist, url=search)
+
+        await self.enqueue(ctx, search)
+
+    @commands.command(name='playnext')
+    async def _playnext(self, ctx: commands.Context, *, search: str):
+        """Queues a song at the front of the queue."""
+
+        if Music.Extraction.is_playlist_url(search):
+            ctx.trace.finish('rejected')
+            return await ctx.send('Only single songs can be played next.')
+
+        await self.enqueue(ctx, search, next_up=True)
+
+    async def enqueue(self, ctx: commands.Context, search: str, *, next_up: bool = False):
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+
+        trace = ctx.trace
+        async with ctx.typing():
+            try:
+                with trace.span('extract'):
+                    info = await Music.YTDLInfo.extractor.resolve(search, guild_id=ctx.guild.id, loop=self.bot.loop,
+                                                                  trace=trace)
+            except Music.YTDLError as e:
+                trace.finish('failed')
+                await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+            else:
+                song = Music.Song.from_info(ctx, info)
+                song.trace = trace
+
+                with trace.span('enqueue'):
+                    if next_up:
+                        ctx.voice_state.songs.insert(0, song)
+                        ctx.voice_state.trim_prepared(Music.VoiceState.PREFETCH_DEPTH)
+                    else:
+                        await ctx.voice_state.songs.put(song)
+                trace.mark_queued()
+                # The song owns the trace from here on, the player finishes it.
+                ctx.trace = None
+
+                if next_up:
+                    await ctx.send('Playing {} next'.format(str(song)))
+                else:
+                    await ctx.send('Enqueued {}'.format(str(song)))
+
+    @commands.command(name='playlist', aliases=['pl'])
+    async def _playlist(self, ctx: commands.Context, *, url: str):
+        """Queues a whole playlist, playback starts as soon as the first entry is listed."""
+
+        if not ctx.voice_state.voice:
+            await ctx.invoke(self._join)
+
+        count = 0
+        try:
+            entries = Music.YTDLInfo.extractor.iter_playlist(url, limit=Music.MAX_PLAYLIST, guild_id=ctx.guild.id,
+                                                             loop=self.bot.loop)
+            async for entry in entries:
+                await ctx.voice_state.songs.put(Music.Song.from_info(ctx, entry))
+                count += 1
+                if count == 1:
+                    await ctx.send('Enqueuing playlist, starting with **{}**...'.format(entry['title']))
+        except Music.YTDLError as e:
+            await ctx.send('An error occurred while processing this request: {}'.format(str(e)))
+
+        if count:
+            await ctx.send('Enqueued {} songs from the playlist.'.format(count))
+
+    @_join.before_invoke
+    @_play.before_invoke
+    @_playnext.before_invoke
+    @_playlist.before_invoke
+    async def ensure_voice_state(self, ctx: commands.Context):
+        # m!play and m!playnext get traced all the way to the first audio, see Tracing.
+        if ctx.command.name in ('play', 'playnext'):
+            ctx.trace = Tracing.Trace.from_context(ctx)
+            started = time.perf_counter()
+
+        if not ctx.author.voice or not ctx.author.voice.channel:
+            raise commands.CommandError('You are not connected to any voice channel.')
+
+        if ctx.voice_client:
+            if ctx.voice_client.channel != ctx.author.voice.channel:
+                raise commands.CommandError('Bot is already in a voice channel.')
+
+        ctx.voice_state = self.get_voice_state(ctx)
+        if hasattr(ctx, 'trace'):
+            ctx.trace.add('voice_state', time.perf_counter() - started, started)
+
+    @_summon.before_invoke
+    async def create_voice_state(self, ctx: commands.Context):
+        ctx.voice_state = self.get_voice_state(ctx)
+
+    # A context for running the player commands on behalf of whoever reacted to the panel, built
+    # directly instead of going through get_context's prefix parsing.
+    def panel_context(self, message: discord.Message, user, state: Music.VoiceState):
+        message = copy.copy(message)
+        message.author = user
+
+        ctx = commands.Context(message=message, bot=self.bot, prefix=None)
+        ctx.voice_state = state
+        return ctx
+
+    @commands.Cog.listener()
+    async def on_reaction_add(self, reaction: discord.Reaction, user):
+        state = self.players.get(reaction.message.id)
+        if state is None or user == self.bot.user:
+            return
+
+        ctx = self.panel_context(reaction.message, user, state)
+        if reaction.emoji == '\U000023EF':  # Play/Pause
+            await ctx.invoke(self._pause)
+        elif reaction.emoji == '\U000023F9':  # Stop
+            await ctx.invoke(self._stop)
+        elif reaction.emoji == '\U000023ED':  # Next
+            await ctx.invoke(self._skip)
+        elif reaction.emoji == '\U0001F500':  # Shuffle
+            await ctx.invoke(self._shuffle)
+        elif reaction.emoji == '\U0001F502':  # Repeat Single
+            await ctx.invoke(self._loop)
+        state.schedule_snapshot()
+
+        # await reaction.message.add_reaction(reaction.emoji)
+
+    @commands.Cog.listener()
+    async def on_reaction_remove(self, reaction: discord.reaction, user):
+        state = self.players.get(reaction.message.id)
+        if state is None or user == self.bot.user:
+            return
+
+        ctx = self.panel_context(reaction.message, user, state)
+        if reaction.emoji == '\U000023EF':  # Play/Pause
+            await ctx.invoke(self._resume)
+        elif reaction.emoji == '\U0001F502':  # Repeat Single
+            await ctx.invoke(self._loop)
+        state.schedule_snapshot()
+
+    # Positions move on by themselves, so on top of the snapshots taken after every change, every
+    # player gets one periodically. Players that idled out are forgotten here too, rather than kept
+    # until the guild's next command replaces them.
+    @tasks.loop(seconds=30)
+    async def save_snapshots(self):
+        for guild_id, state in list(self.voice_states.items()):
+            if not state.exists:
+                del self.voice_states[guild_id]
+            elif state.is_playing:
+                state.save_snapshot()
+
+    # Current values for /metrics, only worked out when it's scraped. Only the current song and the
+    # prefetched ones can have an ffmpeg process, plus whatever the audio cache is filling.
+    def collect_metrics(self):
+        states = [(guild_id, state) for guild_id, state in self.voice_states.items() if state.exists]
+        processes = Music.YTDLInfo.audio_cache.stats()['filling']
+        for guild_id, state in states:
+            yield 'mothbot_queue_depth', {'guild': guild_id}, len(state.songs)
+            songs = [state.current] + state.songs[:Music.VoiceState.PREFETCH_DEPTH]
+            processes += sum(1 for song in songs if song is not None and song.source is not None)
+
+        yield 'mothbot_voice_states', {}, len(states)
+        yield 'mothbot_ffmpeg_processes', {}, processes
+
+    # Picks the players that were running before a restart back up, see VoiceState.restore. Each
+    # guild costs one voice connection now and a single extraction once its first song starts.
+    @commands.Cog.listener()
+    async def on_ready(self):
+        for guild_id, data in self.bot.store.snapshots.items():
+            # With shards, the other guilds' snapshots are for the other shards to restore.
+            if guild_id not in self.voice_states and Shards.owns(self.bot, guild_id):
+                self.bot.loop.create_task(self.restore(guild_id, data))
+
+    async def restore(self, guild_id: int, data: dict):
+        guild = self.bot.get_guild(guild_id)
+        try:
+            state = await Music.VoiceState.restore(self.bot, guild, data, self.players) if guild else None
+        except (discord.DiscordException, asyncio.TimeoutError, OSError):
+            state = None
+
+        if state is None:
+            self.bot.store.snapshots.remove(guild_id)
+        else:
+            self.voice_states[guild_id] = state
+
+
+def setup(bot: commands.Bot):
+    Music.YTDLInfo.start()
+    bot.add_cog(MusicCog(bot))
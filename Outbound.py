@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import time
+from collections import deque
+
+'''
+    Central dispatcher for the REST calls the bot makes on its own (replies from listeners,
+    reactions, the player panel).
+
+    Handlers enqueue and move on. Every channel gets its own queue and worker, so channels go out
+    concurrently while calls within a channel keep their order. Before each call the worker waits
+    on a token bucket that mirrors Discord's rate limits for that route, so we slow down ahead of
+    time instead of running into 429s. Calls enqueued with a key replace a pending call with the
+    same key, which is how outdated UI updates (a superseded embed) get dropped without being sent.
+'''
+
+log = logging.getLogger(__name__)
+
+
+class Bucket:
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+
+    # Takes a token and returns how long to wait before using it.
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.per)
+        self.updated = now
+
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens * self.per / self.limit
+
+
+class Call:
+    __slots__ = ('route', 'factory', 'key', 'future')
+
+    def __init__(self, route: str, factory, key, future: asyncio.Future):
+        self.route = route
+        self.factory = factory
+        self.key = key
+        self.future = future
+
+
+class Channel:
+    __slots__ = ('calls', 'buckets', 'worker', 'last_used')
+
+    def __init__(self):
+        self.calls = deque()
+        self.buckets = {}
+        self.worker = None
+        self.last_used = time.monotonic()
+
+
+class Dispatcher:
+    # Discord's per channel limits, route -> (requests, per seconds).
+    LIMITS = {
+        'send': (5, 5.0),
+        'edit': (5, 5.0),
+        'delete': (5, 1.0),
+        'reaction': (1, 0.25),
+    }
+    GLOBAL_LIMIT = (50, 1.0)
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._channels = {}
+        self._global = Bucket(*self.GLOBAL_LIMIT)
+
+        self.calls = {}
+        self.superseded = 0
+        self.failed = 0
+        self.waited = 0.0
+
+    # Queues factory() (a coroutine function making the REST call) on channel_id. Returns a future for
+    # its result, which nobody has to await. Cancelling the future before the call goes out drops it.
+    def enqueue(self, channel_id: int, route: str, factory, *, key=None):
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            channel = self._channels[channel_id] = Channel()
+            self._prune()
+        channel.last_used = time.monotonic()
+
+        if key is not None:
+            for call in channel.calls:
+                if call.key == key:
+                    call.factory = factory
+                    self.superseded += 1
+                    return call.future
+
+        future = self.loop.create_future()
+        # Failures get logged by the worker, this keeps asyncio from complaining about unawaited ones.
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        channel.calls.append(Call(route, factory, key, future))
+
+        if channel.worker is None or channel.worker.done():
+            channel.worker = self.loop.create_task(self._work(channel))
+        return future
+
+    async def _work(self, channel: Channel):
+        while channel.calls:
+            call = channel.calls[0]
+
+            bucket = channel.buckets.get(call.route)
+            if bucket is None:
+                bucket = channel.buckets[call.route] = Bucket(*self.LIMITS.get(call.route, (5, 5.0)))
+            delay = max(bucket.take(), self._global.take())
+            if delay:
+                self.waited += delay
+                await asyncio.sleep(delay)
+
+            # Popped only now, so a newer call with the same key could still replace it while waiting.
+            channel.calls.popleft()
+            if call.future.cancelled():
+                continue
+
+            self.calls[call.route] = self.calls.get(call.route, 0) + 1
+            try:
+                result = await call.factory()
+            except Exception as e:
+                self.failed += 1
+                log.warning('%s call failed: %s', call.route, e)
+                if not call.future.done():
+                    call.future.set_exception(e)
+            else:
+                if not call.future.done():
+                    call.future.set_result(result)
+
+    # Forgets channels that have been idle long enough for their buckets to be full again.
+    def _prune(self):
+        now = time.monotonic()
+        for channel_id, channel in list(self._channels.items()):
+            if not channel.calls and now - channel.last_used > 60:
+                del self._channels[channel_id]
+
+    def send(self, channel, *args, key=None, **kwargs):
+        return self.enqueue(channel.id, 'send', lambda: channel.send(*args, **kwargs), key=key)
+
+    def edit(self, message, *, key=None, **kwargs):
+        return self.enqueue(message.channel.id, 'edit', lambda: message.edit(**kwargs), key=key)
+
+    def delete(self, message):
+        return self.enqueue(message.channel.id, 'delete', message.delete)
+
+    # One call per emoji, they go out in the order given.
+    def react(self, message, *emojis):
+        futures = [self.enqueue(message.channel.id, 'reaction', lambda emoji=emoji: message.add_reaction(emoji))
+                   for emoji in emojis]
+        return futures[-1] if futures else None
+
+    def stats(self):
+        return {
+            'channels': len(self._channels),
+            'pending': sum(len(channel.calls) for channel in self._channels.values()),
+            'calls': dict(self.calls),
+            'superseded': self.superseded,
+            'failed': self.failed,
+            'waited': self.waited,
+        }
@@ -0,0 +1,186 @@
+import asyncio
+import multiprocessing
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+'''
+    Dedicated worker pool for youtube_dl extraction.
+
+    Work is queued per guild and handed out round-robin, so one guild queueing 50 songs only
+    ever holds one place in line per round. Every job has a deadline, and a job whose caller gave
+    up (timed out or the command got cancelled) is dropped if it hasn't started yet.
+
+    Workers are threads by default. With processes=True the parsing happens in separate processes
+    instead, so it doesn't fight the voice send threads for the GIL. A thread can't be killed, so a
+    hung job in thread mode only gives its slot back. In process mode the whole pool is torn down
+    and rebuilt, which does get rid of it.
+'''
+
+
+# A job that was still waiting on the executor when _reset_executor tore it down. Not a
+# CancelledError, which would look to the caller as if it had been cancelled itself.
+class PoolReset(Exception):
+    pass
+
+
+class Job:
+    __slots__ = ('guild_id', 'fn', 'future', 'queued', 'started', 'handle')
+
+    def __init__(self, guild_id, fn, future: asyncio.Future):
+        self.guild_id = guild_id
+        self.fn = fn
+        self.future = future
+        self.queued = time.monotonic()
+        self.started = None
+        self.handle = None
+
+
+class ExtractionScheduler:
+    def __init__(self, workers: int = 4, *, processes: bool = False, timeout: float = 30.0):
+        self.workers = workers
+        self.processes = processes
+        self.timeout = timeout
+
+        self._executor = None
+        self._queues = OrderedDict()
+        self._running = set()
+        # Threads that are stuck on a job nobody is waiting for anymore.
+        self._stuck = 0
+
+        self.submitted = 0
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.cancelled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.processes:
+                # spawn, not fork: the bot process has voice and event loop threads running.
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            else:
+                # Twice the threads we hand work to, so there's room left over while stuck threads
+                # pile up towards a reset.
+                self._executor = ThreadPoolExecutor(self.workers * 2, thread_name_prefix='extract')
+        return self._executor
+
+    def _reset_executor(self):
+        executor, self._executor = self._executor, None
+        self._stuck = 0
+        if executor is None:
+            return
+
+        if self.processes:
+            # There's no public way to kill a hung worker, so kill all of them. Any other running
+            # jobs fail with BrokenProcessPool and their callers get an error.
+            for process in list((getattr(executor, '_processes', None) or {}).values()):
+                process.kill()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    # Runs fn() on a worker and returns its result, or raises what it raised. Raises
+    # asyncio.TimeoutError once the deadline passes and PoolReset if the workers were torn down under it.
+    async def run(self, guild_id, fn, *, timeout: float = None):
+        loop = asyncio.get_event_loop()
+        job = Job(guild_id, fn, loop.create_future())
+
+        self._queues.setdefault(guild_id, deque()).append(job)
+        self.submitted += 1
+        self._pump()
+
+        try:
+            return await asyncio.wait_for(job.future, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            self._abandon(job, hung=True)
+            raise
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            self._abandon(job)
+            raise
+
+    def _abandon(self, job: Job, *, hung: bool = False):
+        if job.started is None:
+            queue = self._queues.get(job.guild_id)
+            if queue is not None and job in queue:
+                queue.remove(job)
+                if not queue:
+                    del self._queues[job.guild_id]
+            return
+
+        if job in self._running:
+            self._running.discard(job)
+            if hung:
+                self._stuck += 1
+                if self.processes or self._stuck >= self.workers:
+                    self._reset_executor()
+            self._pump()
+
+    # Next job in round-robin order: take the head of the first guild's queue, then send that
+    # guild to the back of the line.
+    def _next_job(self):
+        while self._queues:
+            guild_id, queue = next(iter(self._queues.items()))
+            job = queue.popleft()
+            if queue:
+                self._queues.move_to_end(guild_id)
+            else:
+                del self._queues[guild_id]
+
+            if not job.future.done():
+                return job
+
+        return None
+
+    def _pump(self):
+        while len(self._running) < self.workers:
+            job = self._next_job()
+            if job is None:
+                return
+
+            job.started = time.monotonic()
+            self.started += 1
+            wait = job.started - job.queued
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+            self._running.add(job)
+            job.handle = asyncio.wrap_future(self._get_executor().submit(job.fn))
+            job.handle.add_done_callback(lambda handle, job=job: self._finished(job, handle))
+
+    def _finished(self, job: Job, handle: asyncio.Future):
+        if job in self._running:
+            self._running.discard(job)
+            self._pump()
+
+        error = PoolReset('The extraction workers were restarted.') if handle.cancelled() else handle.exception()
+        if error is not None:
+            self.failed += 1
+            if not job.future.done():
+                job.future.set_exception(error)
+        else:
+            self.completed += 1
+            if not job.future.done():
+                job.future.set_result(handle.result())
+
+    def stats(self):
+        return {
+            'mode': 'processes' if self.processes else 'threads',
+            'workers': self.workers,
+            'running': len(self._running),
+            'queued': {guild_id: len(queue) for guild_id, queue in self._queues.items()},
+            'submitted': self.submitted,
+            'started': self.started,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'cancelled': self.cancelled,
+            'mean_wait': self.total_wait / self.started if self.started else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def shutdown(self):
+        self._reset_executor()
@@ -0,0 +1,302 @@
+import asyncio
+import itertools
+import os
+import secrets
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+'''
+    Sharded launch: `python3 MothBot.py --shards N` runs N shard processes under a local coordinator.
+
+    Each shard is a normal MothBot.py process logged in with shard_id/shard_count, so Discord hands
+    it only its own share of the guilds, (guild id >> 22) % N. The coordinator is the launching
+    process. It doesn't connect to Discord, it starts the shards, restarts any that die, and
+    passes messages between them over a local socket (multiprocessing.connection, with a random
+    authkey).
+
+    Direct messages, and with them the owner-only commands, only ever arrive on shard 0. Commands
+    that act on a guild (m!say to a channel) are routed through the coordinator to the shard that
+    owns it with ShardLink.call. m!refresh and m!shutdown go to the coordinator, which logs every
+    shard out and exits.
+
+    Nothing else needs routing. Reacts, voids, triggers and snapshots are all per guild, so each
+    row only ever has one shard writing it, and they live in the same SQLite database (WAL mode
+    handles the concurrent writers). The extraction cache is shared the same way through cache.db,
+    a miss in one shard's memory finds what the others stored on disk.
+'''
+
+# Environment a shard process is started with.
+SHARD_ENV = 'MOTHBOT_SHARD'
+ADDRESS_ENV = 'MOTHBOT_COORDINATOR'
+AUTHKEY_ENV = 'MOTHBOT_AUTHKEY'
+
+
+# Shard count asked for on the command line, None without --shards.
+def requested_shards(argv=None):
+    argv = sys.argv if argv is None else argv
+    for i, arg in enumerate(argv):
+        if arg == '--shards' and i + 1 < len(argv):
+            return int(argv[i + 1])
+        if arg.startswith('--shards='):
+            return int(arg.split('=', 1)[1])
+    return None
+
+
+# The rest of the command line, passed on to every shard: everything but --shards.
+def shard_argv(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    passed = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == '--shards':
+            skip = True
+        elif not arg.startswith('--shards='):
+            passed.append(arg)
+    return passed
+
+
+def shard_for(guild_id: int, count: int):
+    return (guild_id >> 22) % count
+
+
+# Whether this bot's gateway connection is the one that gets events for the guild.
+def owns(bot, guild_id: int):
+    return not bot.shard_count or shard_for(guild_id, bot.shard_count) == (bot.shard_id or 0)
+
+
+# Where the shard process's directory-backed state goes (the audio cache): the path itself without
+# sharding, a subdirectory per shard with it. Files aren't safe to share between processes the way
+# the SQLite databases are.
+def local_path(path: str):
+    if link is None:
+        return path
+    return os.path.join(path, 'shard-{}'.format(link.id))
+
+
+class Coordinator:
+    # Shards that keep dying are restarted at most this often, seconds.
+    RESTART_DELAY = 5.0
+
+    # command is what starts a shard process, MothBot.py itself with the same flags by default.
+    def __init__(self, count: int, command=None):
+        self.count = count
+        self.command = command or [sys.executable, os.path.abspath(sys.argv[0]), *shard_argv()]
+        self.authkey = secrets.token_bytes(32)
+        self.listener = Listener(authkey=self.authkey)
+
+        self.processes = [None] * count
+        self.started = [0.0] * count
+        # shard id -> connection, once the shard has said hello.
+        self.conns = {}
+        self._send_lock = threading.Lock()
+        self.stopping = None
+
+        self.restarts = 0
+        self.routed = 0
+
+    def _launch(self, shard_id: int):
+        env = dict(os.environ)
+        env[SHARD_ENV] = '{}/{}'.format(shard_id, self.count)
+        env[ADDRESS_ENV] = str(self.listener.address)
+        env[AUTHKEY_ENV] = self.authkey.hex()
+        self.processes[shard_id] = subprocess.Popen(self.command, env=env)
+        self.started[shard_id] = time.monotonic()
+
+    def _send(self, shard_id: int, message):
+        conn = self.conns.get(shard_id)
+        if conn is None:
+            return False
+        try:
+            with self._send_lock:
+                conn.send(message)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def _accept(self):
+        while self.stopping is None:
+            try:
+                conn = self.listener.accept()
+                kind, shard_id = conn.recv()
+            except (OSError, EOFError):
+                continue
+            if kind != 'hello':
+                conn.close()
+                continue
+
+            self.conns[shard_id] = conn
+            threading.Thread(target=self._receive, args=(shard_id, conn), daemon=True).start()
+
+    def _receive(self, shard_id: int, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind == 'call':
+                # ('call', request id, target shard, name, args)
+                _, request_id, target, name, args = message
+                self.routed += 1
+                if not self._send(target, ('call', shard_id, request_id, name, args)):
+                    self._send(shard_id, ('result', request_id, False,
+                                          'Shard {} is not connected.'.format(target)))
+            elif kind == 'result':
+                # ('result', origin shard, request id, ok, value)
+                _, origin, request_id, ok, value = message
+                self._send(origin, ('result', request_id, ok, value))
+            elif kind == 'stop':
+                self.stop(message[1])
+
+        if self.conns.get(shard_id) is conn:
+            del self.conns[shard_id]
+
+    # Logs every shard out. mode is what the shard asked for, 'loop' (m!refresh) or 'stop'.
+    def stop(self, mode: str):
+        if self.stopping is not None:
+            return
+        self.stopping = mode
+        for shard_id in list(self.conns):
+            self._send(shard_id, ('logout',))
+
+    # Runs until stop(), restarting shards that exit on their own. Returns the stop mode.
+    def run(self):
+        for shard_id in range(self.count):
+            self._launch(shard_id)
+        threading.Thread(target=self._accept, daemon=True).start()
+
+        try:
+            while self.stopping is None:
+                time.sleep(0.5)
+                for shard_id, process in enumerate(self.processes):
+                    if process.poll() is None or self.stopping is not None:
+                        continue
+                    if time.monotonic() - self.started[shard_id] < self.RESTART_DELAY:
+                        continue
+                    print('Shard {} exited with {}, restarting'.format(shard_id, process.returncode))
+                    self.restarts += 1
+                    self._launch(shard_id)
+        except KeyboardInterrupt:
+            self.stop('stop')
+
+        for process in self.processes:
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        self.listener.close()
+        return self.stopping
+
+
+# A shard's end of the coordinator connection.
+class ShardLink:
+    def __init__(self, shard_id: int, count: int, address, authkey: bytes):
+        self.id = shard_id
+        self.count = count
+        self.conn = Client(address, authkey=authkey)
+        self.conn.send(('hello', shard_id))
+
+        self.loop = None
+        self.on_logout = None
+        # name -> coroutine function, the calls other shards can route here.
+        self.handlers = {}
+        self._pending = {}
+        self._ids = itertools.count()
+        self._send_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        shard = os.environ.get(SHARD_ENV)
+        if not shard:
+            return None
+        shard_id, count = (int(part) for part in shard.split('/'))
+        address = os.environ[ADDRESS_ENV]
+        return cls(shard_id, count, address, bytes.fromhex(os.environ[AUTHKEY_ENV]))
+
+    # on_logout is a coroutine function, run when the coordinator stops (or loses) the shards.
+    def start(self, loop: asyncio.AbstractEventLoop, on_logout):
+        self.loop = loop
+        self.on_logout = on_logout
+        threading.Thread(target=self._receive, name='shard-link', daemon=True).start()
+
+    def shard_for(self, guild_id: int):
+        return shard_for(guild_id, self.count)
+
+    def _send(self, message):
+        with self._send_lock:
+            self.conn.send(message)
+
+    def _receive(self):
+        while True:
+            try:
+                message = self.conn.recv()
+            except (EOFError, OSError):
+                break
+
+            kind = message[0]
+            if kind == 'call':
+                _, origin, request_id, name, args = message
+                asyncio.run_coroutine_threadsafe(self._answer(origin, request_id, name, args), self.loop)
+            elif kind == 'result':
+                _, request_id, ok, value = message
+                self.loop.call_soon_threadsafe(self._resolve, request_id, ok, value)
+            elif kind == 'logout':
+                break
+
+        # Logged out by the coordinator, or the coordinator is gone: either way this shard is done.
+        asyncio.run_coroutine_threadsafe(self.on_logout(), self.loop)
+
+    async def _answer(self, origin: int, request_id: int, name: str, args):
+        try:
+            result = await self.handlers[name](*args)
+        except Exception as e:
+            reply = ('result', origin, request_id, False, '{}: {}'.format(type(e).__name__, e))
+        else:
+            reply = ('result', origin, request_id, True, result)
+        self._send(reply)
+
+    def _resolve(self, request_id: int, ok: bool, value):
+        future = self._pending.pop(request_id, None)
+        if future is None or future.done():
+            return
+        if ok:
+            future.set_result(value)
+        else:
+            future.set_exception(RuntimeError(value))
+
+    # Runs the handler registered under name on the given shard and returns what it returned.
+    async def call(self, shard_id: int, name: str, *args, timeout: float = 10.0):
+        if shard_id == self.id:
+            return await self.handlers[name](*args)
+
+        request_id = next(self._ids)
+        future = self.loop.create_future()
+        self._pending[request_id] = future
+        self._send(('call', request_id, shard_id, name, args))
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self._pending.pop(request_id, None)
+
+    # Asks the coordinator to log every shard out, see Coordinator.stop.
+    def stop_all(self, mode: str):
+        self._send(('stop', mode))
+
+
+# This process's link when it was started as a shard, None otherwise. Set by connect().
+link = None
+
+
+# Connects to the coordinator if this process was started as a shard. Only MothBot.main() calls it:
+# worker processes inherit the shard's environment and re-import MothBot.py when they're spawned, and
+# a second connection with the same shard id would take the shard's place at the coordinator.
+def connect():
+    global link
+    link = ShardLink.from_env()
+    return link
@@ -0,0 +1,53 @@
+import json
+import os
+import sys
+import time
+
+'''
+    Startup profile: how long each phase between launching MothBot.py and being fully ready takes.
+
+    Phases are marked as they finish (imports, loading the store, setting up the bot, connecting to
+    the gateway, ready, warming up youtube_dl). With `python3 MothBot.py --profile-startup` or
+    MOTHBOT_PROFILE=1 set, the breakdown is printed once the last phase is done and appended to
+    startup.jsonl, one line per launch, to compare time-to-ready across restarts.
+
+    This module should be the first thing MothBot.py imports, its import time is the start of the clock.
+'''
+
+
+class StartupProfile:
+    def __init__(self, enabled: bool, path: str = 'startup.jsonl'):
+        self.enabled = enabled
+        self.path = path
+        self.started = time.perf_counter()
+        self.last = self.started
+        # (phase, seconds) in the order they finished.
+        self.phases = []
+        self.reported = False
+
+    # Only the first time counts for phases that can happen again (reconnects fire on_ready again).
+    def mark(self, phase: str):
+        if any(marked == phase for marked, _ in self.phases):
+            return
+
+        now = time.perf_counter()
+        self.phases.append((phase, now - self.last))
+        self.last = now
+
+    def report(self):
+        if not self.enabled or self.reported:
+            return
+        self.reported = True
+
+        total = self.last - self.started
+        print('Startup profile:')
+        for phase, seconds in self.phases:
+            print('  {:<16} {:>8.3f}s'.format(phase, seconds))
+        print('  {:<16} {:>8.3f}s'.format('total', total))
+
+        with open(self.path, 'a') as file:
+            json.dump({'time': time.time(), 'phases': dict(self.phases), 'total': total}, file)
+            file.write('\n')
+
+
+profile = StartupProfile('--profile-startup' in sys.argv or bool(os.environ.get('MOTHBOT_PROFILE')))
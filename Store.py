@@ -0,0 +1,294 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+'''
+    Persistence for the per-guild chat settings (member reacts, voids and keyword triggers) and the
+    music player snapshots that let playback survive a restart.
+
+    Everything is loaded once at startup into in-memory indexes, which is what the listeners read
+    from. Changes update the index right away and are handed to a single writer thread that
+    applies them to an SQLite database in WAL mode, batching whatever has piled up into one
+    transaction. A change therefore costs the event loop a queue put, no matter how big the tables
+    get, and a crash mid write can't leave a half written file behind. The WAL is checkpointed
+    (compacted back into the database) periodically through compact().
+
+    The old reacts.json/void.json/triggers.json files are imported the first time the database is
+    created.
+
+    A batch that keeps failing (the database locked by another process, a full disk) is retried a
+    few times and then written one statement at a time, dropping and logging whatever still fails
+    rather than stopping the writer. stats() says whether the last batch went through in full.
+'''
+
+log = logging.getLogger(__name__)
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS reacts (guild_id INTEGER, member_id INTEGER, emoji TEXT NOT NULL, '
+    'PRIMARY KEY (guild_id, member_id))',
+    'CREATE TABLE IF NOT EXISTS voids (guild_id INTEGER PRIMARY KEY, channel_id INTEGER NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS triggers (guild_id INTEGER, keyword TEXT, emoji TEXT NOT NULL, '
+    'PRIMARY KEY (guild_id, keyword))',
+    'CREATE TABLE IF NOT EXISTS snapshots (guild_id INTEGER PRIMARY KEY, data TEXT NOT NULL)',
+)
+
+_CHECKPOINT = object()
+
+
+class Writer(threading.Thread):
+    ATTEMPTS = 3
+    # Seconds before the first retry, doubling after that.
+    RETRY_DELAY = 0.5
+
+    def __init__(self, path: str, name: str = 'store-writer'):
+        super().__init__(name=name, daemon=True)
+        self.path = path
+        self.queue = queue.Queue()
+
+        self.written = 0
+        self.batches = 0
+        self.last_batch = 0.0
+        self.dropped = 0
+        # Whether the last batch made it to the database.
+        self.healthy = True
+
+    def run(self):
+        db = sqlite3.connect(self.path)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            writes = [op for op in batch if op is not None and op is not _CHECKPOINT]
+            if writes:
+                self.write(db, writes)
+            if _CHECKPOINT in batch:
+                try:
+                    db.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+                except sqlite3.Error as e:
+                    log.warning('Store checkpoint failed: %s', e)
+            self.last_batch = time.perf_counter() - start
+
+            if None in batch:
+                break
+
+        db.close()
+
+    # One transaction for the whole batch, so a failed attempt leaves nothing of it behind to retry over.
+    def write(self, db: sqlite3.Connection, writes: list):
+        delay = self.RETRY_DELAY
+        for attempt in range(1, self.ATTEMPTS + 1):
+            try:
+                with db:
+                    for statement, params in writes:
+                        db.execute(statement, params)
+            except Exception as e:
+                if attempt == self.ATTEMPTS:
+                    self.write_each(db, writes, e)
+                    return
+                log.warning('Store write failed, retrying in %.1fs: %s', delay, e)
+                time.sleep(delay)
+                delay *= 2
+            else:
+                self.written += len(writes)
+                self.batches += 1
+                self.healthy = True
+                return
+
+    # Last resort for a batch that won't go through: whatever still can goes in on its own, so a single
+    # bad statement only costs itself.
+    def write_each(self, db: sqlite3.Connection, writes: list, error: Exception):
+        failed = 0
+        for statement, params in writes:
+            try:
+                with db:
+                    db.execute(statement, params)
+            except Exception as e:
+                failed += 1
+                error = e
+        self.written += len(writes) - failed
+        self.batches += 1
+        self.dropped += failed
+        self.healthy = not failed
+        if failed:
+            log.error('Dropped %d of %d store writes after %d attempts: %s', failed, len(writes), self.ATTEMPTS, error)
+
+    def put(self, statement: str, *params):
+        self.queue.put((statement, params))
+
+    # Writes out everything still queued and stops.
+    def close(self):
+        if self.is_alive():
+            self.queue.put(None)
+            self.join()
+
+
+class ReactTable:
+    def __init__(self, writer: Writer, rows):
+        self._writer = writer
+        # guild id -> {member id: emoji}
+        self._index = {}
+        for guild_id, member_id, emoji in rows:
+            self._index.setdefault(guild_id, {})[member_id] = emoji
+
+    def get(self, guild_id: int, member_id: int):
+        members = self._index.get(guild_id)
+        return members.get(member_id) if members else None
+
+    def set(self, guild_id: int, member_id: int, emoji: str):
+        self._index.setdefault(guild_id, {})[member_id] = emoji
+        self._writer.put('INSERT OR REPLACE INTO reacts VALUES (?, ?, ?)', guild_id, member_id, emoji)
+
+    def remove(self, guild_id: int, member_id: int):
+        members = self._index.get(guild_id)
+        if not members or members.pop(member_id, None) is None:
+            return False
+
+        if not members:
+            del self._index[guild_id]
+        self._writer.put('DELETE FROM reacts WHERE guild_id = ? AND member_id = ?', guild_id, member_id)
+        return True
+
+
+class VoidTable:
+    def __init__(self, writer: Writer, rows):
+        self._writer = writer
+        # guild id -> channel id
+        self._index = dict(rows)
+
+    def get(self, guild_id: int):
+        return self._index.get(guild_id)
+
+    def items(self):
+        return self._index.items()
+
+    def set(self, guild_id: int, channel_id: int):
+        self._index[guild_id] = channel_id
+        self._writer.put('INSERT OR REPLACE INTO voids VALUES (?, ?)', guild_id, channel_id)
+
+    def remove(self, guild_id: int):
+        if self._index.pop(guild_id, None) is None:
+            return False
+
+        self._writer.put('DELETE FROM voids WHERE guild_id = ?', guild_id)
+        return True
+
+
+class TriggerTable:
+    def __init__(self, writer: Writer, rows):
+        self._writer = writer
+        # guild id -> {keyword: emoji}
+        self._index = {}
+        for guild_id, keyword, emoji in rows:
+            self._index.setdefault(guild_id, {})[keyword] = emoji
+
+    def for_guild(self, guild_id: int):
+        return self._index.get(guild_id, {})
+
+    def set(self, guild_id: int, keyword: str, emoji: str):
+        self._index.setdefault(guild_id, {})[keyword] = emoji
+        self._writer.put('INSERT OR REPLACE INTO triggers VALUES (?, ?, ?)', guild_id, keyword, emoji)
+
+    def remove(self, guild_id: int, keyword: str):
+        keywords = self._index.get(guild_id)
+        if not keywords or keywords.pop(keyword, None) is None:
+            return False
+
+        if not keywords:
+            del self._index[guild_id]
+        self._writer.put('DELETE FROM triggers WHERE guild_id = ? AND keyword = ?', guild_id, keyword)
+        return True
+
+
+class SnapshotTable:
+    def __init__(self, writer: Writer, rows):
+        self._writer = writer
+        # guild id -> snapshot dict (see Music.VoiceState.snapshot), as found at startup. Only those are
+        # kept in memory, afterwards the live players are the up to date copy.
+        self._index = {guild_id: json.loads(data) for guild_id, data in rows}
+
+    def items(self):
+        return list(self._index.items())
+
+    def set(self, guild_id: int, snapshot: dict):
+        self._index.pop(guild_id, None)
+        self._writer.put('INSERT OR REPLACE INTO snapshots VALUES (?, ?)', guild_id,
+                         json.dumps(snapshot, separators=(',', ':')))
+
+    def remove(self, guild_id: int):
+        self._index.pop(guild_id, None)
+        self._writer.put('DELETE FROM snapshots WHERE guild_id = ?', guild_id)
+
+
+class Store:
+    def __init__(self, path: str = 'mothbot.db'):
+        self.path = path
+        fresh = not os.path.exists(path)
+
+        db = sqlite3.connect(path)
+        db.execute('PRAGMA journal_mode=WAL')
+        for statement in SCHEMA:
+            db.execute(statement)
+        if fresh:
+            self._import_json(db)
+
+        self.writer = Writer(path)
+        self.reacts = ReactTable(self.writer, db.execute('SELECT guild_id, member_id, emoji FROM reacts'))
+        self.voids = VoidTable(self.writer, db.execute('SELECT guild_id, channel_id FROM voids'))
+        self.triggers = TriggerTable(self.writer, db.execute('SELECT guild_id, keyword, emoji FROM triggers'))
+        self.snapshots = SnapshotTable(self.writer, db.execute('SELECT guild_id, data FROM snapshots'))
+        db.close()
+
+        self.writer.start()
+
+    # One time import of the json files the bot used to keep.
+    @staticmethod
+    def _import_json(db: sqlite3.Connection):
+        def read(name):
+            try:
+                with open(name, 'r') as in_file:
+                    return json.load(in_file)
+            except (FileNotFoundError, ValueError):
+                return {}
+
+        with db:
+            for guild_id, members in read('reacts.json').items():
+                for member_id, react in members.items():
+                    db.execute('INSERT OR REPLACE INTO reacts VALUES (?, ?, ?)',
+                               (int(guild_id), int(member_id), react['emoji']))
+
+            for guild_id, channel_id in read('void.json').items():
+                db.execute('INSERT OR REPLACE INTO voids VALUES (?, ?)', (int(guild_id), int(channel_id)))
+
+            for guild_id, keywords in read('triggers.json').items():
+                for keyword, emoji in keywords.items():
+                    db.execute('INSERT OR REPLACE INTO triggers VALUES (?, ?, ?)', (int(guild_id), keyword, emoji))
+
+    # Folds the WAL back into the database file so it doesn't grow forever.
+    def compact(self):
+        self.writer.queue.put(_CHECKPOINT)
+
+    def stats(self):
+        return {
+            'pending': self.writer.queue.qsize(),
+            'written': self.writer.written,
+            'batches': self.writer.batches,
+            'last_batch_ms': self.writer.last_batch * 1000,
+            'dropped': self.writer.dropped,
+            'healthy': self.writer.healthy,
+        }
+
+    # Writes out everything still queued and stops the writer.
+    def close(self):
+        self.writer.close()
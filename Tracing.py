@@ -0,0 +1,158 @@
+import datetime
+import json
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+    Time-to-first-audio tracing for m!play and m!playnext.
+
+    A Trace is started when the command comes in, keyed by the command message's id, and then
+    travels with the Song through the queue and the player. Each stage on the way adds a span
+    (stage, offset from the start, duration):
+
+        dispatch     Discord timestamp of the message to the bot receiving the command
+        voice_state  the ensure_voice_state hook
+        connect      joining the voice channel, when the bot wasn't in one yet
+        extract      resolving the search, with search/process for the youtube_dl passes it ran
+        enqueue      SongQueue.put
+        queued       waiting in the queue for the player to get to the song
+        prepare      resolving the stream url, starting ffmpeg (resolve) and buffering its first
+                     frames (ffmpeg), when the prefetch hasn't done it already
+        play         setting the volume and voice.play
+        panel        the now playing message REST calls, after the audio has started
+
+    `first_audio` is when voice.play got the song, the delay the user hears. Finished traces go
+    to traces.jsonl, one json line each, and m!traces reports p50/p95 per stage over the latest.
+    The file is written by a thread of its own, finish() is called on the event loop.
+'''
+
+log = logging.getLogger(__name__)
+
+PATH = 'traces.jsonl'
+# Traces kept in memory since startup, for when the file can't be read.
+recent = deque(maxlen=500)
+# One thread, so the lines go out in the order the traces finished.
+_writer = ThreadPoolExecutor(1, thread_name_prefix='traces')
+
+
+def _append(path: str, line: str):
+    try:
+        with open(path, 'a') as file:
+            file.write(line)
+    except OSError as e:
+        log.warning('Couldn\'t write to %s: %s', path, e)
+
+
+class Span:
+    __slots__ = ('trace', 'stage', 'started')
+
+    def __init__(self, trace, stage: str):
+        self.trace = trace
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.stage, time.perf_counter() - self.started, self.started)
+
+
+class Trace:
+    __slots__ = ('id', 'guild_id', 'command', 'started', 'time', 'spans', 'first_audio', 'queued', 'finished')
+
+    def __init__(self, request_id: int, guild_id: int, command: str, sent: datetime.datetime = None):
+        self.id = request_id
+        self.guild_id = guild_id
+        self.command = command
+        self.started = time.perf_counter()
+        self.time = time.time()
+        # (stage, offset, seconds)
+        self.spans = []
+        self.first_audio = None
+        self.queued = None
+        self.finished = False
+
+        if sent is not None:
+            # discord.py hands out naive UTC datetimes. Clocks that are off a bit can't make it negative.
+            delay = self.time - sent.replace(tzinfo=datetime.timezone.utc).timestamp()
+            self.spans.append(('dispatch', 0.0, max(delay, 0.0)))
+
+    @classmethod
+    def from_context(cls, ctx):
+        return cls(ctx.message.id, ctx.guild.id, ctx.command.qualified_name, ctx.message.created_at)
+
+    def span(self, stage: str):
+        return Span(self, stage)
+
+    def add(self, stage: str, seconds: float, started: float = None):
+        if self.finished:
+            return
+        offset = (started if started is not None else time.perf_counter() - seconds) - self.started
+        self.spans.append((stage, round(offset, 6), round(seconds, 6)))
+
+    def mark_queued(self):
+        self.queued = time.perf_counter()
+
+    # The player got to the song, the time since mark_queued is how long it waited for that.
+    def mark_dequeued(self):
+        if self.queued is not None:
+            self.add('queued', time.perf_counter() - self.queued, self.queued)
+            self.queued = None
+
+    def mark_audio(self):
+        if self.first_audio is None:
+            self.first_audio = time.perf_counter() - self.started
+
+    # Writes the trace out, once. outcome says why it ended if the song never played.
+    def finish(self, outcome: str = 'ok'):
+        if self.finished:
+            return
+        self.finished = True
+
+        record = {'id': self.id, 'guild': self.guild_id, 'command': self.command, 'time': self.time,
+                  'outcome': outcome, 'first_audio': self.first_audio,
+                  'spans': [list(span) for span in self.spans]}
+        recent.append(record)
+        _writer.submit(_append, PATH, json.dumps(record, separators=(',', ':')) + '\n')
+
+
+# The latest `limit` traces from the log, restarts included. Blocks, so run it in an executor.
+def load(limit: int = 500):
+    try:
+        with open(PATH, 'r') as file:
+            lines = deque(file, maxlen=limit)
+    except FileNotFoundError:
+        return list(recent)
+
+    records = []
+    for line in lines:
+        try:
+            records.append(json.loads(line))
+        except ValueError:
+            pass
+    return records
+
+
+def percentile(values: list, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+# stage -> (count, p50, p95) in seconds, over every span of that stage, plus 'first_audio'.
+def summary(records: list):
+    stages = {}
+    for record in records:
+        # A stage that ran more than once in a trace (extraction passes) counts once, summed.
+        totals = {}
+        for stage, _, seconds in record['spans']:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        for stage, seconds in totals.items():
+            stages.setdefault(stage, []).append(seconds)
+        if record.get('first_audio') is not None:
+            stages.setdefault('first_audio', []).append(record['first_audio'])
+
+    return {stage: (len(values), percentile(values, 0.5), percentile(values, 0.95))
+            for stage, values in stages.items()}
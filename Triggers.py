@@ -0,0 +1,128 @@
+from collections import OrderedDict, deque
+
+'''
+    Keyword trigger engine for the on_message listeners.
+
+    Every keyword (the built in thonk/mood/moth ones and whatever each guild adds) is compiled into
+    an Aho-Corasick automaton, so a message is lowercased once and scanned once no matter how many
+    triggers there are. Guilds with their own triggers get their own automaton (built ins
+    included); changing a guild's triggers only rebuilds that guild's, and only when the next
+    message from it comes in.
+
+    The result of a scan is remembered per message, so the module level listener and the ChatCog
+    one share a single pass.
+
+    The per-guild triggers themselves live in the Store; the engine only reads them.
+'''
+
+
+class Automaton:
+    # Up to this many keywords, plain substring checks (done in C) beat walking the automaton
+    # character by character in Python.
+    SMALL = 32
+
+    def __init__(self, keywords):
+        self.keywords = tuple(keywords)
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+
+        for keyword in keywords:
+            self._add(keyword)
+        self._link()
+
+    def _add(self, keyword: str):
+        state = 0
+        for char in keyword:
+            following = self._goto[state].get(char)
+            if following is None:
+                following = len(self._goto)
+                self._goto[state][char] = following
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = following
+        self._out[state] = (keyword,)
+
+    # Breadth first, so a state's failure link is always finished before its children need it.
+    def _link(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, following in self._goto[state].items():
+                queue.append(following)
+
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                fail = self._goto[fail].get(char, 0)
+                if fail == following:
+                    fail = 0
+
+                self._fail[following] = fail
+                if self._out[fail]:
+                    self._out[following] = self._out[following] + self._out[fail]
+
+    # Every keyword found anywhere in text. Expects text to be lowercased already.
+    def find(self, text: str):
+        if len(self.keywords) <= self.SMALL:
+            return {keyword for keyword in self.keywords if keyword in text}
+
+        goto, fail, out = self._goto, self._fail, self._out
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+
+class TriggerEngine:
+    def __init__(self, keywords, table):
+        self.keywords = [keyword.lower() for keyword in keywords]
+        self.builtin = Automaton(self.keywords)
+
+        # Store.TriggerTable, guild id -> {keyword: emoji}
+        self.table = table
+        self._automata = {}
+        self._recent = OrderedDict()
+
+    def guild_triggers(self, guild_id: int):
+        return self.table.for_guild(guild_id)
+
+    def set_trigger(self, guild_id: int, keyword: str, emoji: str):
+        self.table.set(guild_id, keyword.lower(), emoji)
+        self._automata.pop(guild_id, None)
+
+    def remove_trigger(self, guild_id: int, keyword: str):
+        self._automata.pop(guild_id, None)
+        return self.table.remove(guild_id, keyword.lower())
+
+    def _automaton(self, guild_id):
+        custom = self.table.for_guild(guild_id) if guild_id is not None else None
+        if not custom:
+            return self.builtin
+
+        automaton = self._automata.get(guild_id)
+        if automaton is None:
+            automaton = Automaton(set(self.keywords) | set(custom))
+            self._automata[guild_id] = automaton
+        return automaton
+
+    def scan_text(self, text: str, guild_id=None):
+        return self._automaton(guild_id).find(text.lower())
+
+    # Keywords found in a message, its content lowercased and scanned only the first time.
+    def scan(self, message):
+        found = self._recent.get(message.id)
+        if found is None:
+            guild_id = message.guild.id if message.guild else None
+            found = self.scan_text(message.content, guild_id)
+
+            self._recent[message.id] = found
+            if len(self._recent) > 64:
+                self._recent.popitem(last=False)
+        return found
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import Metrics
+
+'''
+    Event loop stall watchdog.
+
+    A heartbeat scheduled on the event loop every INTERVAL seconds measures how late it runs, that
+    lateness is the loop lag (mothbot_loop_lag_seconds with the metrics endpoint on). A separate
+    thread keeps an eye on the heartbeat. Once it is overdue by more than the threshold, some
+    callback is holding the loop, and the thread grabs the loop thread's stack right then, while
+    the offender is still on it. When the loop comes back the stall is recorded with how long it
+    lasted, the stack, and what was running: the command (found from the ctx further up the
+    stack) or otherwise the outermost function of the bot's own that was on it, a listener or loop.
+
+    Stalls are logged, kept for m!stalls and appended to stalls.jsonl (by a thread of its own, not
+    adding file I/O to the loop it's watching). Opt in with
+    `python3 MothBot.py --watchdog` or MOTHBOT_WATCHDOG=1, MOTHBOT_WATCHDOG_MS sets the threshold.
+'''
+
+log = logging.getLogger(__name__)
+
+enabled = '--watchdog' in sys.argv or bool(os.environ.get('MOTHBOT_WATCHDOG'))
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# What the stalled stack was doing: ('command', name) when a command context is on it, otherwise
+# ('function', qualified name) of the outermost frame in the bot's own modules.
+def describe(frame):
+    outermost = None
+    while frame is not None:
+        code = frame.f_code
+        path = os.path.abspath(code.co_filename)
+        if os.path.dirname(path) == HERE and path != os.path.abspath(__file__):
+            ctx = frame.f_locals.get('ctx')
+            command = getattr(ctx, 'command', None)
+            if command is not None and hasattr(command, 'qualified_name'):
+                return 'command', command.qualified_name
+            outermost = getattr(code, 'co_qualname', code.co_name)
+        frame = frame.f_back
+
+    return ('function', outermost) if outermost else ('unknown', None)
+
+
+class Stall:
+    __slots__ = ('started', 'duration', 'kind', 'name', 'stack')
+
+    def __init__(self, started: float, kind: str, name: str, stack: list):
+        self.started = started
+        self.duration = 0.0
+        self.kind = kind
+        self.name = name
+        self.stack = stack
+
+    def __str__(self):
+        return '{:.0f}ms in {} {}'.format(self.duration * 1000, self.kind, self.name)
+
+
+class Watchdog:
+    INTERVAL = 0.05
+    THRESHOLD = 0.25
+    # How many stalls m!stalls can show.
+    KEEP = 20
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, *, threshold: float = None, path: str = 'stalls.jsonl'):
+        self.loop = loop
+        self.threshold = threshold or float(os.environ.get('MOTHBOT_WATCHDOG_MS', 0)) / 1000 or self.THRESHOLD
+        self.path = path
+
+        self._thread_id = None
+        self._due = None
+        # Stall caught by the sampling thread, finished off by the next heartbeat.
+        self._pending = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        self.stalls = deque(maxlen=self.KEEP)
+        # One thread, so stalls.jsonl has them in order.
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='stalls')
+        self.count = 0
+        self.max_lag = 0.0
+
+    def start(self):
+        self.loop.call_soon(self._beat)
+        threading.Thread(target=self._watch, name='loop-watchdog', daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+
+    def _beat(self):
+        now = time.monotonic()
+        if self._thread_id is None:
+            self._thread_id = threading.get_ident()
+
+        if self._due is not None:
+            lag = max(now - self._due, 0.0)
+            self.max_lag = max(self.max_lag, lag)
+            Metrics.observe('mothbot_loop_lag_seconds', lag)
+
+            with self._lock:
+                stall, self._pending = self._pending, None
+            if stall is not None:
+                stall.duration = lag
+                self._record(stall)
+
+        if not self._stopped.is_set():
+            self._due = now + self.INTERVAL
+            self.loop.call_later(self.INTERVAL, self._beat)
+
+    def _watch(self):
+        while not self._stopped.wait(self.INTERVAL):
+            due = self._due
+            if due is None or time.monotonic() - due < self.threshold:
+                continue
+
+            with self._lock:
+                if self._pending is not None:
+                    continue
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is None:
+                    continue
+                kind, name = describe(frame)
+                stack = traceback.format_stack(frame)
+                # One stall per missed heartbeat, even if the sampling thread looks again.
+                self._pending = Stall(time.time(), kind, name, stack)
+                del frame
+
+    def _record(self, stall: Stall):
+        self.count += 1
+        self.stalls.append(stall)
+        Metrics.inc('mothbot_loop_stalls_total', source='{} {}'.format(stall.kind, stall.name))
+        log.warning('event loop stalled for %s:\n%s', stall, ''.join(stall.stack[-6:]))
+
+        line = json.dumps({'time': stall.started, 'duration': stall.duration, 'kind': stall.kind,
+                           'name': stall.name, 'stack': stall.stack}) + '\n'
+        self._writer.submit(self._append, line)
+
+    def _append(self, line: str):
+        try:
+            with open(self.path, 'a') as file:
+                file.write(line)
+        except OSError as e:
+            log.warning('Couldn\'t write to %s: %s', self.path, e)
+
+    def stats(self):
+        return {
+            'threshold_ms': self.threshold * 1000,
+            'stalls': self.count,
+            'max_lag_ms': self.max_lag * 1000,
+        }
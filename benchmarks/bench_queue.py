@@ -0,0 +1,109 @@
+import itertools
+import os
+import random
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import BlockList
+
+'''
+    Queue operations on a long queue: the deque the song queue used to keep (islice for pages,
+    random.shuffle straight on the deque) against BlockList. Microseconds per operation.
+
+        python benchmarks/bench_queue.py [entries]
+'''
+
+
+class Legacy:
+    def __init__(self, items):
+        self.items = deque(items)
+
+    def get(self, index):
+        return self.items[index]
+
+    def page(self, start, stop):
+        return list(itertools.islice(self.items, start, stop))
+
+    def insert(self, index, item):
+        self.items.insert(index, item)
+
+    def remove(self, index):
+        del self.items[index]
+
+    def move(self, src, dst):
+        item = self.items[src]
+        del self.items[src]
+        self.items.insert(dst, item)
+
+    def shuffle(self, rng):
+        rng.shuffle(self.items)
+
+    def popleft(self):
+        return self.items.popleft()
+
+
+class Blocked:
+    def __init__(self, items):
+        self.items = BlockList.BlockList(items)
+
+    def get(self, index):
+        return self.items[index]
+
+    def page(self, start, stop):
+        return self.items[start:stop]
+
+    def insert(self, index, item):
+        self.items.insert(index, item)
+
+    def remove(self, index):
+        del self.items[index]
+
+    def move(self, src, dst):
+        self.items.move(src, dst)
+
+    def shuffle(self, rng):
+        self.items.shuffle(rng)
+
+    def popleft(self):
+        return self.items.popleft()
+
+
+def bench(cls, size: int, rounds: int):
+    rng = random.Random(258)
+    positions = [rng.randrange(size - 1) for _ in range(rounds)]
+    results = {}
+
+    def timed(name, fn, count=rounds):
+        start = time.perf_counter()
+        fn()
+        results[name] = (time.perf_counter() - start) / count * 1e6
+
+    queue = cls(range(size))
+    timed('index', lambda: [queue.get(i) for i in positions])
+    timed('last page', lambda: [queue.page(size - 10, size) for _ in positions])
+    timed('insert', lambda: [queue.insert(i, -1) for i in positions])
+    timed('remove', lambda: [queue.remove(i) for i in positions])
+    timed('move', lambda: [queue.move(i, size - 1 - i) for i in positions])
+    timed('shuffle', lambda: [queue.shuffle(rng) for _ in range(5)], 5)
+    timed('get', lambda: [queue.popleft() for _ in positions])
+    return results
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    rounds = 1000
+
+    before = bench(Legacy, size, rounds)
+    after = bench(Blocked, size, rounds)
+    print('{} entries, us/op'.format(size))
+    print('{:>10} {:>12} {:>12} {:>8}'.format('op', 'deque', 'BlockList', 'speedup'))
+    for name in before:
+        print('{:>10} {:>12.2f} {:>12.2f} {:>7.1f}x'.format(name, before[name], after[name],
+                                                            before[name] / after[name]))
+
+
+if __name__ == '__main__':
+    main()
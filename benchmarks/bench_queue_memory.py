@@ -0,0 +1,71 @@
+import gc
+import random
+import sys
+import tracemalloc
+
+import fakes
+from fakes import make_info
+
+# Importing Music opens its caches in the working directory, keep them out of the repo.
+fakes.offline()
+
+import Cache
+import Music
+
+'''
+    Memory held per queued song: the old way (a source per entry, keeping the whole youtube_dl info
+    dict) against the Song records queued now, plus how many ffmpeg processes each keeps around.
+
+        python benchmarks/bench_queue_memory.py [songs]
+'''
+
+
+class Context:
+    author = object()
+
+
+# What the queue used to hold per entry: the source object with the full info dict in `data`.
+class LegacyEntry:
+    def __init__(self, ctx, data: dict):
+        self.requester = ctx.author
+        self.data = data
+        self.title = data['title']
+        self.url = data['webpage_url']
+        self.stream_url = data['url']
+
+
+def legacy(rng: random.Random, count: int):
+    return [LegacyEntry(Context, make_info(rng)) for _ in range(count)]
+
+
+def records(rng: random.Random, count: int):
+    # Queued from what the extractor hands back, which is already trimmed by the cache.
+    return [Music.Song.from_info(Context, dict(Cache.trim_info(make_info(rng)))) for _ in range(count)]
+
+
+def measure(fn, count: int):
+    rng = random.Random(258)
+    gc.collect()
+    tracemalloc.start()
+    queue = fn(rng, count)
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del queue
+    return size / count
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+
+    before = measure(legacy, count)
+    after = measure(records, count)
+    print('{} queued songs'.format(count))
+    print('{:>8} {:>14} {:>16}'.format('', 'bytes/entry', 'ffmpeg processes'))
+    print('{:>8} {:>14.0f} {:>16}'.format('legacy', before, count))
+    print('{:>8} {:>14.0f} {:>16}'.format('records', after, 1 + Music.VoiceState.PREFETCH_DEPTH))
+    print('{:.0f}x less memory per entry'.format(before / after))
+
+
+if __name__ == '__main__':
+    main()
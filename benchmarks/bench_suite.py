@@ -0,0 +1,282 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+import fakes
+
+loop = fakes.offline()
+
+import MothBot
+import Music
+
+'''
+    Offline benchmark suite: the chat listeners, m!roll, song queue operations and create_source,
+    run against the fake Discord client and the fake YoutubeDL in fakes.py. No token, no network.
+
+    Every benchmark does the same seeded operations every time. Each operation is timed on its own
+    for the percentiles and ops/sec is over the sum of those, and a second, untimed run under
+    tracemalloc measures what the operations allocate. Results can be saved and compared between
+    commits:
+
+        python benchmarks/bench_suite.py [--ops N] [--only NAME] [--save FILE] [--compare FILE]
+
+    Saved files have the commit they were measured at in them, the default name is
+    bench-<commit>.json.
+'''
+
+
+class Benchmark:
+    # ops is how many times run() gets called. setup(rng, ops) builds fresh state before the timed
+    # and the allocation runs alike.
+    def __init__(self, name: str, run, setup=None, ops: int = 2000):
+        self.name = name
+        self.run = run
+        self.setup = setup or (lambda rng, ops: None)
+        self.ops = ops
+
+
+def chat_on_message(discord_):
+    cog = discord_.bot.get_cog('ChatCog')
+    words = ['moth', 'good bot', 'praise be', ':thonk:', 'mood', 'hello', 'music', 'queue', 'tonight', 'lol']
+
+    def setup(rng, ops):
+        for member in discord_.members[:10]:
+            cog.store.reacts.set(discord_.guilds[0].id, member.id, '\U0001F44D')
+        return [discord_.message(' '.join(rng.choice(words) for _ in range(rng.randint(3, 20))), rng)
+                for _ in range(4000)]
+
+    async def run(messages, i):
+        await cog.on_message(messages[i % len(messages)])
+
+    return Benchmark('chat.on_message', run, setup)
+
+
+def bot_on_message(discord_):
+    words = ['moth', 'mother', 'mothbot', 'praise be', 'hello', 'there', 'general', 'kenobi']
+
+    def setup(rng, ops):
+        return [discord_.message(' '.join(rng.choice(words) for _ in range(rng.randint(3, 20))), rng)
+                for _ in range(4000)]
+
+    async def run(messages, i):
+        await discord_.bot.on_message(messages[i % len(messages)])
+
+    return Benchmark('bot.on_message', run, setup)
+
+
+def chat_roll(discord_):
+    cog = discord_.bot.get_cog('ChatCog')
+    dice = ['d20', '2d6', '4d6 + 3', '10d10', '100d6', '1000d20 + 5']
+
+    def setup(rng, ops):
+        # m!roll uses the random module directly.
+        random.seed(258)
+        return [(discord_.context('m!roll', rng, cog.roll), rng.choice(dice)) for _ in range(500)]
+
+    async def run(calls, i):
+        ctx, roll = calls[i % len(calls)]
+        ctx.sent.clear()
+        await cog.roll(ctx, dice=roll)
+
+    return Benchmark('chat.roll', run, setup)
+
+
+def make_queue(discord_, rng, size: int):
+    ctx = discord_.context('m!play', rng)
+    queue = Music.SongQueue()
+    for i in range(size):
+        queue.put_nowait(Music.Song(ctx, title='song {}'.format(i), url='https://youtu.be/{:011d}'.format(i % (size // 2)),
+                                    length=rng.randint(60, 600)))
+    return queue, ctx
+
+
+def queue_benchmarks(discord_, size: int = 10000):
+    def setup(rng, ops):
+        queue, ctx = make_queue(discord_, rng, size)
+        positions = [rng.randrange(size // 2) for _ in range(4000)]
+        return queue, ctx, positions
+
+    async def put_get(state, i):
+        queue, ctx, _ = state
+        queue.put_nowait(queue.get_nowait())
+
+    async def insert(state, i):
+        queue, ctx, positions = state
+        queue.insert(positions[i % len(positions)], Music.Song(ctx, title='inserted', url='https://youtu.be/x'))
+
+    async def move(state, i):
+        queue, ctx, positions = state
+        queue.move(positions[i % len(positions)], positions[-1 - i % len(positions)])
+
+    async def page(state, i):
+        queue, ctx, positions = state
+        start = positions[i % len(positions)]
+        return queue[start:start + 10]
+
+    async def shuffle(state, i):
+        state[0].shuffle()
+
+    async def dedupe(state, i):
+        queue, ctx, _ = state
+        # Puts the duplicates back in first, so every round has the same amount of work.
+        while len(queue) < size:
+            queue.put_nowait(Music.Song(ctx, title='again', url='https://youtu.be/{:011d}'.format(len(queue) % 100)))
+        queue.dedupe()
+
+    return [
+        Benchmark('queue.put_get', put_get, setup),
+        Benchmark('queue.insert', insert, setup),
+        Benchmark('queue.move', move, setup),
+        Benchmark('queue.page', page, setup),
+        Benchmark('queue.shuffle', shuffle, setup, ops=50),
+        Benchmark('queue.dedupe', dedupe, setup, ops=50),
+    ]
+
+
+# The source create_source hands back, minus ffmpeg: opening it is the one step that isn't the bot's.
+class OfflineSource(Music.YTDLOpusSource):
+    def _open(self, start: float = 0.0):
+        return OfflineAudio()
+
+
+class OfflineAudio:
+    def read(self):
+        return b''
+
+    def cleanup(self):
+        pass
+
+
+def create_source(discord_):
+    ytdl = fakes.FakeYoutubeDL()
+    Music.YTDLInfo.extractor._ytdl = ytdl
+
+    def cold_setup(rng, ops):
+        # A search nobody made before for every operation, so each one misses the extraction cache.
+        searches = ['cold {} {}'.format(rng.random(), i) for i in range(ops)]
+        ytdl.prepare(searches)
+        return [discord_.context('m!play', rng) for _ in range(200)], searches
+
+    def warm_setup(rng, ops):
+        # The same 50 over and over, hits after the first round.
+        searches = ['warm {}'.format(i % 50) for i in range(ops)]
+        ytdl.prepare(searches[:50])
+        return [discord_.context('m!play', rng) for _ in range(200)], searches
+
+    async def run(state, i):
+        contexts, searches = state
+        source = await OfflineSource.create_source(contexts[i % len(contexts)], searches[i], loop=loop)
+        source.cleanup()
+
+    return [
+        Benchmark('music.create_source.cold', run, cold_setup, ops=300),
+        Benchmark('music.create_source.warm', run, warm_setup, ops=2000),
+    ]
+
+
+def percentile(ordered: list, fraction: float):
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+async def drive(benchmark: Benchmark, state, ops: int, timings: list = None):
+    for i in range(ops):
+        started = time.perf_counter_ns()
+        await benchmark.run(state, i)
+        if timings is not None:
+            timings.append(time.perf_counter_ns() - started)
+        # Lets whatever the operation scheduled (outbound sends, reactions) run, outside the timing.
+        await asyncio.sleep(0)
+
+
+def measure(benchmark: Benchmark, ops: int):
+    warmup = min(ops // 10, 100)
+    loop.run_until_complete(drive(benchmark, benchmark.setup(random.Random(257), warmup), warmup))
+
+    state = benchmark.setup(random.Random(258), ops)
+    gc.collect()
+    timings = []
+    loop.run_until_complete(drive(benchmark, state, ops, timings))
+    # Without the sleeps between operations.
+    elapsed = sum(timings) / 1e9
+
+    state = benchmark.setup(random.Random(259), ops)
+    gc.collect()
+    tracemalloc.start()
+    loop.run_until_complete(drive(benchmark, state, ops))
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    timings.sort()
+    return {
+        'ops': ops,
+        'ops_per_sec': ops / elapsed,
+        'p50_us': percentile(timings, 0.5) / 1000,
+        'p95_us': percentile(timings, 0.95) / 1000,
+        'p99_us': percentile(timings, 0.99) / 1000,
+        'retained_b_per_op': retained / ops,
+        'peak_kb': peak / 1024,
+    }
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=fakes.ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline MothBot benchmarks.')
+    parser.add_argument('--ops', type=float, default=1.0, help='scale every benchmark\'s operation count')
+    parser.add_argument('--only', action='append', help='only run benchmarks whose name contains this')
+    parser.add_argument('--save', nargs='?', const='', help='write the results as json (default bench-<commit>.json)')
+    parser.add_argument('--compare', help='results saved earlier to compare against')
+    args = parser.parse_args()
+
+    bot = MothBot.MothBot()
+    discord_ = fakes.FakeDiscord(bot)
+    benchmarks = [chat_on_message(discord_), bot_on_message(discord_), chat_roll(discord_),
+                  *queue_benchmarks(discord_), *create_source(discord_)]
+    if args.only:
+        benchmarks = [b for b in benchmarks if any(part in b.name for part in args.only)]
+
+    baseline = {}
+    if args.compare:
+        with open(fakes.user_path(args.compare)) as file:
+            baseline = json.load(file)['results']
+
+    results = {}
+    print('{:<26} {:>11} {:>9} {:>9} {:>9} {:>10} {:>9} {:>8}'.format(
+        'benchmark', 'ops/s', 'p50 us', 'p95 us', 'p99 us', 'B/op kept', 'peak KB', 'vs base'))
+    for benchmark in benchmarks:
+        result = measure(benchmark, max(int(benchmark.ops * args.ops), 1))
+        results[benchmark.name] = result
+
+        change = ''
+        if benchmark.name in baseline:
+            change = '{:+.1f}%'.format((result['ops_per_sec'] / baseline[benchmark.name]['ops_per_sec'] - 1) * 100)
+        print('{:<26} {:>11.0f} {:>9.1f} {:>9.1f} {:>9.1f} {:>10.0f} {:>9.0f} {:>8}'.format(
+            benchmark.name, result['ops_per_sec'], result['p50_us'], result['p95_us'], result['p99_us'],
+            result['retained_b_per_op'], result['peak_kb'], change))
+
+    if args.save is not None:
+        path = fakes.user_path(args.save) if args.save else os.path.join(fakes.ROOT, 'bench-{}.json'.format(commit()))
+        with open(path, 'w') as file:
+            json.dump({'commit': commit(), 'python': platform.python_version(), 'time': time.time(),
+                       'results': results}, file, indent=1)
+        print('Saved to', path)
+
+    bot.store.close()
+    Music.YTDLInfo.close()
+
+
+if __name__ == '__main__':
+    main()
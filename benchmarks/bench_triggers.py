@@ -0,0 +1,92 @@
+import os
+import random
+import string
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import Store
+import Triggers
+
+'''
+    Messages/sec through the on_message keyword checks, the old way (lowercase the content and do a
+    substring check, once per trigger) against Triggers.TriggerEngine, for growing trigger counts.
+
+        python benchmarks/bench_triggers.py [messages]
+'''
+
+BUILTIN = [":thonk:", ":megathonk:", ":gaythonk:", ":doublethonk:", ":codethonk:", ":eggthonk:", "mood", "darryl",
+           "bruh", ":high:", "good bot", "moth", "mother", "mothbot", "praise be"]
+
+
+class Message:
+    __slots__ = ('id', 'content', 'guild')
+
+    def __init__(self, id_, content, guild):
+        self.id = id_
+        self.content = content
+        self.guild = guild
+
+
+class Guild:
+    id = 1
+
+
+def random_word(rng: random.Random, length: int):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(length))
+
+
+def make_messages(rng: random.Random, count: int, keywords):
+    messages = []
+    for i in range(count):
+        words = [random_word(rng, rng.randint(2, 8)) for _ in range(rng.randint(3, 25))]
+        if rng.random() < 0.2:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(keywords).upper())
+        messages.append(Message(i, ' '.join(words), Guild))
+    return messages
+
+
+def legacy(messages, keywords):
+    hits = 0
+    for message in messages:
+        for keyword in keywords:
+            if keyword in message.content.lower():
+                hits += 1
+    return hits
+
+
+def engine(messages, keywords):
+    # The writer is never started, the benchmark has no business touching a database.
+    triggers = Triggers.TriggerEngine(BUILTIN, Store.TriggerTable(Store.Writer(os.devnull), ()))
+    for keyword in keywords[len(BUILTIN):]:
+        triggers.set_trigger(Guild.id, keyword, '\U0001F44D')
+
+    hits = 0
+    for message in messages:
+        hits += len(triggers.scan(message))
+    return hits
+
+
+def run(fn, messages, keywords):
+    start = time.perf_counter()
+    fn(messages, keywords)
+    return len(messages) / (time.perf_counter() - start)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rng = random.Random(258)
+
+    print('{:>9} {:>14} {:>14} {:>8}'.format('triggers', 'legacy msg/s', 'engine msg/s', 'speedup'))
+    for trigger_count in (len(BUILTIN), 100, 1000, 5000):
+        keywords = BUILTIN + [random_word(rng, rng.randint(4, 10)) for _ in range(trigger_count - len(BUILTIN))]
+        messages = make_messages(rng, count, keywords)
+
+        before = run(legacy, messages, keywords)
+        after = run(engine, messages, keywords)
+        print('{:>9} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(trigger_count, before, after, after / before))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+import asyncio
+import datetime
+import itertools
+import os
+import random
+import string
+import sys
+import tempfile
+import zlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Where the benchmark was started from, for the paths given on its command line.
+CWD = os.getcwd()
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+import discord
+from discord.ext import commands
+
+'''
+    Offline stand-ins for the benchmarks: enough of a Discord client for the listeners and commands
+    to run in process, and a YoutubeDL that makes up deterministic info dicts instead of going to
+    the network.
+
+    offline() has to come before importing any of the bot's modules: Music, the store and the
+    caches open their files in the working directory, which it moves to a scratch directory.
+    Paths from the command line go through user_path() to still mean what they did.
+'''
+
+
+def offline():
+    os.chdir(tempfile.mkdtemp(prefix='mothbot-bench-'))
+    # Benchmarks drive everything on the loop the bot and its tasks were created with.
+    return asyncio.get_event_loop()
+
+
+def user_path(path: str):
+    return os.path.join(CWD, os.path.expanduser(path))
+
+
+def random_text(rng: random.Random, length: int):
+    return ''.join(rng.choices(string.ascii_letters + ' ', k=length))
+
+
+# Roughly the shape of a processed youtube_dl info dict for a YouTube video.
+def make_info(rng: random.Random, video_id: str = None):
+    video_id = video_id or random_text(rng, 11)
+    formats = [{
+        'format_id': str(rng.randint(100, 400)),
+        # Far enough out that the stream urls never count as expired.
+        'url': 'https://r1.googlevideo.com/videoplayback?expire=4102444800&id=' + random_text(rng, 300),
+        'ext': rng.choice(('webm', 'm4a', 'mp4')),
+        'acodec': rng.choice(('opus', 'mp4a.40.2', 'none')),
+        'vcodec': rng.choice(('none', 'avc1.4d401e', 'vp9')),
+        'abr': rng.randint(48, 160),
+        'asr': 48000,
+        'filesize': rng.randint(10 ** 5, 10 ** 8),
+        'format_note': random_text(rng, 10),
+        'fps': rng.choice((None, 30, 60)),
+        'height': rng.choice((None, 360, 720, 1080)),
+        'width': rng.choice((None, 640, 1280, 1920)),
+        'tbr': rng.random() * 1000,
+        'protocol': 'https',
+        'http_headers': {'User-Agent': random_text(rng, 100), 'Accept': random_text(rng, 60)},
+    } for _ in range(25)]
+
+    info = {
+        'id': video_id,
+        'extractor': 'youtube',
+        'title': random_text(rng, 60),
+        'uploader': random_text(rng, 20),
+        'uploader_url': 'http://www.youtube.com/user/' + random_text(rng, 20),
+        'upload_date': '20200101',
+        'thumbnail': 'https://i.ytimg.com/vi/{}/maxresdefault.jpg'.format(video_id),
+        'thumbnails': [{'url': random_text(rng, 80), 'id': str(i)} for i in range(20)],
+        'description': random_text(rng, 2500),
+        'duration': rng.randint(60, 600),
+        'tags': [random_text(rng, 12) for _ in range(15)],
+        'categories': ['Music'],
+        'webpage_url': 'https://www.youtube.com/watch?v=' + video_id,
+        'view_count': rng.randint(0, 10 ** 8),
+        'like_count': rng.randint(0, 10 ** 6),
+        'dislike_count': rng.randint(0, 10 ** 5),
+        'formats': formats,
+        'requested_formats': None,
+        'automatic_captions': {lang: [{'url': random_text(rng, 120), 'ext': 'vtt'}] for lang in ('en', 'de', 'fr')},
+    }
+    info.update(formats[0])
+    info['acodec'] = 'opus'
+    return info
+
+
+# Stands in for youtube_dl.YoutubeDL with the two calls Extraction.extract_first makes. The same
+# search or url always gives the same video, and nothing sleeps. Videos are made up once and kept,
+# prepare() makes them ahead of time, so only the bot's own work is timed.
+class FakeYoutubeDL:
+    def __init__(self):
+        self.calls = 0
+        self._videos = {}
+
+    def prepare(self, searches):
+        for search in searches:
+            self.process_ie_result(self.extract_info(search))
+
+    @staticmethod
+    def _video_id(url: str):
+        if 'watch?v=' in url:
+            return url.split('watch?v=', 1)[1][:11]
+        return '{:011x}'.format(zlib.crc32(url.encode()))[-11:]
+
+    def extract_info(self, url: str, download: bool = False, process: bool = False):
+        self.calls += 1
+        video_id = self._video_id(url)
+        if '://' in url:
+            return {'_type': 'url', 'url': 'https://www.youtube.com/watch?v=' + video_id, 'ie_key': 'Youtube'}
+        return {'_type': 'playlist', 'entries': [{'_type': 'url', 'url': video_id, 'ie_key': 'Youtube'}]}
+
+    def process_ie_result(self, result: dict, download: bool = False):
+        if result.get('_type') == 'playlist':
+            return dict(result, entries=[self.process_ie_result(entry) for entry in result['entries']])
+        video_id = self._video_id(result['url'] if '://' in result['url'] else 'watch?v=' + result['url'])
+        info = self._videos.get(video_id)
+        if info is None:
+            info = self._videos[video_id] = make_info(random.Random(video_id), video_id)
+        return info
+
+
+class FakeUser:
+    def __init__(self, user_id: int, name: str, *, bot: bool = False):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.nick = None
+        self.bot = bot
+        self.mention = '<@{}>'.format(user_id)
+        self.voice = None
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return self.id >> 22
+
+
+class FakeGuild:
+    def __init__(self, guild_id: int, name: str = 'guild'):
+        self.id = guild_id
+        self.name = name
+        self.voice_client = None
+        self.me = None
+        self.voice_channel = None
+
+
+# What member.voice is while a member sits in a voice channel.
+class FakeVoiceState:
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeVoiceChannel:
+    def __init__(self, loop: asyncio.AbstractEventLoop, guild: FakeGuild, channel_id: int):
+        self.loop = loop
+        self.guild = guild
+        self.id = channel_id
+        self.name = 'voice-{}'.format(channel_id)
+
+    async def connect(self):
+        self.guild.voice_client = FakeVoiceClient(self.loop, self)
+        return self.guild.voice_client
+
+
+# Plays a source the way discord.py's AudioPlayer does as far as the bot can tell: a few frames get
+# read, and after the song's length (on the loop's clock) the source is cleaned up and after() called.
+# Reading every 20ms frame is left out, nothing is sent anywhere anyway.
+class FakeVoiceClient:
+    FRAMES = 5
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, channel: FakeVoiceChannel):
+        self.loop = loop
+        self.channel = channel
+        self.guild = channel.guild
+        self.source = None
+        self._after = None
+        self._end = None
+        self._ends_at = 0.0
+        self._paused = False
+
+    def play(self, source, *, after=None):
+        if self.source is not None:
+            raise discord.ClientException('Already playing audio.')
+        self.source = source
+        self._after = after
+        for _ in range(self.FRAMES):
+            source.read()
+        self._paused = False
+        self._schedule(max(getattr(source, 'length', 0) - getattr(source, 'position', 0), 0.0))
+
+    def _schedule(self, seconds: float):
+        self._ends_at = self.loop.time() + seconds
+        self._end = self.loop.call_later(seconds, self._finish)
+
+    def _finish(self):
+        source, after = self.source, self._after
+        if self._end is not None:
+            self._end.cancel()
+        self.source = self._after = self._end = None
+        self._paused = False
+        source.cleanup()
+        if after is not None:
+            after(None)
+
+    def is_playing(self):
+        return self.source is not None and not self._paused
+
+    def is_paused(self):
+        return self.source is not None and self._paused
+
+    def pause(self):
+        if self.is_playing():
+            self._end.cancel()
+            self._ends_at -= self.loop.time()
+            self._paused = True
+
+    def resume(self):
+        if self.is_paused():
+            self._paused = False
+            # While paused, _ends_at is what was left of the song.
+            self._schedule(self._ends_at)
+
+    def stop(self):
+        if self.source is not None:
+            self._finish()
+
+    async def move_to(self, channel: FakeVoiceChannel):
+        self.channel = channel
+
+    async def disconnect(self, *, force: bool = False):
+        self.stop()
+        if self.guild.voice_client is self:
+            self.guild.voice_client = None
+
+
+# A real TextChannel (the listeners check isinstance) whose sends stay in process.
+class FakeChannel(discord.TextChannel):
+    def __init__(self, state, guild: FakeGuild, channel_id: int):
+        self._state = state
+        self.guild = guild
+        self.id = channel_id
+        self.name = 'channel-{}'.format(channel_id)
+        self.sent = 0
+        self._ids = itertools.count(channel_id * 1000)
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessage(next(self._ids), content or '', self, self._state.user)
+
+    def typing(self):
+        return FakeTyping()
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class FakeMessage:
+    def __init__(self, message_id: int, content: str, channel: FakeChannel, author: FakeUser):
+        self._state = channel._state
+        self.id = message_id
+        self.content = content
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.mentions = []
+        self.created_at = datetime.datetime.utcnow()
+        self.reactions = 0
+
+    async def add_reaction(self, emoji):
+        self.reactions += 1
+
+    async def edit(self, **kwargs):
+        pass
+
+    async def delete(self):
+        pass
+
+
+class FakeContext:
+    def __init__(self, bot, message: FakeMessage, command=None):
+        self.bot = bot
+        self.message = message
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+        self.command = command
+        self.voice_client = None
+        self.sent = []
+
+    async def send(self, content=None, **kwargs):
+        self.sent.append(content)
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return FakeTyping()
+
+
+# A real commands.Context, for going through get_context() and invoke() like a message would, whose
+# replies stay in process.
+class FakeCommandContext(commands.Context):
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return FakeTyping()
+
+
+# A logged in bot as far as the handlers can tell: it has a user, an owner and a few guilds with a
+# channel each, and nothing it sends leaves the process.
+class FakeDiscord:
+    def __init__(self, bot, guilds: int = 10):
+        self.bot = bot
+        self.user = FakeUser(1000, 'MothBot', bot=True)
+        self.owner = FakeUser(1, 'owner')
+        bot._connection.user = self.user
+        bot.owner_id = self.owner.id
+
+        self.guilds = [FakeGuild((i + 1) << 22, 'guild-{}'.format(i)) for i in range(guilds)]
+        self.channels = [FakeChannel(bot._connection, guild, 100 + i) for i, guild in enumerate(self.guilds)]
+        for i, guild in enumerate(self.guilds):
+            guild.voice_channel = FakeVoiceChannel(bot.loop, guild, 100 + guilds + i)
+        self.members = [FakeUser(2000 + i, 'member-{}'.format(i)) for i in range(50)]
+        self._ids = itertools.count(10 ** 6)
+
+    def message(self, content: str, rng: random.Random):
+        channel = rng.choice(self.channels)
+        return FakeMessage(next(self._ids), content, channel, rng.choice(self.members))
+
+    def context(self, content: str, rng: random.Random, command=None):
+        return FakeContext(self.bot, self.message(content, rng), command)
+
+    # Runs message through the bot's command handling, checks and hooks included.
+    async def command(self, message: FakeMessage):
+        ctx = await self.bot.get_context(message, cls=FakeCommandContext)
+        await self.bot.invoke(ctx)
+        return ctx
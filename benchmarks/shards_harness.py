@@ -0,0 +1,219 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+import discord
+
+import fakes
+import Shards
+
+'''
+    Sharded mode against a local fake gateway: a real Coordinator starting real MothBot shards,
+    each one a process of this script that builds the bot with Shards.connect() and runs it against
+    the fake Discord client instead of logging in. Shard 0 gets the owner's DMs, as it would from
+    Discord, and drives the checks through the bot's own command handling:
+
+        routing     m!set and m!say on a channel whose guild another shard owns, answered by that
+                    shard through the coordinator
+        restart     a shard that dies is started again and takes calls again once it has reconnected
+        stop        m!shutdown logs every shard out and the coordinator returns 'stop'
+        argv        every shard was started with the coordinator's command line less --shards,
+                    which is how flags like --metrics get to them
+
+    Each shard appends what it saw to a json lines file, which the coordinator side checks once
+    every shard has exited.
+
+        python benchmarks/shards_harness.py [--shards N] [--label TEXT]
+'''
+
+parser = argparse.ArgumentParser(description='MothBot sharded mode against a fake gateway.')
+parser.add_argument('--shards', type=int, default=2, help='at least 2, the checks route between shards')
+parser.add_argument('--label', default='fake-gateway', help='does nothing, a flag for the shards to be passed')
+args = parser.parse_args()
+
+OUT_ENV = 'MOTHBOT_HARNESS_OUT'
+# How long a shard waits for the others before giving up on a check, seconds.
+PATIENCE = 30.0
+
+
+def record(**values):
+    with open(os.environ[OUT_ENV], 'a') as file:
+        file.write(json.dumps(dict(values, shard=Shards.link.id, pid=os.getpid())) + '\n')
+
+
+# A fake channel that keeps what was sent to it, the shards' side of the checks.
+class RecordingChannel(fakes.FakeChannel):
+    def __init__(self, state, guild, channel_id: int):
+        super().__init__(state, guild, channel_id)
+        self.messages = []
+
+    async def send(self, content=None, **kwargs):
+        self.messages.append(content)
+        record(channel=self.id, content=content)
+        return await super().send(content, **kwargs)
+
+
+# The channel lookups the gateway would otherwise answer. Like discord.py, fetching a channel of a
+# guild this shard doesn't have gives it a bare discord.Object for a guild.
+def fake_gateway(bot, discord_: fakes.FakeDiscord):
+    channels = {channel.id: RecordingChannel(bot._connection, channel.guild, channel.id)
+                for channel in discord_.channels}
+
+    async def fetch_channel(channel_id: int):
+        channel = channels[channel_id]
+        if Shards.owns(bot, channel.guild.id):
+            return channel
+        return RecordingChannel(bot._connection, discord.Object(channel.guild.id), channel_id)
+
+    def get_channel(channel_id: int):
+        channel = channels.get(channel_id)
+        return channel if channel is not None and Shards.owns(bot, channel.guild.id) else None
+
+    bot.get_channel = get_channel
+    bot.fetch_channel = fetch_channel
+    return channels
+
+
+# Calls name on shard_id until it answers with something accept() takes, through restarts and all.
+async def until(shard_id: int, name: str, accept=lambda value: True):
+    deadline = time.monotonic() + PATIENCE
+    while time.monotonic() < deadline:
+        try:
+            value = await Shards.link.call(shard_id, name, timeout=2.0)
+            if accept(value):
+                return value
+        except (RuntimeError, asyncio.TimeoutError):
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError('Shard {} never answered {}'.format(shard_id, name))
+
+
+# Shard 0's side. Whatever goes wrong is recorded and every shard stopped, rather than left hanging.
+async def drive(bot, discord_: fakes.FakeDiscord, channels: dict):
+    try:
+        await checks(bot, discord_, channels)
+    except Exception as e:
+        record(error=repr(e))
+        Shards.link.stop_all('stop')
+
+
+async def checks(bot, discord_: fakes.FakeDiscord, channels: dict):
+    # The owner's DMs, they only come in on shard 0.
+    dm = RecordingChannel(bot._connection, None, 1)
+
+    async def owner(content: str):
+        before = len(dm.messages)
+        await discord_.command(fakes.FakeMessage(next(discord_._ids), content, dm, discord_.owner))
+        return dm.messages[before:]
+
+    for shard_id in range(Shards.link.count):
+        await until(shard_id, 'pid')
+
+    # The first guild, whose id is 1 << 22, belongs to shard 1.
+    target = next(channel for channel in channels.values() if not Shards.owns(bot, channel.guild.id))
+    owner_shard = Shards.shard_for(target.guild.id, Shards.link.count)
+    record(check='set', replies=await owner('m!set {}'.format(target.id)))
+    record(check='say', replies=await owner('m!say routed'))
+
+    first = await until(owner_shard, 'pid')
+    try:
+        await Shards.link.call(owner_shard, 'crash', timeout=2.0)
+    except (RuntimeError, asyncio.TimeoutError):
+        pass
+    restarted = await until(owner_shard, 'pid', lambda pid: pid != first)
+    record(check='restart', before=first, after=restarted)
+    record(check='say_again', replies=await owner('m!say routed again'))
+
+    await owner('m!shutdown')
+
+
+async def shard():
+    import Music
+    import MothBot
+
+    link = Shards.connect()
+    bot = MothBot.MothBot(link)
+    discord_ = fakes.FakeDiscord(bot)
+    channels = fake_gateway(bot, discord_)
+
+    async def pid():
+        return os.getpid()
+
+    async def crash():
+        # After answering, so the caller isn't left waiting on it.
+        bot.loop.call_later(0.1, os._exit, 1)
+        return os.getpid()
+
+    link.handlers['pid'] = pid
+    link.handlers['crash'] = crash
+    record(argv=sys.argv[1:])
+
+    if link.id == 0:
+        bot.loop.create_task(drive(bot, discord_, channels))
+
+    # Logged out through the link once the coordinator stops the shards.
+    while not bot.is_closed():
+        await asyncio.sleep(0.1)
+    bot.store.close()
+    Music.YTDLInfo.close()
+
+
+def check(name: str, ok: bool, detail=''):
+    print('{:<10} {}  {}'.format(name, 'ok' if ok else 'FAILED', detail))
+    return ok
+
+
+def coordinate():
+    if args.shards < 2:
+        sys.exit('--shards has to be at least 2.')
+
+    # The shards are started with the Coordinator's default command, which passes this command line on.
+    # --label always goes on it, so that there is something to pass.
+    if not any(arg == '--label' or arg.startswith('--label=') for arg in sys.argv):
+        sys.argv += ['--label', args.label]
+
+    out = tempfile.NamedTemporaryFile(prefix='mothbot-shards-', suffix='.jsonl', delete=False).name
+    os.environ[OUT_ENV] = out
+
+    coordinator = Shards.Coordinator(args.shards)
+    coordinator.RESTART_DELAY = 0.5
+    started = time.monotonic()
+    mode = coordinator.run()
+
+    with open(out) as file:
+        lines = [json.loads(line) for line in file]
+    os.remove(out)
+    results = {line['check']: line for line in lines if 'check' in line}
+    sent = [line['content'] for line in lines if 'channel' in line and line['channel'] != 1]
+    errors = [line['error'] for line in lines if 'error' in line]
+    argvs = [line['argv'] for line in lines if 'argv' in line]
+
+    print('{} shards, {:.1f}s'.format(args.shards, time.monotonic() - started))
+    passed = [
+        check('errors', not errors, '; '.join(errors)),
+        check('set', results.get('set', {}).get('replies') == ['Destination to channel-100 in guild-0.'],
+              results.get('set', {}).get('replies')),
+        check('say', results.get('say', {}).get('replies') == ['Message sent.'] and 'routed' in sent,
+              results.get('say', {}).get('replies')),
+        check('restart', 'restart' in results and coordinator.restarts == 1,
+              '{} restart(s)'.format(coordinator.restarts)),
+        check('say again', results.get('say_again', {}).get('replies') == ['Message sent.']
+              and 'routed again' in sent, results.get('say_again', {}).get('replies')),
+        check('argv', len(argvs) == args.shards + coordinator.restarts
+              and all(argv == Shards.shard_argv() for argv in argvs), argvs[:1]),
+        check('stop', mode == 'stop' and all(process.poll() is not None for process in coordinator.processes),
+              'coordinator returned {!r}'.format(mode)),
+    ]
+    sys.exit(0 if all(passed) else 1)
+
+
+if __name__ == '__main__':
+    if os.environ.get(Shards.SHARD_ENV):
+        fakes.offline()
+        asyncio.get_event_loop().run_until_complete(shard())
+    else:
+        coordinate()
@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import resource
+import selectors
+import subprocess
+import threading
+import time
+from collections import Counter
+
+import fakes
+
+'''
+    Soak test for the music player: hundreds of guilds going through sessions of joining, queueing,
+    skipping and the other player commands, then leaving or going quiet until the player idles out
+    after its 180 seconds, over and over. The commands go through the bot's own command handling
+    against the fake Discord client, with a fake voice client playing each song for its length.
+    Songs get a `cat` child process in place of ffmpeg, opened and cleaned up where ffmpeg would
+    be, so a source that is never cleaned up shows as a leftover process.
+
+    The loop runs on an accelerated clock (--speed simulated seconds per real second), so the idle
+    timeouts, song lengths and prefetch delays all play out faster without changing the bot.
+
+    Every --sample simulated seconds it records RSS, open fds, live tasks, threads, child
+    processes, the player bookkeeping and the number of live objects per type, then reports what
+    kept growing over the run rather than levelling off. At the end every player is stopped and
+    whatever is left over (processes, tasks, players) is reported too.
+
+        python benchmarks/soak.py [--guilds N] [--hours H] [--speed X] [--sample S] [--out FILE]
+'''
+
+parser = argparse.ArgumentParser(description='MothBot music player soak test.')
+parser.add_argument('--guilds', type=int, default=200)
+parser.add_argument('--hours', type=float, default=6.0, help='simulated hours to run for')
+parser.add_argument('--speed', type=float, default=60.0, help='simulated seconds per real second')
+parser.add_argument('--sample', type=float, default=600.0, help='simulated seconds between samples')
+parser.add_argument('--songs', type=int, default=500, help='distinct searches the guilds pick from')
+parser.add_argument('--seed', type=int, default=258)
+parser.add_argument('--out', help='write every sample to this file, one json line each')
+args = parser.parse_args()
+
+
+# Waits 1/speed of what the loop asks for, which together with AcceleratedLoop.time() makes every
+# timer on the loop fire that much sooner.
+class ScaledSelector(selectors.DefaultSelector):
+    def __init__(self, speed: float):
+        super().__init__()
+        self.speed = speed
+
+    def select(self, timeout=None):
+        if timeout is not None and timeout > 0:
+            timeout /= self.speed
+        return super().select(timeout)
+
+
+class AcceleratedLoop(asyncio.SelectorEventLoop):
+    def __init__(self, speed: float):
+        super().__init__(ScaledSelector(speed))
+        self.speed = speed
+        self._origin = time.monotonic()
+
+    def time(self):
+        return self._origin + (time.monotonic() - self._origin) * self.speed
+
+
+# Has to be the loop before the bot gets created with it.
+asyncio.set_event_loop(AcceleratedLoop(args.speed))
+loop = fakes.offline()
+
+import MothBot
+import Music
+
+bot = MothBot.MothBot()
+
+
+# A child process that lives as long as the source would keep ffmpeg. `cat` exits by itself once the
+# pipe closes, so nothing outlives the harness.
+class ChildAudio:
+    SILENCE = b'\xf8\xff\xfe'
+
+    def __init__(self):
+        self.process = subprocess.Popen(['cat'], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+
+    def read(self):
+        return self.SILENCE
+
+    def cleanup(self):
+        if self.process is not None:
+            self.process.kill()
+            self.process.wait()
+            self.process.stdin.close()
+            self.process = None
+
+
+class SoakSource(Music.YTDLOpusSource):
+    def _open(self, start: float = 0.0):
+        return ChildAudio()
+
+
+class Guild:
+    def __init__(self, discord_, guild, channel, rng: random.Random, searches: list):
+        self.discord = discord_
+        self.guild = guild
+        self.channel = channel
+        self.rng = rng
+        self.searches = searches
+        self.members = [fakes.FakeUser(guild.id + i, 'member-{}'.format(i)) for i in range(3)]
+        self.sessions = 0
+        self.idled_out = 0
+
+    @property
+    def state(self):
+        state = cog().voice_states.get(self.guild.id)
+        return state if state is not None and state.exists else None
+
+    async def command(self, content: str, member=None):
+        message = fakes.FakeMessage(next(self.discord._ids), 'm!' + content, self.channel,
+                                    member or self.rng.choice(self.members))
+        await self.discord.command(message)
+
+    async def run(self):
+        rng = self.rng
+        # Staggered, so the guilds don't all start at once.
+        await asyncio.sleep(rng.uniform(0, 1800))
+        while True:
+            await self.session()
+            await asyncio.sleep(rng.expovariate(1 / 1800))
+
+    async def session(self):
+        rng = self.rng
+        self.sessions += 1
+        for member in self.members:
+            member.voice = fakes.FakeVoiceState(self.guild.voice_channel)
+
+        for _ in range(rng.randint(1, 5)):
+            await self.command('play ' + rng.choice(self.searches))
+            await asyncio.sleep(rng.uniform(1, 20))
+
+        left = False
+        for _ in range(rng.randint(0, 20)):
+            await asyncio.sleep(rng.expovariate(1 / 90))
+            if self.state is None:
+                break
+            action = rng.choices(('play', 'playnext', 'skip', 'queue', 'now', 'shuffle', 'volume', 'pause',
+                                  'loop', 'leave'), (30, 8, 20, 15, 5, 5, 5, 5, 2, 3))[0]
+            if action in ('play', 'playnext'):
+                await self.command('{} {}'.format(action, rng.choice(self.searches)))
+            elif action == 'volume':
+                await self.command('volume {}'.format(rng.randint(10, 100)))
+            elif action == 'pause':
+                await self.command('pause')
+                await asyncio.sleep(rng.uniform(5, 60))
+                await self.command('resume')
+            elif action == 'loop':
+                await self.command('loop')
+                await asyncio.sleep(rng.uniform(60, 600))
+                await self.command('loop')
+            elif action == 'leave':
+                await self.command('leave')
+                left = True
+                break
+            else:
+                await self.command(action)
+
+        # Everybody gets out of voice. Unless they said m!leave, the player plays out its queue and
+        # then idles out.
+        for member in self.members:
+            member.voice = None
+        while self.state is not None:
+            await asyncio.sleep(30)
+        if not left:
+            self.idled_out += 1
+
+
+def cog():
+    return bot.get_cog('MusicCog')
+
+
+def rss_kb():
+    try:
+        with open('/proc/self/statm') as file:
+            return int(file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        # Peak rather than current, but still only goes up if the current does.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+def child_processes():
+    pid = str(os.getpid())
+    count = 0
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return None
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as file:
+                # The parent pid is the second field after the parenthesised command name.
+                if file.read().rsplit(')', 1)[1].split()[1] == pid:
+                    count += 1
+        except (OSError, IndexError):
+            pass
+    return count
+
+
+# Live objects per type, for the types of the bot's own modules, the fakes and asyncio.
+def object_counts():
+    modules = set(MothBot.local_modules()) | {'fakes', '__main__', '_asyncio', 'asyncio.events'}
+    counts = Counter()
+    for obj in gc.get_objects():
+        kind = type(obj)
+        if kind.__module__ in modules:
+            counts['objects.' + kind.__qualname__] += 1
+    return counts
+
+
+def sample(guilds: list):
+    music = cog()
+    states = music.voice_states
+    values = {
+        'rss_kb': rss_kb(),
+        'fds': open_fds(),
+        'tasks': len(asyncio.all_tasks(loop)),
+        'threads': threading.active_count(),
+        'children': child_processes(),
+        'voice_states': len(states),
+        'voice_states_live': sum(1 for state in states.values() if state.exists),
+        'players': len(music.players),
+        'outbound_channels': bot.outbound.stats()['channels'],
+        'scheduler_queues': len(Music.YTDLInfo.scheduler.stats()['queued']),
+        'cache_entries': Music.YTDLInfo.extractor.cache.stats()['memory_entries'],
+        'sessions': sum(guild.sessions for guild in guilds),
+    }
+    values.update(object_counts())
+    return {name: value for name, value in values.items() if value is not None}
+
+
+# Metrics that only count what has happened so far, they are meant to go up.
+CUMULATIVE = {'sessions'}
+
+
+# Metrics that fill up to a limit of their own, so growing until then is fine: the extraction cache
+# (searches and infos, `size` each), and the outbound channels with a bucket per route, which are
+# only pruned after a minute of real time.
+def caps(guilds: int):
+    return {
+        'cache_entries': 2 * Music.YTDLInfo.extractor.cache.size,
+        'outbound_channels': guilds,
+        'objects.Bucket': guilds * len(bot.outbound.LIMITS) + 1,
+    }
+
+
+# Whether a metric kept climbing after the warmup: the means of the first, middle and last third of
+# the samples each higher than the one before, and the last well above the first.
+def growing(values: list):
+    third = len(values) // 3
+    if third < 2:
+        return False
+    first, middle, last = (sum(part) / len(part) for part in (values[:third], values[third:-third], values[-third:]))
+    return first < middle < last and last - first > max(2, 0.05 * first)
+
+
+def report(samples: list, hours: float, guilds: int):
+    # The first quarter is the guilds ramping up.
+    steady = samples[len(samples) // 4:]
+    names = sorted(set().union(*(sample_ for _, sample_ in steady)) - CUMULATIVE)
+    limits = caps(guilds)
+
+    print()
+    print('{:<40} {:>10} {:>10} {:>10} {:>12}'.format('metric', 'first', 'last', 'peak', 'per hour'))
+    flagged = []
+    for name in names:
+        values = [sample_.get(name, 0) for _, sample_ in steady]
+        span = (steady[-1][0] - steady[0][0]) / 3600
+        rate = (values[-1] - values[0]) / span if span else 0.0
+        note = ''
+        if growing(values):
+            if name in limits and values[-1] <= limits[name]:
+                note = '  filling up to {}'.format(limits[name])
+            else:
+                flagged.append(name)
+                note = '  GROWING'
+        elif not name.startswith('objects.') or max(values) < 100:
+            continue
+        print('{:<40} {:>10} {:>10} {:>10} {:>+12.1f}{}'.format(name, values[0], values[-1], max(values), rate, note))
+
+    print()
+    if flagged:
+        print('Kept growing over {:.1f} simulated hours: {}'.format(hours, ', '.join(flagged)))
+    else:
+        print('Nothing kept growing over {:.1f} simulated hours.'.format(hours))
+
+
+async def teardown(baseline: dict):
+    music = cog()
+    await asyncio.gather(*(state.stop() for state in music.voice_states.values()))
+    music.voice_states.clear()
+    # As on shutdown. Their writers open the database's WAL files on the first write, after the baseline.
+    Music.YTDLInfo.close()
+    await asyncio.sleep(10)
+    gc.collect()
+
+    after = sample([])
+    leftovers = {name: (baseline.get(name, 0), value) for name, value in after.items()
+                 if name in ('tasks', 'children', 'fds', 'players', 'objects.VoiceState', 'objects.Song',
+                             'objects.SoakSource', 'objects.ChildAudio', 'objects.FakeVoiceClient')}
+    print()
+    print('After stopping every player (before the run -> now):')
+    for name, (before, value) in sorted(leftovers.items()):
+        print('  {:<28} {:>6} -> {:<6}{}'.format(name, before, value, '  LEFT OVER' if value > before else ''))
+
+
+async def soak():
+    Music.Source = SoakSource
+    # Filling the audio cache runs ffmpeg itself, plays are still counted.
+    Music.YTDLInfo.audio_cache.max_length = 0
+    ytdl = fakes.FakeYoutubeDL()
+    Music.YTDLInfo.extractor._ytdl = ytdl
+    searches = ['soak song {}'.format(i) for i in range(args.songs)]
+    ytdl.prepare(searches)
+
+    discord_ = fakes.FakeDiscord(bot, guilds=args.guilds)
+    rng = random.Random(args.seed)
+    guilds = [Guild(discord_, guild, channel, random.Random(rng.random()), searches)
+              for guild, channel in zip(discord_.guilds, discord_.channels)]
+
+    gc.collect()
+    baseline = sample(guilds)
+    tasks = [loop.create_task(guild.run()) for guild in guilds]
+
+    out = open(fakes.user_path(args.out), 'w') if args.out else None
+    samples = []
+    started = loop.time()
+    wall = time.monotonic()
+    try:
+        while loop.time() - started < args.hours * 3600:
+            await asyncio.sleep(args.sample)
+            gc.collect()
+            elapsed = loop.time() - started
+            values = sample(guilds)
+            samples.append((elapsed, values))
+            if out:
+                json.dump({'time': elapsed, **values}, out)
+                out.write('\n')
+                out.flush()
+            print('{:6.2f}h  rss {:7.1f}MB  tasks {:5}  children {:4}  players {:4}/{:<4}  sessions {}'.format(
+                elapsed / 3600, values['rss_kb'] / 1024, values['tasks'], values.get('children', '-'),
+                values['voice_states_live'], values['voice_states'], values['sessions']))
+    finally:
+        for task in tasks:
+            task.cancel()
+        if out:
+            out.close()
+
+    print('{} guilds, {} sessions, {} idled out, {:.0f}s real time'.format(
+        len(guilds), sum(guild.sessions for guild in guilds), sum(guild.idled_out for guild in guilds),
+        time.monotonic() - wall))
+    report(samples, args.hours, len(guilds))
+    await teardown(baseline)
+
+
+def main():
+    try:
+        loop.run_until_complete(soak())
+    finally:
+        bot.store.close()
+        Music.YTDLInfo.close()
+
+
+if __name__ == '__main__':
+    main()